@@ -1,12 +1,12 @@
 from roadtools.roadlib.metadef.entitytypes import *
 
 header = '''import os
-import json
-import datetime
+from roadtools.roadlib import serializer
+from roadtools.roadlib.timestamps import parse_timestamp
 import sqlalchemy.types
-from sqlalchemy import Column, Text, Boolean, BigInteger as Integer, create_engine, Table, ForeignKey
+from sqlalchemy import Column, Text, Boolean, BigInteger as Integer, create_engine, Table, ForeignKey, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, foreign
+from sqlalchemy.orm import relationship, sessionmaker, foreign, deferred
 from sqlalchemy.types import TypeDecorator, TEXT
 Base = declarative_base()
 
@@ -15,38 +15,21 @@ class JSON(TypeDecorator):
     impl = TEXT
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = json.dumps(value)
+            value = serializer.dumps(value)
 
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = json.loads(value)
+            value = serializer.loads(value)
         return value
 
 class DateTime(TypeDecorator):
     impl = sqlalchemy.types.DateTime
     def process_bind_param(self, value, dialect):
         if value is not None and isinstance(value, str):
-            # Sometimes it ends on a Z, sometimes it doesn't
-            if value[-1] == 'Z':
-                if '.' in value:
-                    try:
-                        value = datetime.datetime.strptime(value[:-2], '%Y-%m-%dT%H:%M:%S.%f')
-                    except ValueError:
-                        value = datetime.datetime.strptime(value[:-2], '%Y-%m-%dT%H:%M:%S.')
-                else:
-                    value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
-            elif '.' in value:
-                if '+' in value:
-                    value = datetime.datetime.strptime(value[:-7], '%Y-%m-%dT%H:%M:%S.%f')
-                else:
-                    try:
-                        value = datetime.datetime.strptime(value[:-1], '%Y-%m-%dT%H:%M:%S.%f')
-                    except ValueError:
-                        value = datetime.datetime.strptime(value[:-1], '%Y-%m-%dT%H:%M:%S.')
-            else:
-                value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+            # With or without Z, fraction or offset
+            value = parse_timestamp(value)
 
         return value
 
@@ -77,6 +60,19 @@ class %s(Base, SerializeMixin):
 %s
 '''
 
+# Tables used by gather itself, which do not map to directory objects
+gather_tables = '''
+class GatherCheckpoint(Base, SerializeMixin):
+    __tablename__ = "GatherCheckpoints"
+    task = Column(Text, primary_key=True)
+    objectId = Column(Text, primary_key=True)
+    nextLink = Column(Text)
+    # Decisions that a resumed run follows, such as the direction of group memberships
+    state = Column(Text)
+    done = Column(Boolean)
+
+'''
+
 footer = '''
 def parse_db_argument(dbarg):
     \'\'\'
@@ -104,6 +100,18 @@ def init(create=False, dburl='sqlite:///roadrecon.db'):
         Base.metadata.create_all(engine)
     return engine
 
+def create_indexes(engine):
+    \'\'\'
+    Create the secondary indexes. These are not part of the tables, since
+    maintaining them while inserting slows down gathering, and are created
+    once the data is loaded instead. Existing indexes are kept.
+    \'\'\'
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table, column in indexes:
+            name = quote('ix_%s_%s' % (table, column))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, quote(table), quote(column))))
+
 def get_session(engine):
     Session = sessionmaker(bind=engine)
     return Session()
@@ -122,9 +130,45 @@ custom_splinks = '''
 '''
 
 coldef = '    %s = Column(%s)'
+# Deferred columns are only loaded when accessed, or when a query asks for them
+# with undefer() or undefer_group()
+dcoldef = "    %s = deferred(Column(%s), group='%s')"
 pcoldef = '    %s = Column(%s, primary_key=True)'
 fcoldef = '    %s = Column(%s, ForeignKey("%s"))'
 
+# Large properties that are not analysed, per class. These are only requested
+# by gathers with the full profile, which reads them from the 'heavy' group
+heavy_columns = {
+    'User': ['assignedPlans', 'provisionedPlans', 'provisioningErrors', 'thumbnailPhoto', 'infoCatalogs',
+             'cloudMSRtcPolicyAssignments', 'cloudMSRtcServiceAttributes', 'cloudRtcUserPolicies',
+             'windowsInformationProtectionKey'],
+    'ServicePrincipal': ['appBranding', 'authenticationPolicy', 'samlSingleSignOnSettings'],
+    'Application': ['appBranding', 'logo', 'mainLogo', 'certification', 'parentalControlSettings'],
+    'Group': ['provisioningErrors', 'licenseAssignment', 'exchangeResources', 'sharepointResources', 'infoCatalogs'],
+    'Device': ['deviceSystemMetadata', 'systemLabels'],
+    'Contact': ['provisioningErrors', 'thumbnailPhoto', 'cloudMSRtcPolicyAssignments', 'cloudMSRtcServiceAttributes',
+                'cloudRtcUserPolicies'],
+}
+
+# Other large properties that are only shown for single objects, per class, in the 'details' group
+deferred_columns = {
+    'User': ['assignedLicenses', 'strongAuthenticationDetail'],
+    'ServicePrincipal': ['appRoles', 'oauth2Permissions', 'keyCredentials', 'passwordCredentials', 'addIns'],
+    'Application': ['appRoles', 'oauth2Permissions', 'keyCredentials', 'passwordCredentials', 'addIns',
+                    'requiredResourceAccess', 'optionalClaims'],
+    'Device': ['keyCredentials'],
+}
+
+# Columns that objects are looked up by, other than their primary key, per class
+index_columns = {
+    'AppRoleAssignment': ['principalId', 'resourceId'],
+    'OAuth2PermissionGrant': ['clientId', 'resourceId'],
+    'ServicePrincipal': ['appId'],
+    'Application': ['appId'],
+    'RoleAssignment': ['principalId', 'roleDefinitionId'],
+    'DirectoryRole': ['roleTemplateId'],
+}
+
 def gen_db_class(classdef, rels, rev_rels):
     classname = classdef.__name__
     props = {}
@@ -150,6 +194,10 @@ def gen_db_class(classdef, rels, rev_rels):
             cols.append(pcoldef % (pname, dbtype))
         elif pname == 'roleDefinitionId':
             cols.append(fcoldef % (pname, dbtype, 'RoleDefinitions.objectId'))
+        elif pname in heavy_columns.get(classname, []):
+            cols.append(dcoldef % (pname, dbtype, 'heavy'))
+        elif pname in deferred_columns.get(classname, []):
+            cols.append(dcoldef % (pname, dbtype, 'details'))
         else:
             cols.append(coldef % (pname, dbtype))
     outrels = []
@@ -202,8 +250,8 @@ relations = {
 
 link_tbl_tpl = '''
 lnk_%s = Table('lnk_%s', Base.metadata,
-    Column('%s', Text, ForeignKey('%ss.objectId')),
-    Column('%s', Text, ForeignKey('%ss.objectId'))
+    Column('%s', Text, ForeignKey('%ss.objectId'), primary_key=True),
+    Column('%s', Text, ForeignKey('%ss.objectId'), primary_key=True)
 )
 '''
 
@@ -215,6 +263,13 @@ def gen_link_table(linkname, left_tbl, right_tbl):
         right_tbl_name = right_tbl
     return link_tbl_tpl % (linkname, linkname, left_tbl, left_tbl, right_tbl_name, right_tbl)
 
+def link_table_index(linkname, left_tbl, right_tbl):
+    # The primary key covers lookups of the left column, such as the members of a group,
+    # the right column needs an index for the reverse, such as the groups of a user
+    if left_tbl == right_tbl:
+        return ('lnk_' + linkname, 'child' + right_tbl)
+    return ('lnk_' + linkname, right_tbl)
+
 # Simple link template for many to many relationships with link table
 link_tpl = '''    %s = relationship("%s",
         secondary=lnk_%s,
@@ -277,4 +332,14 @@ with open('metadef/database.py', 'w') as outf:
         outf.write(gen_link_table(relname, reldata[0], reldata[1]))
     for table, links, revlinks in tables:
         outf.write(gen_db_class(table, links, revlinks))
+    outf.write(gather_tables)
+    outf.write('\n# Secondary indexes as (table, column), created by create_indexes()\nindexes = [\n')
+    for relname, reldata in relations.items():
+        if relname == 'role_assignment_active' or relname == 'role_assignment_eligible':
+            continue
+        outf.write('    %r,\n' % (link_table_index(relname, reldata[0], reldata[1]),))
+    for table, _, _ in tables:
+        for column in index_columns.get(table.__name__, []):
+            outf.write('    %r,\n' % ((table.__name__ + 's', column),))
+    outf.write(']\n')
     outf.write(footer)
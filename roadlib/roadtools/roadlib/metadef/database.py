@@ -1,10 +1,10 @@
 import os
-import json
-import datetime
+from roadtools.roadlib import serializer
+from roadtools.roadlib.timestamps import parse_timestamp
 import sqlalchemy.types
-from sqlalchemy import Column, Text, Boolean, BigInteger as Integer, create_engine, Table, ForeignKey
+from sqlalchemy import Column, Text, Boolean, BigInteger as Integer, create_engine, Table, ForeignKey, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, foreign
+from sqlalchemy.orm import relationship, sessionmaker, foreign, deferred
 from sqlalchemy.types import TypeDecorator, TEXT
 Base = declarative_base()
 
@@ -13,38 +13,21 @@ class JSON(TypeDecorator):
     impl = TEXT
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = json.dumps(value)
+            value = serializer.dumps(value)
 
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = json.loads(value)
+            value = serializer.loads(value)
         return value
 
 class DateTime(TypeDecorator):
     impl = sqlalchemy.types.DateTime
     def process_bind_param(self, value, dialect):
         if value is not None and isinstance(value, str):
-            # Sometimes it ends on a Z, sometimes it doesn't
-            if value[-1] == 'Z':
-                if '.' in value:
-                    try:
-                        value = datetime.datetime.strptime(value[:-2], '%Y-%m-%dT%H:%M:%S.%f')
-                    except ValueError:
-                        value = datetime.datetime.strptime(value[:-2], '%Y-%m-%dT%H:%M:%S.')
-                else:
-                    value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
-            elif '.' in value:
-                if '+' in value:
-                    value = datetime.datetime.strptime(value[:-7], '%Y-%m-%dT%H:%M:%S.%f')
-                else:
-                    try:
-                        value = datetime.datetime.strptime(value[:-1], '%Y-%m-%dT%H:%M:%S.%f')
-                    except ValueError:
-                        value = datetime.datetime.strptime(value[:-1], '%Y-%m-%dT%H:%M:%S.')
-            else:
-                value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+            # With or without Z, fraction or offset
+            value = parse_timestamp(value)
 
         return value
 
@@ -68,93 +51,93 @@ class SerializeMixin():
         return str(self.as_dict(True))
 
 lnk_group_member_user = Table('lnk_group_member_user', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_group_member_group = Table('lnk_group_member_group', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('childGroup', Text, ForeignKey('Groups.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('childGroup', Text, ForeignKey('Groups.objectId'), primary_key=True)
 )
 
 lnk_group_member_contact = Table('lnk_group_member_contact', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('Contact', Text, ForeignKey('Contacts.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('Contact', Text, ForeignKey('Contacts.objectId'), primary_key=True)
 )
 
 lnk_group_member_device = Table('lnk_group_member_device', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('Device', Text, ForeignKey('Devices.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('Device', Text, ForeignKey('Devices.objectId'), primary_key=True)
 )
 
 lnk_group_member_serviceprincipal = Table('lnk_group_member_serviceprincipal', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True)
 )
 
 lnk_device_owner = Table('lnk_device_owner', Base.metadata,
-    Column('Device', Text, ForeignKey('Devices.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('Device', Text, ForeignKey('Devices.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_application_owner_user = Table('lnk_application_owner_user', Base.metadata,
-    Column('Application', Text, ForeignKey('Applications.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('Application', Text, ForeignKey('Applications.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_application_owner_serviceprincipal = Table('lnk_application_owner_serviceprincipal', Base.metadata,
-    Column('Application', Text, ForeignKey('Applications.objectId')),
-    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'))
+    Column('Application', Text, ForeignKey('Applications.objectId'), primary_key=True),
+    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True)
 )
 
 lnk_serviceprincipal_owner_user = Table('lnk_serviceprincipal_owner_user', Base.metadata,
-    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_serviceprincipal_owner_serviceprincipal = Table('lnk_serviceprincipal_owner_serviceprincipal', Base.metadata,
-    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId')),
-    Column('childServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'))
+    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True),
+    Column('childServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True)
 )
 
 lnk_role_member_user = Table('lnk_role_member_user', Base.metadata,
-    Column('DirectoryRole', Text, ForeignKey('DirectoryRoles.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('DirectoryRole', Text, ForeignKey('DirectoryRoles.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_role_member_serviceprincipal = Table('lnk_role_member_serviceprincipal', Base.metadata,
-    Column('DirectoryRole', Text, ForeignKey('DirectoryRoles.objectId')),
-    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'))
+    Column('DirectoryRole', Text, ForeignKey('DirectoryRoles.objectId'), primary_key=True),
+    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True)
 )
 
 lnk_role_member_group = Table('lnk_role_member_group', Base.metadata,
-    Column('DirectoryRole', Text, ForeignKey('DirectoryRoles.objectId')),
-    Column('Group', Text, ForeignKey('Groups.objectId'))
+    Column('DirectoryRole', Text, ForeignKey('DirectoryRoles.objectId'), primary_key=True),
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True)
 )
 
 lnk_group_owner_user = Table('lnk_group_owner_user', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_group_owner_serviceprincipal = Table('lnk_group_owner_serviceprincipal', Base.metadata,
-    Column('Group', Text, ForeignKey('Groups.objectId')),
-    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'))
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True),
+    Column('ServicePrincipal', Text, ForeignKey('ServicePrincipals.objectId'), primary_key=True)
 )
 
 lnk_au_member_user = Table('lnk_au_member_user', Base.metadata,
-    Column('AdministrativeUnit', Text, ForeignKey('AdministrativeUnits.objectId')),
-    Column('User', Text, ForeignKey('Users.objectId'))
+    Column('AdministrativeUnit', Text, ForeignKey('AdministrativeUnits.objectId'), primary_key=True),
+    Column('User', Text, ForeignKey('Users.objectId'), primary_key=True)
 )
 
 lnk_au_member_group = Table('lnk_au_member_group', Base.metadata,
-    Column('AdministrativeUnit', Text, ForeignKey('AdministrativeUnits.objectId')),
-    Column('Group', Text, ForeignKey('Groups.objectId'))
+    Column('AdministrativeUnit', Text, ForeignKey('AdministrativeUnits.objectId'), primary_key=True),
+    Column('Group', Text, ForeignKey('Groups.objectId'), primary_key=True)
 )
 
 lnk_au_member_device = Table('lnk_au_member_device', Base.metadata,
-    Column('AdministrativeUnit', Text, ForeignKey('AdministrativeUnits.objectId')),
-    Column('Device', Text, ForeignKey('Devices.objectId'))
+    Column('AdministrativeUnit', Text, ForeignKey('AdministrativeUnits.objectId'), primary_key=True),
+    Column('Device', Text, ForeignKey('Devices.objectId'), primary_key=True)
 )
 
 class AppRoleAssignment(Base, SerializeMixin):
@@ -196,17 +179,17 @@ class User(Base, SerializeMixin):
     signInNames = Column(JSON)
     signInNamesInfo = Column(JSON)
     appMetadata = Column(JSON)
-    assignedLicenses = Column(JSON)
-    assignedPlans = Column(JSON)
+    assignedLicenses = deferred(Column(JSON), group='details')
+    assignedPlans = deferred(Column(JSON), group='heavy')
     city = Column(Text)
     cloudAudioConferencingProviderInfo = Column(Text)
     cloudMSExchRecipientDisplayType = Column(Integer)
     cloudMSRtcIsSipEnabled = Column(Boolean)
     cloudMSRtcOwnerUrn = Column(Text)
-    cloudMSRtcPolicyAssignments = Column(JSON)
+    cloudMSRtcPolicyAssignments = deferred(Column(JSON), group='heavy')
     cloudMSRtcPool = Column(Text)
-    cloudMSRtcServiceAttributes = Column(JSON)
-    cloudRtcUserPolicies = Column(Text)
+    cloudMSRtcServiceAttributes = deferred(Column(JSON), group='heavy')
+    cloudRtcUserPolicies = deferred(Column(Text), group='heavy')
     cloudSecurityIdentifier = Column(Text)
     cloudSipLine = Column(Text)
     cloudSipProxyAddress = Column(Text)
@@ -241,7 +224,7 @@ class User(Base, SerializeMixin):
     givenName = Column(Text)
     hasOnPremisesShadow = Column(Boolean)
     immutableId = Column(Text)
-    infoCatalogs = Column(JSON)
+    infoCatalogs = deferred(Column(JSON), group='heavy')
     invitedAsMail = Column(Text)
     invitedOn = Column(DateTime)
     inviteReplyUrl = Column(JSON)
@@ -274,8 +257,8 @@ class User(Base, SerializeMixin):
     preferredDataLocation = Column(Text)
     preferredLanguage = Column(Text)
     primarySMTPAddress = Column(Text)
-    provisionedPlans = Column(JSON)
-    provisioningErrors = Column(JSON)
+    provisionedPlans = deferred(Column(JSON), group='heavy')
+    provisioningErrors = deferred(Column(JSON), group='heavy')
     proxyAddresses = Column(JSON)
     refreshTokensValidFromDateTime = Column(DateTime)
     releaseTrack = Column(Text)
@@ -297,14 +280,14 @@ class User(Base, SerializeMixin):
     streetAddress = Column(Text)
     surname = Column(Text)
     telephoneNumber = Column(Text)
-    thumbnailPhoto = Column(Text)
+    thumbnailPhoto = deferred(Column(Text), group='heavy')
     usageLocation = Column(Text)
     userPrincipalName = Column(Text)
     userState = Column(Text)
     userStateChangedOn = Column(DateTime)
     userType = Column(Text)
-    strongAuthenticationDetail = Column(JSON)
-    windowsInformationProtectionKey = Column(JSON)
+    strongAuthenticationDetail = deferred(Column(JSON), group='details')
+    windowsInformationProtectionKey = deferred(Column(JSON), group='heavy')
     memberOf = relationship("Group",
         secondary=lnk_group_member_user,
         back_populates="memberUsers")
@@ -340,9 +323,9 @@ class ServicePrincipal(Base, SerializeMixin):
     objectId = Column(Text, primary_key=True)
     deletionTimestamp = Column(DateTime)
     accountEnabled = Column(Boolean)
-    addIns = Column(JSON)
+    addIns = deferred(Column(JSON), group='details')
     alternativeNames = Column(JSON)
-    appBranding = Column(JSON)
+    appBranding = deferred(Column(JSON), group='heavy')
     appCategory = Column(Text)
     appData = Column(Text)
     appDisplayName = Column(Text)
@@ -351,27 +334,27 @@ class ServicePrincipal(Base, SerializeMixin):
     appMetadata = Column(JSON)
     appOwnerTenantId = Column(Text)
     appRoleAssignmentRequired = Column(Boolean)
-    appRoles = Column(JSON)
-    authenticationPolicy = Column(JSON)
+    appRoles = deferred(Column(JSON), group='details')
+    authenticationPolicy = deferred(Column(JSON), group='heavy')
     disabledByMicrosoftStatus = Column(Text)
     displayName = Column(Text)
     errorUrl = Column(Text)
     homepage = Column(Text)
     informationalUrls = Column(JSON)
-    keyCredentials = Column(JSON)
+    keyCredentials = deferred(Column(JSON), group='details')
     logoutUrl = Column(Text)
     managedIdentityResourceId = Column(Text)
     microsoftFirstParty = Column(Boolean)
     notificationEmailAddresses = Column(JSON)
-    oauth2Permissions = Column(JSON)
-    passwordCredentials = Column(JSON)
+    oauth2Permissions = deferred(Column(JSON), group='details')
+    passwordCredentials = deferred(Column(JSON), group='details')
     preferredSingleSignOnMode = Column(Text)
     preferredTokenSigningKeyEndDateTime = Column(DateTime)
     preferredTokenSigningKeyThumbprint = Column(Text)
     publisherName = Column(Text)
     replyUrls = Column(JSON)
     samlMetadataUrl = Column(Text)
-    samlSingleSignOnSettings = Column(JSON)
+    samlSingleSignOnSettings = deferred(Column(JSON), group='heavy')
     servicePrincipalNames = Column(JSON)
     tags = Column(JSON)
     tokenEncryptionKeyId = Column(Text)
@@ -434,19 +417,19 @@ class Group(Base, SerializeMixin):
     description = Column(Text)
     dirSyncEnabled = Column(Boolean)
     displayName = Column(Text)
-    exchangeResources = Column(JSON)
+    exchangeResources = deferred(Column(JSON), group='heavy')
     expirationDateTime = Column(DateTime)
     externalGroupIds = Column(JSON)
     externalGroupProviderId = Column(Text)
     externalGroupState = Column(Text)
     creationOptions = Column(JSON)
     groupTypes = Column(JSON)
-    infoCatalogs = Column(JSON)
+    infoCatalogs = deferred(Column(JSON), group='heavy')
     isAssignableToRole = Column(Boolean)
     isMembershipRuleLocked = Column(Boolean)
     isPublic = Column(Boolean)
     lastDirSyncTime = Column(DateTime)
-    licenseAssignment = Column(JSON)
+    licenseAssignment = deferred(Column(JSON), group='heavy')
     mail = Column(Text)
     mailNickname = Column(Text)
     mailEnabled = Column(Boolean)
@@ -457,13 +440,13 @@ class Group(Base, SerializeMixin):
     preferredDataLocation = Column(Text)
     preferredLanguage = Column(Text)
     primarySMTPAddress = Column(Text)
-    provisioningErrors = Column(JSON)
+    provisioningErrors = deferred(Column(JSON), group='heavy')
     proxyAddresses = Column(JSON)
     renewedDateTime = Column(DateTime)
     resourceBehaviorOptions = Column(JSON)
     resourceProvisioningOptions = Column(JSON)
     securityEnabled = Column(Boolean)
-    sharepointResources = Column(JSON)
+    sharepointResources = deferred(Column(JSON), group='heavy')
     targetAddress = Column(Text)
     theme = Column(Text)
     visibility = Column(Text)
@@ -518,18 +501,18 @@ class Application(Base, SerializeMixin):
     objectType = Column(Text)
     objectId = Column(Text, primary_key=True)
     deletionTimestamp = Column(DateTime)
-    addIns = Column(JSON)
+    addIns = deferred(Column(JSON), group='details')
     allowActAsForAllClients = Column(Boolean)
     allowPassthroughUsers = Column(Boolean)
-    appBranding = Column(JSON)
+    appBranding = deferred(Column(JSON), group='heavy')
     appCategory = Column(Text)
     appData = Column(Text)
     appId = Column(Text)
     applicationTemplateId = Column(Text)
     appMetadata = Column(JSON)
-    appRoles = Column(JSON)
+    appRoles = deferred(Column(JSON), group='details')
     availableToOtherTenants = Column(Boolean)
-    certification = Column(JSON)
+    certification = deferred(Column(JSON), group='heavy')
     disabledByMicrosoftStatus = Column(Text)
     displayName = Column(Text)
     encryptedMsiApplicationSecret = Column(Text)
@@ -539,25 +522,25 @@ class Application(Base, SerializeMixin):
     identifierUris = Column(JSON)
     informationalUrls = Column(JSON)
     isDeviceOnlyAuthSupported = Column(Boolean)
-    keyCredentials = Column(JSON)
+    keyCredentials = deferred(Column(JSON), group='details')
     knownClientApplications = Column(JSON)
-    logo = Column(Text)
+    logo = deferred(Column(Text), group='heavy')
     logoUrl = Column(Text)
     logoutUrl = Column(Text)
-    mainLogo = Column(Text)
+    mainLogo = deferred(Column(Text), group='heavy')
     oauth2AllowIdTokenImplicitFlow = Column(Boolean)
     oauth2AllowImplicitFlow = Column(Boolean)
     oauth2AllowUrlPathMatching = Column(Boolean)
-    oauth2Permissions = Column(JSON)
+    oauth2Permissions = deferred(Column(JSON), group='details')
     oauth2RequirePostResponse = Column(Boolean)
-    optionalClaims = Column(JSON)
-    parentalControlSettings = Column(JSON)
-    passwordCredentials = Column(JSON)
+    optionalClaims = deferred(Column(JSON), group='details')
+    parentalControlSettings = deferred(Column(JSON), group='heavy')
+    passwordCredentials = deferred(Column(JSON), group='details')
     publicClient = Column(Boolean)
     publisherDomain = Column(Text)
     recordConsentConditions = Column(Text)
     replyUrls = Column(JSON)
-    requiredResourceAccess = Column(JSON)
+    requiredResourceAccess = deferred(Column(JSON), group='details')
     samlMetadataUrl = Column(Text)
     supportsConvergence = Column(Boolean)
     tokenEncryptionKeyId = Column(Text)
@@ -597,7 +580,7 @@ class Device(Base, SerializeMixin):
     deviceOSVersion = Column(Text)
     deviceOwnership = Column(Text)
     devicePhysicalIds = Column(JSON)
-    deviceSystemMetadata = Column(JSON)
+    deviceSystemMetadata = deferred(Column(JSON), group='heavy')
     deviceTrustType = Column(Text)
     dirSyncEnabled = Column(Boolean)
     displayName = Column(Text)
@@ -610,7 +593,7 @@ class Device(Base, SerializeMixin):
     isCompliant = Column(Boolean)
     isManaged = Column(Boolean)
     isRooted = Column(Boolean)
-    keyCredentials = Column(JSON)
+    keyCredentials = deferred(Column(JSON), group='details')
     lastDirSyncTime = Column(DateTime)
     localCredentials = Column(Text)
     managementType = Column(Text)
@@ -619,7 +602,7 @@ class Device(Base, SerializeMixin):
     profileType = Column(Text)
     reserved1 = Column(Text)
     sourceType = Column(Text)
-    systemLabels = Column(JSON)
+    systemLabels = deferred(Column(JSON), group='heavy')
     owner = relationship("User",
         secondary=lnk_device_owner,
         back_populates="ownedDevices")
@@ -744,10 +727,10 @@ class Contact(Base, SerializeMixin):
     cloudAudioConferencingProviderInfo = Column(Text)
     cloudMSRtcIsSipEnabled = Column(Boolean)
     cloudMSRtcOwnerUrn = Column(Text)
-    cloudMSRtcPolicyAssignments = Column(JSON)
+    cloudMSRtcPolicyAssignments = deferred(Column(JSON), group='heavy')
     cloudMSRtcPool = Column(Text)
-    cloudMSRtcServiceAttributes = Column(JSON)
-    cloudRtcUserPolicies = Column(Text)
+    cloudMSRtcServiceAttributes = deferred(Column(JSON), group='heavy')
+    cloudRtcUserPolicies = deferred(Column(Text), group='heavy')
     cloudSipLine = Column(Text)
     companyName = Column(Text)
     country = Column(Text)
@@ -763,14 +746,14 @@ class Contact(Base, SerializeMixin):
     mobile = Column(Text)
     physicalDeliveryOfficeName = Column(Text)
     postalCode = Column(Text)
-    provisioningErrors = Column(JSON)
+    provisioningErrors = deferred(Column(JSON), group='heavy')
     proxyAddresses = Column(JSON)
     sipProxyAddress = Column(Text)
     state = Column(Text)
     streetAddress = Column(Text)
     surname = Column(Text)
     telephoneNumber = Column(Text)
-    thumbnailPhoto = Column(Text)
+    thumbnailPhoto = deferred(Column(Text), group='heavy')
     memberOf = relationship("Group",
         secondary=lnk_group_member_contact,
         back_populates="memberContacts")
@@ -878,6 +861,47 @@ class AdministrativeUnit(Base, SerializeMixin):
         back_populates="memberOfAu")
 
 
+class GatherCheckpoint(Base, SerializeMixin):
+    __tablename__ = "GatherCheckpoints"
+    task = Column(Text, primary_key=True)
+    objectId = Column(Text, primary_key=True)
+    nextLink = Column(Text)
+    # Decisions that a resumed run follows, such as the direction of group memberships
+    state = Column(Text)
+    done = Column(Boolean)
+
+
+# Secondary indexes as (table, column), created by create_indexes()
+indexes = [
+    ('lnk_group_member_user', 'User'),
+    ('lnk_group_member_group', 'childGroup'),
+    ('lnk_group_member_contact', 'Contact'),
+    ('lnk_group_member_device', 'Device'),
+    ('lnk_group_member_serviceprincipal', 'ServicePrincipal'),
+    ('lnk_device_owner', 'User'),
+    ('lnk_application_owner_user', 'User'),
+    ('lnk_application_owner_serviceprincipal', 'ServicePrincipal'),
+    ('lnk_serviceprincipal_owner_user', 'User'),
+    ('lnk_serviceprincipal_owner_serviceprincipal', 'childServicePrincipal'),
+    ('lnk_role_member_user', 'User'),
+    ('lnk_role_member_serviceprincipal', 'ServicePrincipal'),
+    ('lnk_role_member_group', 'Group'),
+    ('lnk_group_owner_user', 'User'),
+    ('lnk_group_owner_serviceprincipal', 'ServicePrincipal'),
+    ('lnk_au_member_user', 'User'),
+    ('lnk_au_member_group', 'Group'),
+    ('lnk_au_member_device', 'Device'),
+    ('AppRoleAssignments', 'principalId'),
+    ('AppRoleAssignments', 'resourceId'),
+    ('OAuth2PermissionGrants', 'clientId'),
+    ('OAuth2PermissionGrants', 'resourceId'),
+    ('ServicePrincipals', 'appId'),
+    ('Applications', 'appId'),
+    ('DirectoryRoles', 'roleTemplateId'),
+    ('RoleAssignments', 'principalId'),
+    ('RoleAssignments', 'roleDefinitionId'),
+]
+
 def parse_db_argument(dbarg):
     '''
     Parse DB string given as argument into full path required
@@ -904,6 +928,18 @@ def init(create=False, dburl='sqlite:///roadrecon.db'):
         Base.metadata.create_all(engine)
     return engine
 
+def create_indexes(engine):
+    '''
+    Create the secondary indexes. These are not part of the tables, since
+    maintaining them while inserting slows down gathering, and are created
+    once the data is loaded instead. Existing indexes are kept.
+    '''
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table, column in indexes:
+            name = quote('ix_%s_%s' % (table, column))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, quote(table), quote(column))))
+
 def get_session(engine):
     Session = sessionmaker(bind=engine)
     return Session()
@@ -0,0 +1,55 @@
+'''
+JSON encoding and decoding used for API responses, the JSON column type
+and the GUI. Uses orjson when it is installed, which is several times
+faster than the json module of the standard library, and falls back to
+the json module otherwise. Call dumps and loads through this module,
+so that they follow set_backend.
+'''
+import json
+try:
+    import orjson
+    HAS_ORJSON_MODULE = True
+except ModuleNotFoundError:
+    HAS_ORJSON_MODULE = False
+
+BACKENDS = ('orjson', 'json')
+
+# Raised by loads for invalid JSON, orjson raises a subclass of it
+JSONDecodeError = json.JSONDecodeError
+
+def available_backends():
+    '''
+    The backends that can be used, fastest first
+    '''
+    return [backend for backend in BACKENDS if backend != 'orjson' or HAS_ORJSON_MODULE]
+
+def set_backend(backend):
+    '''
+    Use backend ('orjson' or 'json') for all encoding and decoding
+    '''
+    global BACKEND, dumps, loads
+    if backend not in available_backends():
+        raise ValueError('JSON backend {0} is not available, choose from: {1}'.format(backend, ', '.join(available_backends())))
+    BACKEND = backend
+    if backend == 'orjson':
+        dumps = orjson_dumps
+        loads = orjson.loads
+    else:
+        dumps = json_dumps
+        loads = json.loads
+
+def json_dumps(obj, default=None, sort_keys=False):
+    return json.dumps(obj, default=default, sort_keys=sort_keys)
+
+def orjson_dumps(obj, default=None, sort_keys=False):
+    # Leave datetimes to the default function, as the json module does
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    try:
+        return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+    except orjson.JSONEncodeError:
+        # For example integers that do not fit in 64 bits
+        return json_dumps(obj, default=default, sort_keys=sort_keys)
+
+set_backend(available_backends()[0])
@@ -0,0 +1,65 @@
+'''
+Parsing of the ISO 8601 timestamps returned by the API. Timestamps come
+with or without a trailing Z, with up to 7 fractional digits or none at
+all, and sometimes with a UTC offset. They are parsed in a single pass
+to naive datetimes in UTC, as they are stored in the database.
+'''
+import datetime
+import re
+from functools import lru_cache
+
+# Many objects share timestamps, such as those of synchronization runs and license plans
+TIMESTAMP_CACHE_SIZE = 65536
+
+TIMESTAMP_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d*))?(Z|[+-]\d{2}:?\d{2})?$')
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(value):
+    '''
+    Parse a timestamp string to a naive datetime in UTC. Fractions are
+    truncated to microseconds. Raises ValueError for invalid timestamps.
+    '''
+    match = TIMESTAMP_RE.match(value)
+    if match is None:
+        raise ValueError('Invalid timestamp: %s' % value)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    result = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    if offset and offset != 'Z':
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        if offset[0] == '-':
+            minutes = -minutes
+        try:
+            result -= datetime.timedelta(minutes=minutes)
+        except OverflowError:
+            # In UTC the timestamp is before year 1 or after year 9999
+            raise ValueError('Timestamp out of range: %s' % value)
+    return result
+
+def parse_timestamps(values, errors='raise'):
+    '''
+    Parse a sequence of timestamps, such as a column of a batch of rows.
+    Each distinct timestamp is parsed once. None and datetimes are kept
+    as they are. With errors='coerce', invalid timestamps become None
+    instead of raising ValueError.
+    '''
+    parsed = {}
+    result = []
+    for value in values:
+        if not isinstance(value, str):
+            result.append(value)
+            continue
+        try:
+            result.append(parsed[value])
+            continue
+        except KeyError:
+            pass
+        try:
+            timestamp = parse_timestamp(value)
+        except ValueError:
+            if errors != 'coerce':
+                raise
+            timestamp = None
+        parsed[value] = timestamp
+        result.append(timestamp)
+    return result
@@ -0,0 +1,141 @@
+'''
+Archive of raw API responses collected during gather, which can be
+ingested again into a database without access to the API.
+
+The archive is a newline delimited JSON file, compressed with zstandard
+(.zst) or gzip (.gz) based on the file extension. The first record of
+each gather run holds the tenant, the base URL of the API and the options
+that determine the requested URLs, all other records hold a response
+together with the URL and the gather task that requested it.
+'''
+import asyncio
+import gzip
+import io
+import tempfile
+import threading
+from queue import Full, Queue
+
+from roadtools.roadlib import serializer
+try:
+    import zstandard
+    HAS_ZSTD_MODULE = True
+except ModuleNotFoundError:
+    HAS_ZSTD_MODULE = False
+
+def open_archive(path, mode):
+    '''
+    Open an archive for reading ('r') or appending ('a') as text file
+    '''
+    if path.endswith('.zst'):
+        if not HAS_ZSTD_MODULE:
+            raise Exception('The zstandard module is required for .zst archives, install it with pip install zstandard')
+        fh = open(path, mode + 'b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(fh, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+class ResponseArchive(object):
+    '''
+    Appends responses to an archive file. Serializing and compressing
+    happens in a separate thread, to keep it out of the event loop.
+    '''
+    def __init__(self, path, tenantid, selectprofile=None, pagesize=None, partitioned=False, membership='auto',
+                 baseurl=None):
+        self.outfile = open_archive(path, 'a')
+        self.queue = Queue(1000)
+        self.lock = asyncio.Lock()
+        self.records = 0
+        self.thread = threading.Thread(target=self.process, daemon=True)
+        self.thread.start()
+        self.queue.put({'tenant': tenantid, 'select': selectprofile, 'pagesize': pagesize, 'partitioned': partitioned,
+                        'membership': membership, 'baseurl': baseurl})
+
+    def process(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.outfile.write(serializer.dumps(record) + '\n')
+        self.outfile.close()
+
+    async def write(self, task, url, response):
+        '''
+        Queue a response to be archived. A response of None records a failed
+        request. When the queue is full, this waits until there is room again.
+        '''
+        self.records += 1
+        record = {'task': task, 'url': url, 'response': response}
+        async with self.lock:
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                await asyncio.get_running_loop().run_in_executor(None, self.queue.put, record)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class ArchiveReplay(object):
+    '''
+    Responses from an archive by URL, to replay a gather from. Only the
+    position of each response is kept in memory, responses are read from
+    disk when they are requested. Compressed archives are decompressed to
+    a temporary file first, since these can not be read at a position.
+    '''
+    def __init__(self, path):
+        self.tenantid = None
+        # Archives of older versions were gathered without these options
+        self.selectprofile = None
+        self.pagesize = None
+        self.partitioned = False
+        self.membership = 'auto'
+        # None for the default API
+        self.baseurl = None
+        self.offsets = {}
+        self.tasks = set()
+        if path.endswith(('.zst', '.gz')):
+            self.infile = tempfile.TemporaryFile()
+            with open_archive(path, 'r') as archive:
+                for line in archive:
+                    line = line.encode('utf-8')
+                    self.index(line, self.infile.tell())
+                    self.infile.write(line)
+        else:
+            self.infile = open(path, 'rb')
+            offset = 0
+            for line in self.infile:
+                self.index(line, offset)
+                offset += len(line)
+        self.replayed = 0
+
+    def index(self, line, offset):
+        record = serializer.loads(line)
+        if 'tenant' in record:
+            self.tenantid = record['tenant']
+            self.selectprofile = record.get('select')
+            self.pagesize = record.get('pagesize')
+            self.partitioned = record.get('partitioned', False)
+            self.membership = record.get('membership', 'auto')
+            self.baseurl = record.get('baseurl')
+            return
+        # Later responses for the same URL replace earlier ones, as for resumed gathers
+        self.offsets[record['url']] = offset
+        self.tasks.add(record['task'])
+
+    def get(self, url):
+        '''
+        The archived response for url, which is None for failed requests.
+        Raises KeyError if the archive has no response for url.
+        '''
+        self.infile.seek(self.offsets[url])
+        response = serializer.loads(self.infile.readline())['response']
+        self.replayed += 1
+        return response
+
+    def close(self):
+        self.infile.close()
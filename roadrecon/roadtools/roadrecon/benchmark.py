@@ -0,0 +1,626 @@
+'''
+Benchmark gather against a local stand-in for the Azure AD Graph API.
+
+The stand-in serves a synthetic tenant from memory the way graph.windows.net
+does: paged results with odata.nextLink, $links, $expand, $filter on role
+assignments, $batch and differential queries. Latency and throttling can be
+added to resemble a real tenant.
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import random
+import string
+import sys
+import time
+import uuid
+
+from aiohttp import web
+from roadtools.roadlib import serializer
+from roadtools.roadrecon import gather
+from roadtools.roadrecon.gather import getargs as getgatherargs
+try:
+    import resource
+    HAS_RESOURCE_MODULE = True
+except ModuleNotFoundError:
+    HAS_RESOURCE_MODULE = False
+
+TYPE_PREFIX = 'Microsoft.DirectoryServices.'
+
+COLLECTION_TYPES = {
+    'users': 'User',
+    'groups': 'Group',
+    'servicePrincipals': 'ServicePrincipal',
+    'applications': 'Application',
+    'devices': 'Device',
+    'contacts': 'Contact',
+    'directoryRoles': 'DirectoryRole',
+    'administrativeUnits': 'AdministrativeUnit',
+}
+
+COLLECTION_FOR_TYPE = {value: key for key, value in COLLECTION_TYPES.items()}
+
+# Properties that the directory only returns when a single object is requested
+SINGLE_OBJECT_PROPERTIES = ('strongAuthenticationDetail',)
+
+class SyntheticTenant(object):
+    '''
+    Randomly generated (but reproducible) tenant
+    '''
+    def __init__(self, users=1000, groups=100, nesting=2, serviceprincipals=50, devices=100, seed=1):
+        self.rng = random.Random(seed)
+        self.tenantid = self.guid()
+        self.collections = {}
+        # objectId -> (type, object)
+        self.index = {}
+        # (objectId, relationship) -> [objectIds]
+        self.links = {}
+        # (objectId, relationship) -> [objects]
+        self.linkedobjects = {}
+        # Changes for differential query: (version, collection, entry)
+        self.version = 0
+        self.changelog = []
+        self.generate(users, groups, nesting, serviceprincipals, devices)
+
+    def guid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def timestamp(self):
+        ts = datetime.datetime(2020, 1, 1) + datetime.timedelta(seconds=self.rng.randint(0, 10**8))
+        return ts.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def add(self, collection, objtype, obj):
+        obj['odata.type'] = TYPE_PREFIX + objtype
+        obj['objectType'] = objtype
+        self.collections.setdefault(collection, []).append(obj)
+        if 'objectId' in obj:
+            self.index[obj['objectId']] = (objtype, obj)
+        return obj
+
+    def link(self, parentid, relationship, childid):
+        self.links.setdefault((parentid, relationship), []).append(childid)
+        if relationship == 'members':
+            self.links.setdefault((childid, 'memberOf'), []).append(parentid)
+
+    def generate(self, nusers, ngroups, nesting, nsps, ndevices):
+        rng = self.rng
+        for i in range(nusers):
+            self.add('users', 'User', {
+                'objectId': self.guid(),
+                'displayName': 'User %d' % i,
+                'userPrincipalName': '%s.user%d@contoso.com' % (string.ascii_lowercase[i % 26], i),
+                'accountEnabled': rng.random() > 0.1,
+                'userType': 'Member',
+                'lastDirSyncTime': self.timestamp() if rng.random() > 0.5 else None,
+                'refreshTokensValidFromDateTime': self.timestamp(),
+                'assignedPlans': [{'assignedTimestamp': self.timestamp(), 'capabilityStatus': 'Enabled', 'service': 'exchange', 'servicePlanId': self.guid()} for _ in range(10)],
+                'provisionedPlans': [{'capabilityStatus': 'Enabled', 'provisioningStatus': 'Success', 'service': 'exchange'} for _ in range(10)],
+                'strongAuthenticationDetail': {'methods': [], 'requirements': []},
+                'searchableDeviceKey': [],
+            })
+        users = [u['objectId'] for u in self.collections['users']]
+        for i in range(nsps):
+            self.add('servicePrincipals', 'ServicePrincipal', {
+                'objectId': self.guid(),
+                'appId': self.guid(),
+                'displayName': 'App %d' % i,
+                'servicePrincipalType': 'Application',
+                'accountEnabled': True,
+                'appRoles': [{'id': self.guid(), 'value': 'Role.%d' % j, 'displayName': 'Role %d' % j} for j in range(rng.randint(0, 3))],
+                'oauth2Permissions': [],
+                'keyCredentials': [],
+                'passwordCredentials': [],
+                'replyUrls': [],
+            })
+        sps = self.collections['servicePrincipals']
+        for i, sp in enumerate(sps):
+            if i % 2 == 0:
+                app = self.add('applications', 'Application', {
+                    'objectId': self.guid(),
+                    'appId': sp['appId'],
+                    'displayName': sp['displayName'],
+                    'keyCredentials': [],
+                    'passwordCredentials': [],
+                    'appRoles': sp['appRoles'],
+                })
+                if users:
+                    self.link(app['objectId'], 'owners', rng.choice(users))
+            else:
+                self.collections.setdefault('applicationRefs', []).append({
+                    'appId': sp['appId'],
+                    'displayName': sp['displayName'],
+                    'odata.type': TYPE_PREFIX + 'ApplicationRef',
+                })
+            if users and rng.random() > 0.5:
+                self.link(sp['objectId'], 'owners', rng.choice(users))
+        for i in range(ndevices):
+            device = self.add('devices', 'Device', {
+                'objectId': self.guid(),
+                'deviceId': self.guid(),
+                'displayName': 'DEVICE%d' % i,
+                'accountEnabled': True,
+                'deviceOSType': 'Windows',
+                'approximateLastLogonTimestamp': self.timestamp(),
+            })
+            if users:
+                self.link(device['objectId'], 'registeredOwners', rng.choice(users))
+        devices = [d['objectId'] for d in self.collections.get('devices', [])]
+        self.add('contacts', 'Contact', {'objectId': self.guid(), 'displayName': 'Contact', 'mail': 'contact@fabrikam.com'})
+        # Groups, of which the first ones are nested into the next levels
+        groups = []
+        for i in range(ngroups):
+            group = self.add('groups', 'Group', {
+                'objectId': self.guid(),
+                'displayName': 'Group %d' % i,
+                'securityEnabled': True,
+                'createdDateTime': self.timestamp(),
+                # Groups that are not used for nesting are Microsoft 365 groups
+                'groupTypes': ['Unified'] if i > nesting and i % (nesting + 1) == 0 else [],
+            })
+            groups.append(group['objectId'])
+            # Most groups are small, a few are large
+            size = int(rng.paretovariate(1.2) * 3) if users else 0
+            for member in rng.sample(users, min(size, len(users))):
+                self.link(group['objectId'], 'members', member)
+            if devices and rng.random() > 0.8:
+                self.link(group['objectId'], 'members', rng.choice(devices))
+            if sps and rng.random() > 0.9:
+                self.link(group['objectId'], 'members', rng.choice(sps)['objectId'])
+            if users and rng.random() > 0.7:
+                self.link(group['objectId'], 'owners', rng.choice(users))
+        for level in range(1, nesting + 1):
+            # Nest a fraction of the groups in groups of the previous level
+            for groupid in groups[level::nesting + 1]:
+                self.link(groups[(level - 1)::nesting + 1][0], 'members', groupid)
+        for i in range(2):
+            au = self.add('administrativeUnits', 'AdministrativeUnit', {'objectId': self.guid(), 'displayName': 'AU %d' % i})
+            for member in rng.sample(users, min(5, len(users))):
+                self.link(au['objectId'], 'members', member)
+        for name, templateid in (('Global Administrator', '62e90394-69f5-4237-9190-012177145e10'),
+                                 ('Application Administrator', '9b895d92-2cd3-44c7-9d02-a6ac2d5ea5c3')):
+            role = self.add('directoryRoles', 'DirectoryRole', {'objectId': self.guid(), 'displayName': name, 'roleTemplateId': templateid})
+            roledef = self.add('roleDefinitions', 'RoleDefinition', {'objectId': templateid, 'displayName': name, 'isBuiltIn': True, 'templateId': templateid})
+            for member in rng.sample(users, min(2, len(users))):
+                self.link(role['objectId'], 'members', member)
+                self.collections.setdefault('roleAssignments', []).append({
+                    'id': self.guid(), 'principalId': member, 'resourceScopes': ['/'], 'roleDefinitionId': roledef['objectId'],
+                })
+        # App role assignments, available from both the resource and principal side
+        for sp in sps:
+            if not sp['appRoles']:
+                continue
+            principals = [(principal, 'User') for principal in rng.sample(users, min(3, len(users)))]
+            # Some applications are assigned roles of other applications
+            if rng.random() > 0.5:
+                principals.append((rng.choice(sps)['objectId'], 'ServicePrincipal'))
+            for principal, principaltype in principals:
+                assignment = {
+                    'objectId': self.guid(),
+                    'objectType': 'AppRoleAssignment',
+                    'id': sp['appRoles'][0]['id'],
+                    'principalId': principal,
+                    'principalType': principaltype,
+                    'resourceId': sp['objectId'],
+                    'resourceDisplayName': sp['displayName'],
+                    'creationTimestamp': self.timestamp(),
+                }
+                self.linkedobjects.setdefault((sp['objectId'], 'appRoleAssignedTo'), []).append(assignment)
+                if principaltype == 'ServicePrincipal':
+                    self.linkedobjects.setdefault((principal, 'appRoleAssignments'), []).append(assignment)
+        for sp in sps:
+            if users and rng.random() > 0.5:
+                self.add('oauth2PermissionGrants', 'OAuth2PermissionGrant', {
+                    'objectId': self.guid(), 'clientId': sp['objectId'], 'consentType': 'AllPrincipals',
+                    'resourceId': rng.choice(sps)['objectId'], 'scope': 'User.Read', 'expiryTime': self.timestamp(),
+                })
+        self.add('tenantDetails', 'TenantDetail', {'objectId': self.tenantid, 'displayName': 'Contoso'})
+        self.collections.setdefault('policies', [])
+        self.collections['authorizationPolicy'] = [{'id': 'authorizationPolicy', 'displayName': 'Authorization Policy'}]
+        self.collections.setdefault('settings', [])
+        self.collections.setdefault('eligibleRoleAssignments', [])
+
+    def change(self, collection, entry):
+        self.version += 1
+        self.changelog.append((self.version, collection, entry))
+
+    def update(self, objectid, **props):
+        objtype, obj = self.index[objectid]
+        obj.update(props)
+        self.change(COLLECTION_FOR_TYPE[objtype], obj)
+
+    def delete(self, objectid):
+        objtype, obj = self.index.pop(objectid)
+        collection = COLLECTION_FOR_TYPE[objtype]
+        self.collections[collection].remove(obj)
+        for key in list(self.links):
+            if objectid in self.links[key]:
+                self.links[key].remove(objectid)
+        for key in list(self.linkedobjects):
+            self.linkedobjects[key] = [o for o in self.linkedobjects[key] if objectid not in (o['principalId'], o['resourceId'])]
+        self.change(collection, {'odata.type': obj['odata.type'], 'objectId': objectid, 'aad.isDeleted': True})
+
+    def addmember(self, groupid, memberid, remove=False):
+        if remove:
+            self.links[(groupid, 'members')].remove(memberid)
+        else:
+            self.link(groupid, 'members', memberid)
+        self.change('groups', {'odata.type': TYPE_PREFIX + 'DirectoryLinkChange', 'sourceObjectId': groupid,
+                               'targetObjectId': memberid, 'associationType': 'Member', 'aad.isDeleted': remove})
+
+
+class MockDirectoryServer(object):
+    '''
+    aiohttp application that serves a SyntheticTenant the way graph.windows.net does
+    '''
+    def __init__(self, tenant, latency=0.0, throttle_rate=0.0, error_rate=0.0, pagesize=100, seed=1):
+        self.tenant = tenant
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.pagesize = pagesize
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        # Path -> statuses to answer the next batched requests for it with, None leaves the part out
+        self.part_faults = {}
+        # Set once the server listens, absolute links in responses start with it
+        self.baseurl = None
+        self.app = web.Application()
+        self.app.router.add_post('/{tenant}/$batch', self.handle_batch)
+        self.app.router.add_get('/{tenant}/{path:.*}', self.handle_get)
+
+    def injected_error(self):
+        '''
+        Throttling or server error response to send instead of the real response, if any
+        '''
+        if self.throttle_rate and self.rng.random() < self.throttle_rate:
+            self.throttled += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503)
+        return None
+
+    async def handle_get(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = self.injected_error()
+        if error is not None:
+            return error
+        path = request.match_info['path']
+        if path.endswith('/$count'):
+            items = self.tenant.collections.get(path.split('/')[0], [])
+            return web.Response(text=str(len(items)), content_type='text/plain')
+        status, body = self.get(path, request.query)
+        return web.Response(status=status, text=json.dumps(body), content_type='application/json')
+
+    async def handle_batch(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        error = self.injected_error()
+        if error is not None:
+            return error
+        body = await request.text()
+        boundary = request.headers['Content-Type'].split('boundary=')[1]
+        parts = []
+        respboundary = 'batchresponse_%s' % uuid.uuid4()
+        for part in body.split('--' + boundary)[1:]:
+            if part.startswith('--'):
+                break
+            line = [line for line in part.split('\r\n') if line.startswith('GET ')][0]
+            url = line.split(' ')[1]
+            path = url.split('?')[0].split('/', 4)[4]
+            query = {}
+            if '?' in url:
+                for param in url.split('?', 1)[1].split('&'):
+                    key, _, value = param.partition('=')
+                    query[key] = value
+            faults = self.part_faults.get(path)
+            if faults:
+                status = faults.pop(0)
+                if status is None:
+                    continue
+                result = {'odata.error': {'code': 'Injected'}}
+            else:
+                status, result = self.get(path, query)
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n'
+                         'HTTP/1.1 %d OK\r\nContent-Type: application/json\r\n\r\n%s\r\n' % (respboundary, status, json.dumps(result)))
+        parts.append('--%s--\r\n' % respboundary)
+        return web.Response(text=''.join(parts), headers={'Content-Type': 'multipart/mixed; boundary=%s' % respboundary})
+
+    def page(self, items, query, nextpath):
+        try:
+            pagesize = min(int(query['$top']), 999)
+        except (KeyError, ValueError):
+            pagesize = self.pagesize
+        try:
+            offset = int(query['$skiptoken'])
+        except (KeyError, ValueError):
+            offset = 0
+        result = {'value': [self.select(item, query, single=False) for item in items[offset:offset + pagesize]]}
+        if offset + pagesize < len(items):
+            params = ['$skiptoken=%d' % (offset + pagesize)]
+            for key in ('$top', '$expand', '$filter', '$select'):
+                if key in query:
+                    params.append('%s=%s' % (key, query[key]))
+            result['odata.nextLink'] = '%s?%s' % (nextpath, '&'.join(params))
+        return 200, result
+
+    def filter(self, items, expression):
+        '''
+        Only startswith(property,'x') and roleDefinitionId eq 'x' are supported
+        '''
+        value = expression.split("'", 1)[1][:-1]
+        if expression.startswith('startswith('):
+            prop = expression[len('startswith('):].split(',')[0]
+            value = value[:-1].replace("''", "'").lower()
+            return [item for item in items if (item.get(prop) or '').lower().startswith(value)]
+        return [item for item in items if item.get('roleDefinitionId') == value]
+
+    def select(self, obj, query, single=True):
+        '''
+        Only the requested properties of an object, properties without a value are left out
+        '''
+        if '$select' not in query:
+            if single:
+                return obj
+            return {key: value for key, value in obj.items() if key not in SINGLE_OBJECT_PROPERTIES}
+        selected = {key: obj[key] for key in query['$select'].split(',') if key in obj}
+        if 'odata.type' in obj:
+            selected['odata.type'] = obj['odata.type']
+        return selected
+
+    def delta(self, collection, query):
+        tenant = self.tenant
+        deltalink = '%s/%s/%s?deltaLink=%d' % (self.baseurl, tenant.tenantid, collection, tenant.version)
+        if query['deltaLink'] and query['deltaLink'] != 'initial':
+            since = int(query['deltaLink'])
+            items = [self.select(entry, query, single=False) for version, changed, entry in tenant.changelog
+                     if version > since and changed == collection]
+            return 200, {'value': items, 'aad.deltaLink': deltalink}
+        items = tenant.collections[collection]
+        status, result = self.page(items, query, collection)
+        if 'odata.nextLink' in result:
+            result['aad.nextLink'] = '%s/%s/%s&deltaLink=initial' % (self.baseurl, tenant.tenantid, result.pop('odata.nextLink'))
+        else:
+            result['aad.deltaLink'] = deltalink
+        return status, result
+
+    def objecturl(self, objectid):
+        return '%s/%s/directoryObjects/%s/%s%s' % (self.baseurl, self.tenant.tenantid, objectid, TYPE_PREFIX, self.tenant.index[objectid][0])
+
+    def get(self, path, query):
+        tenant = self.tenant
+        parts = path.split('/')
+        if parts[0] == 'directoryObjects':
+            # Format used in nextLinks: directoryObjects/<id>/<type cast>/<relationship>
+            objectid = parts[1]
+            parts = [parts[2][len(TYPE_PREFIX):].lower() + 's', objectid] + parts[3:]
+            for collection, objtype in COLLECTION_TYPES.items():
+                if tenant.index.get(objectid, (None,))[0] == objtype:
+                    parts[0] = collection
+        collection = parts[0]
+        if len(parts) == 1:
+            items = tenant.collections.get(collection)
+            if items is None:
+                return 404, {'odata.error': {'code': 'Request_ResourceNotFound'}}
+            if 'deltaLink' in query:
+                return self.delta(collection, query)
+            if '$filter' in query:
+                items = self.filter(items, query['$filter'])
+            if '$expand' in query:
+                prop = query['$expand']
+                expanded = []
+                for item in items:
+                    item = dict(item)
+                    item[prop] = [dict(tenant.index[childid][1]) for childid in tenant.links.get((item['objectId'], prop), [])][:20]
+                    expanded.append(item)
+                items = expanded
+            return self.page(items, query, collection)
+        objectid = parts[1]
+        if collection == 'applicationRefs':
+            for ref in tenant.collections.get('applicationRefs', []):
+                if ref['appId'] == objectid:
+                    return 200, ref
+            return 404, {'odata.error': {'code': 'Request_ResourceNotFound'}}
+        if objectid not in tenant.index:
+            return 404, {'odata.error': {'code': 'Request_ResourceNotFound'}}
+        objtype = tenant.index[objectid][0]
+        nextpath = 'directoryObjects/%s/%s%s/%s' % (objectid, TYPE_PREFIX, objtype, '/'.join(parts[2:]))
+        if len(parts) == 2:
+            return 200, self.select(tenant.index[objectid][1], query)
+        if parts[2] == '$links':
+            links = [{'url': self.objecturl(childid)} for childid in tenant.links.get((objectid, parts[3]), [])]
+            return self.page(links, query, nextpath)
+        return self.page(tenant.linkedobjects.get((objectid, parts[2]), []), query, nextpath)
+
+    async def start(self, host='127.0.0.1', port=0):
+        '''
+        Listen on the given port (or a free one), returns the runner to clean up with
+        '''
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        self.baseurl = 'http://%s:%d' % (host, port)
+        return runner
+
+def serve(args, conn):
+    '''
+    Serve a synthetic tenant until the benchmark asks for the statistics.
+    Runs in a separate process, to keep it out of the measurements.
+    '''
+    tenant = SyntheticTenant(users=args.users, groups=args.groups, nesting=args.nesting,
+                             serviceprincipals=args.service_principals, devices=args.devices, seed=args.seed)
+    server = MockDirectoryServer(tenant, latency=args.latency / 1000.0, throttle_rate=args.throttle_rate,
+                                 error_rate=args.error_rate, pagesize=args.server_page_size, seed=args.seed)
+    loop = asyncio.new_event_loop()
+    runner = loop.run_until_complete(server.start(port=args.port))
+    conn.send((server.baseurl, tenant.tenantid))
+    loop.run_until_complete(loop.run_in_executor(None, conn.recv))
+    conn.send((server.requests, server.throttled, server.errors))
+    loop.run_until_complete(runner.cleanup())
+
+def peak_rss():
+    '''
+    Peak resident set size of this process in MB, or None if not available
+    '''
+    if not HAS_RESOURCE_MODULE:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+def best_time(func, rounds):
+    '''
+    Fastest of rounds calls of func, in milliseconds
+    '''
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000.0
+
+def serializer_benchmark(args):
+    '''
+    Time the JSON backends on a page of synthetic users: decoding the response,
+    and encoding and decoding the JSON columns of its rows in the database
+    '''
+    tenant = SyntheticTenant(users=min(args.users, gather.MAX_PAGE_SIZE), groups=1, serviceprincipals=1, devices=1, seed=args.seed)
+    users = tenant.collections['users']
+    page = json.dumps({'odata.metadata': 'https://graph.windows.net/%s/$metadata#directoryObjects' % tenant.tenantid, 'value': users})
+    columns = [value for user in users for value in user.values() if isinstance(value, (list, dict))]
+    stored = [json.dumps(value) for value in columns]
+    print('Page of {0} users, {1:0.1f} MB, with {2} JSON column values'.format(len(users), len(page) / 1048576.0, len(columns)))
+    previous = serializer.BACKEND
+    try:
+        for backend in serializer.available_backends():
+            serializer.set_backend(backend)
+            decode = best_time(lambda: serializer.loads(page), args.serializer_rounds)
+            bind = best_time(lambda: [serializer.dumps(value) for value in columns], args.serializer_rounds)
+            result = best_time(lambda: [serializer.loads(value) for value in stored], args.serializer_rounds)
+            print('{0:<8} decode page {1:8.2f} ms, encode columns {2:8.2f} ms, decode columns {3:8.2f} ms'.format(backend, decode, bind, result))
+    finally:
+        serializer.set_backend(previous)
+    if not serializer.HAS_ORJSON_MODULE:
+        print('Install orjson with pip install orjson to use the faster backend')
+
+def getargs(benchmark_parser):
+    getgatherargs(benchmark_parser)
+    benchmark_parser.set_defaults(database='benchmark.db')
+    benchmark_parser.add_argument('--users',
+                                  type=int,
+                                  action='store',
+                                  help='Number of users in the synthetic tenant (default: 10000)',
+                                  default=10000)
+    benchmark_parser.add_argument('--groups',
+                                  type=int,
+                                  action='store',
+                                  help='Number of groups in the synthetic tenant (default: 1000)',
+                                  default=1000)
+    benchmark_parser.add_argument('--nesting',
+                                  type=int,
+                                  action='store',
+                                  help='Depth of group nesting (default: 2)',
+                                  default=2)
+    benchmark_parser.add_argument('--service-principals',
+                                  type=int,
+                                  action='store',
+                                  help='Number of service principals (default: 500)',
+                                  default=500)
+    benchmark_parser.add_argument('--devices',
+                                  type=int,
+                                  action='store',
+                                  help='Number of devices (default: 1000)',
+                                  default=1000)
+    benchmark_parser.add_argument('--seed',
+                                  type=int,
+                                  action='store',
+                                  help='Seed for generating the tenant, the same seed gives the same tenant (default: 1)',
+                                  default=1)
+    benchmark_parser.add_argument('--latency',
+                                  type=float,
+                                  action='store',
+                                  help='Latency in milliseconds added to every response (default: 0)',
+                                  default=0.0)
+    benchmark_parser.add_argument('--throttle-rate',
+                                  type=float,
+                                  action='store',
+                                  help='Fraction of requests answered with HTTP 429 (default: 0)',
+                                  default=0.0)
+    benchmark_parser.add_argument('--error-rate',
+                                  type=float,
+                                  action='store',
+                                  help='Fraction of requests answered with HTTP 503 (default: 0)',
+                                  default=0.0)
+    benchmark_parser.add_argument('--server-page-size',
+                                  type=int,
+                                  action='store',
+                                  help='Number of objects per page of the mock API if the request does not specify $top (default: 100)',
+                                  default=100)
+    benchmark_parser.add_argument('--serializer',
+                                  action='store_true',
+                                  help='Only time the JSON backends on a page of synthetic users instead of gathering')
+    benchmark_parser.add_argument('--serializer-rounds',
+                                  type=int,
+                                  action='store',
+                                  help='Number of times to repeat each measurement of --serializer, the fastest counts (default: 20)',
+                                  default=20)
+    benchmark_parser.add_argument('--port',
+                                  type=int,
+                                  action='store',
+                                  help='Port for the mock API to listen on (default: any free port)',
+                                  default=0)
+
+def main(args=None):
+    if args is None:
+        parser = argparse.ArgumentParser(add_help=True, description='ROADrecon - Benchmark gather against a mock API', formatter_class=argparse.RawDescriptionHelpFormatter)
+        getargs(parser)
+        args = parser.parse_args()
+    if args.serializer:
+        serializer_benchmark(args)
+        return
+    if not gather.check_args(args):
+        return
+    print('Generating synthetic tenant with {0} users, {1} groups, {2} service principals and {3} devices'.format(args.users, args.groups, args.service_principals, args.devices))
+    conn, childconn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(args, childconn), daemon=True)
+    server.start()
+    try:
+        baseurl, tenantid = conn.recv()
+        print('Mock API listening on {0}'.format(baseurl))
+        token = {
+            'tokenType': 'Bearer',
+            'accessToken': 'benchmark',
+            'expiresOn': '2099-01-01 00:00:00.000000',
+            'tenantId': tenantid
+        }
+        if args.plan:
+            gather.run_plan(args, token, baseurl=baseurl)
+            elapsed = None
+        else:
+            elapsed = gather.run_gather(args, token, baseurl=baseurl)
+        conn.send('stats')
+        requests, throttled, errors = conn.recv()
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+    if elapsed is None:
+        return
+    print('Mock API served {0} requests ({1:0.1f} requests/sec), of which {2} were throttled and {3} failed'.format(requests, requests / elapsed, throttled, errors))
+    rss = peak_rss()
+    if rss is not None:
+        print('Peak memory usage of gather: {0:0.1f} MB'.format(rss))
+
+if __name__ == "__main__":
+    main()
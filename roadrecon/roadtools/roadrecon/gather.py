@@ -1,50 +1,146 @@
 import argparse
 import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import fnmatch
 import json
+import math
 import os
+import random
 import sys
+import threading
 import time
 import traceback
+import uuid
 import warnings
+from queue import Full, Queue
+from urllib.parse import quote
 
 import aiohttp
 import requests
 import roadtools.roadlib.metadef.database as database
 #from roadlib.metadef.database import Domain
+from roadtools.roadlib import serializer
 from roadtools.roadlib.auth import Authentication
+from roadtools.roadrecon.archive import ArchiveReplay, ResponseArchive
 from roadtools.roadlib.metadef.database import (
     AdministrativeUnit, Application, ApplicationRef, AppRoleAssignment,
     AuthorizationPolicy, Contact, Device, DirectoryRole, DirectorySetting,
-    EligibleRoleAssignment, ExtensionProperty, Group, OAuth2PermissionGrant,
+    EligibleRoleAssignment, ExtensionProperty, GatherCheckpoint, Group,
+    OAuth2PermissionGrant,
     Policy, RoleAssignment, RoleDefinition, ServicePrincipal, TenantDetail,
-    User, lnk_au_member_device, lnk_au_member_group, lnk_au_member_user,
-    lnk_device_owner, lnk_group_member_contact, lnk_group_member_device,
-    lnk_group_member_group, lnk_group_member_serviceprincipal,
-    lnk_group_member_user, lnk_group_owner_serviceprincipal,
-    lnk_group_owner_user)
-from sqlalchemy import bindparam, func
+    User)
+from sqlalchemy import bindparam, func, inspect, select
 from sqlalchemy.dialects.postgresql import insert as pginsert
+from sqlalchemy.dialects.sqlite import insert as sqliteinsert
 from sqlalchemy.orm import sessionmaker
 
 warnings.simplefilter('ignore')
-token = None
-expiretime = None
-headers = {}
-dburl = ''
-urlcounter = 0
-groupcounter = 0
-totalgroups = 0
-devicecounter = 0
-totaldevices = 0
-
-tokencounter = 0
-tokenfilltime = time.time()
 
+# Name of the gather task that makes a request
+current_task = contextvars.ContextVar('current_task', default=None)
+
+# Base URL of the Azure AD Graph API
+GRAPH_URL = 'https://graph.windows.net'
 MAX_GROUPS = 3000
+# Number of parent objects that are processed concurrently per task
+MAX_WORKERS = 100
+# Tables of which the objects are indexed to validate links
+INDEXED_TABLES = {dbtype.__tablename__: dbtype for dbtype in (User, Group, Contact, Device, ServicePrincipal,
+                                                              Application, DirectoryRole, AdministrativeUnit)}
+# Number of parent objects read from the database at once
+PARENT_CHUNK_SIZE = 1000
+# Ceiling and starting point for the request rate of each endpoint family
 MAX_REQ_PER_SEC = 600.0
+INITIAL_REQ_PER_SEC = 150.0
+# Connection pool settings
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 0
+KEEPALIVE_TIMEOUT = 15.0
+DNS_CACHE_TTL = 300
+# Number of times a request is retried after a connection error or server error
+RETRY_ATTEMPTS = 5
+# Back-off before the first retry, which doubles for each attempt up to the maximum
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Errors after which a request is retried
+TRANSIENT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+# Seconds before expiry at which the token is refreshed in the background
+TOKEN_REFRESH_MARGIN = 600
+# Seconds to wait before trying again after a failed token refresh
+TOKEN_RETRY_INTERVAL = 30
+# Maximum number of operations the directory accepts in one $batch request
+MAX_BATCH_SIZE = 5
+# Number of pending writes before gathering waits on the database writer
+WRITE_QUEUE_SIZE = 100
+# Profiles for the properties requested with $select, from least to most
+SELECT_PROFILES = ('minimal', 'standard', 'full')
+SELECT_PROFILE = 'full'
+# Collections that can hold many objects, which are requested with $select and the maximum page size
+LARGE_COLLECTIONS = ('users', 'groups', 'servicePrincipals', 'applications', 'devices', 'contacts')
+# Largest page size the directory accepts with $top
+MAX_PAGE_SIZE = 999
+# Collections that can be split in partitions by the first character of a property,
+# to enumerate them over concurrent cursors. The characters cover all values the property allows.
+PARTITIONS = {
+    'users': ('userPrincipalName', "abcdefghijklmnopqrstuvwxyz0123456789'-_!#^~"),
+}
+# Properties that are gathered separately instead of with the objects
+SEPARATE_COLUMNS = ('strongAuthenticationDetail',)
+# Properties requested with the minimal profile, which are those used by the GUI and plugins
+MINIMAL_COLUMNS = {
+    'Users': ('objectType', 'objectId', 'displayName', 'userPrincipalName', 'mail', 'accountEnabled', 'userType',
+              'department', 'jobTitle', 'mobile', 'createdDateTime', 'dirSyncEnabled', 'lastDirSyncTime',
+              'lastPasswordChangeDateTime', 'immutableId', 'onPremisesSecurityIdentifier',
+              'onPremisesDistinguishedName', 'cloudSecurityIdentifier', 'searchableDeviceKey'),
+    'Groups': ('objectType', 'objectId', 'displayName', 'description', 'createdDateTime', 'createdByAppId', 'mail',
+               'groupTypes', 'securityEnabled', 'isPublic', 'visibility', 'isAssignableToRole', 'membershipRule',
+               'dirSyncEnabled', 'lastDirSyncTime', 'onPremisesSecurityIdentifier', 'cloudSecurityIdentifier'),
+    'Devices': ('objectType', 'objectId', 'displayName', 'accountEnabled', 'deviceId', 'deviceManufacturer',
+                'deviceModel', 'deviceOSType', 'deviceOSVersion', 'deviceTrustType', 'isCompliant', 'isManaged',
+                'isRooted', 'approximateLastLogonTimestamp', 'dirSyncEnabled', 'lastDirSyncTime',
+                'onPremisesSecurityIdentifier'),
+    'ServicePrincipals': ('objectType', 'objectId', 'displayName', 'appDisplayName', 'appId', 'appOwnerTenantId',
+                          'publisherName', 'servicePrincipalType', 'accountEnabled', 'microsoftFirstParty',
+                          'appRoleAssignmentRequired', 'appRoles', 'oauth2Permissions', 'replyUrls',
+                          'passwordCredentials', 'keyCredentials'),
+    'Applications': ('objectType', 'objectId', 'displayName', 'appId', 'availableToOtherTenants', 'publisherDomain',
+                     'publicClient', 'oauth2AllowIdTokenImplicitFlow', 'oauth2AllowImplicitFlow', 'homepage',
+                     'replyUrls', 'appRoles', 'oauth2Permissions', 'requiredResourceAccess',
+                     'passwordCredentials', 'keyCredentials'),
+    'Contacts': ('objectType', 'objectId', 'displayName', 'mail', 'dirSyncEnabled', 'lastDirSyncTime'),
+}
+
+# Page size of the directory for requests without $top
+DEFAULT_PAGE_SIZE = 100
+# Number of objects the directory returns at most for an expanded property
+EXPAND_LIMIT = 20
+# Collections of which the objects can be a member of groups
+MEMBER_COLLECTIONS = {'users': User, 'devices': Device, 'contacts': Contact, 'servicePrincipals': ServicePrincipal, 'groups': Group}
+# Objects returned by memberOf, role and administrative unit memberships are collected by other tasks
+MEMBEROF_MAPPING = {
+    'Microsoft.DirectoryServices.Group': (Group, 'memberOf'),
+    'Microsoft.DirectoryServices.DirectoryRole': None,
+    'Microsoft.DirectoryServices.AdministrativeUnit': None,
+}
+
+# Collections of which gather --plan counts the objects
+PLAN_COLLECTIONS = {
+    'users': User, 'groups': Group, 'servicePrincipals': ServicePrincipal, 'applications': Application,
+    'devices': Device, 'contacts': Contact, 'administrativeUnits': AdministrativeUnit, 'directoryRoles': DirectoryRole,
+    'roleDefinitions': RoleDefinition, 'oauth2PermissionGrants': OAuth2PermissionGrant,
+}
+# Rough number of bytes a row takes in the database, for the database size of gather --plan
+PLAN_ROW_SIZE = {
+    'Users': 2500, 'Groups': 800, 'ServicePrincipals': 3000, 'Applications': 2500, 'Devices': 900, 'Contacts': 600,
+    'lnk': 100, None: 500,
+}
+# Members per group assumed by gather --plan without a previous gather of the tenant
+PLAN_MEMBERS_PER_GROUP = 10
 
 def mknext(url, prevurl):
-    if url.startswith('https://'):
+    if url.startswith(('https://', 'http://')):
         # Absolute URL
         return url + '&api-version=1.61-internal'
     parts = prevurl.split('/')
@@ -52,123 +148,678 @@ def mknext(url, prevurl):
         return '/'.join(parts[:4]) + '/' + url + '&api-version=1.61-internal'
     return '/'.join(parts[:-1]) + '/' + url + '&api-version=1.61-internal'
 
-async def dumphelper(url, method=requests.get):
-    global urlcounter, tokencounter
-    nexturl = url
-    while nexturl:
-        checktoken()
-        await ratelimit()
+def select_columns(dbtype, profile):
+    '''
+    Properties to request for the objects of a table, derived from the
+    columns of its model. Returns None to request all properties,
+    which the full profile does without $select.
+    '''
+    if profile is None or profile == 'full':
+        return None
+    table = dbtype.__tablename__
+    if profile == 'minimal' and table in MINIMAL_COLUMNS:
+        return list(MINIMAL_COLUMNS[table])
+    # Large properties that are not analysed are in the 'heavy' group of deferred columns
+    skip = set(SEPARATE_COLUMNS) | set(prop.key for prop in dbtype.__mapper__.column_attrs if prop.group == 'heavy')
+    return [column.name for column in dbtype.__table__.columns if column.name not in skip]
+
+def partition_filter(prop, prefix):
+    '''
+    $filter for the objects of which prop starts with prefix, quoted for use in a URL
+    '''
+    return quote("startswith(%s,'%s')" % (prop, prefix.replace("'", "''")), safe="(),'")
+
+class RequestFailed(Exception):
+    '''
+    A request that still failed after all retries
+    '''
+    def __init__(self, url, error):
+        super().__init__('Request failed (%s): %s' % (error, url))
+        self.url = url
+        self.error = error
+
+def retry_delay(attempt):
+    '''
+    Exponential back-off with jitter, so retries of concurrent requests spread out
+    '''
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+async def request_json(ctx, url, method):
+    '''
+    Do a request and decode the response, waiting when throttled and retrying
+    connection errors and server errors with exponential back-off.
+    Returns the status and the decoded response (None unless the status is 200),
+    raises RequestFailed if all attempts failed.
+    '''
+    attempt = 0
+    while True:
+        if not await ctx.tokens.check():
+            # Failing the request keeps the objects it belongs to from being marked as completed
+            raise RequestFailed(url, 'access token expired')
+        token = ctx.tokens.token
+        await ratelimit(ctx, url)
+        ctx.urlcounter += 1
         try:
-            urlcounter += 1
-            async with method(nexturl, headers=headers) as req:
+            async with method(url, headers=ctx.headers, proxy=ctx.proxy) as res:
                 # Hold off when rate limit is reached
-                if req.status == 429:
-                    if tokencounter > 0:
-                        tokencounter -= 10*MAX_REQ_PER_SEC
-                        print('Sleeping because of rate-limit hit')
+                if res.status == 429:
+                    ctx.ratelimiter.throttled(url, res.headers.get('Retry-After'))
                     continue
-                if req.status != 200:
-                    # Ignore default users role not being found
-                    if req.status == 404 and 'a0b1b346-4d3e-4e8b-98f8-753987be4970' in url:
-                        return
-                    print('Error %d for URL %s' % (req.status, nexturl))
-                    # print(await req.text())
-                    # print(req.headers)
-                    print('')
-                try:
-                    objects = await req.json()
-                except json.decoder.JSONDecodeError:
-                    # In case we break Azure
-                    print(url)
-                    print(req.content)
-                    print('')
+                ctx.ratelimiter.success(url)
+                if res.status == 401:
+                    # Token was rejected, refresh it before the next attempt
+                    ctx.tokens.expire(token)
+                elif res.status < 500:
+                    if attempt > 0:
+                        ctx.recovered += 1
+                    if res.status != 200:
+                        return res.status, None
+                    try:
+                        return res.status, await res.json(loads=serializer.loads)
+                    except (json.decoder.JSONDecodeError, aiohttp.ContentTypeError):
+                        # In case we break Azure
+                        print('Invalid JSON for URL %s' % url)
+                        return res.status, None
+                error = 'HTTP status %d' % res.status
+        except TRANSIENT_ERRORS as exc:
+            error = str(exc) or exc.__class__.__name__
+        attempt += 1
+        if attempt > ctx.retries:
+            print('Giving up after %d attempts (%s): %s' % (attempt, error, url))
+            raise RequestFailed(url, error)
+        await asyncio.sleep(retry_delay(attempt))
+
+async def dumppages(ctx, url, method=requests.get, delta=None):
+    '''
+    Async generator that yields the objects of each page of a collection,
+    together with the URL of the next page (None for the last page).
+    For differential queries, pass a dict as delta to receive the deltaLink
+    '''
+    nexturl = url
+    while nexturl:
+        if ctx.replay is not None:
+            objects = replay_response(ctx, nexturl)
+            if objects is None:
+                return
+        else:
+            status, objects = await request_json(ctx, nexturl, method)
+            if ctx.archive is not None and status != 200:
+                # Archived without response, so replaying it gives the same result
+                await ctx.archive.write(current_task.get(), nexturl, None)
+            if status != 200:
+                # Ignore default users role not being found
+                if status == 404 and 'a0b1b346-4d3e-4e8b-98f8-753987be4970' in url:
                     return
-                try:
-                    nexturl = mknext(objects['odata.nextLink'], url)
-                except KeyError:
-                    nexturl = None
-                try:
-                    for robject in objects['value']:
-                        yield robject
-                except KeyError:
-                    # print(objects)
-                    pass
-        except Exception as exc:
-            print(exc)
-            return
+                print('Error %d for URL %s' % (status, nexturl))
+                print('')
+                return
+            if objects is None:
+                return
+            if ctx.archive is not None:
+                await ctx.archive.write(current_task.get(), nexturl, objects)
+        try:
+            nexturl = mknext(objects['odata.nextLink'], url)
+        except KeyError:
+            nexturl = None
+        if delta is not None:
+            # Differential query uses its own paging links
+            if 'aad.nextLink' in objects:
+                nexturl = mknext(objects['aad.nextLink'], url)
+            if 'aad.deltaLink' in objects:
+                delta['deltaLink'] = objects['aad.deltaLink']
+        try:
+            page = objects['value']
+        except KeyError:
+            # print(objects)
+            page = []
+        yield page, nexturl
+
+async def dumphelper(ctx, url, method=requests.get):
+    async for page, _ in dumppages(ctx, url, method=method):
+        for robject in page:
+            yield robject
 
-async def ratelimit():
-    global tokencounter, tokenfilltime
-    if tokencounter < MAX_REQ_PER_SEC:
+def endpoint_family(url):
+    '''
+    Reduce a request URL to the endpoint it targets, without tenant, object IDs
+    and query string. For example groups/<id>/$links/members becomes groups/$links/members
+    '''
+    parts = url.split('?')[0].split('/')[4:]
+    family = []
+    for part in parts:
+        # Skip object IDs and type casts that directoryObjects nextLinks contain
+        if len(part) == 36 and part.count('-') == 4:
+            continue
+        if part.startswith('Microsoft.DirectoryServices.'):
+            continue
+        family.append(part)
+    return '/'.join(family)
+
+class EndpointRate(object):
+    '''
+    Token bucket for a single endpoint family
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.filltime = time.time()
+        self.blocked_until = 0
+        self.last_decrease = 0
+        self.requests = 0
+        self.throttled = 0
+
+class AdaptiveRateLimiter(object):
+    '''
+    Rate limiter that keeps a separate rate per endpoint family, so that
+    throttling on one endpoint does not slow down the others.
+    The rate of a family is increased additively for every successful request
+    and halved when the service returns a 429 (AIMD), which converges on the
+    highest rate the endpoint sustains. Retry-After hints from the server
+    block the whole family until they expire.
+    '''
+    def __init__(self, initial_rate=INITIAL_REQ_PER_SEC, max_rate=MAX_REQ_PER_SEC, min_rate=1.0, increase=1.0, decrease=0.5):
+        self.initial_rate = min(initial_rate, max_rate)
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.families = {}
+
+    def get_family(self, url):
+        family = endpoint_family(url)
+        try:
+            return self.families[family]
+        except KeyError:
+            state = self.families[family] = EndpointRate(self.initial_rate)
+            return state
+
+    async def acquire(self, url):
+        state = self.get_family(url)
+        while True:
+            now = time.time()
+            if state.blocked_until > now:
+                await asyncio.sleep(state.blocked_until - now)
+                continue
+            # Allow bursts of at most one second worth of requests
+            state.tokens = min(state.rate, state.tokens + state.rate * (now - state.filltime))
+            state.filltime = now
+            if state.tokens >= 1:
+                state.tokens -= 1
+                state.requests += 1
+                return
+            await asyncio.sleep((1 - state.tokens) / state.rate)
+
+    def duration(self, requests):
+        '''
+        Seconds that requests to a single endpoint family take at least, starting
+        at the initial rate and increasing up to the maximum rate without throttling
+        '''
+        ramp = min(requests, max(0, math.ceil((self.max_rate - self.initial_rate) / self.increase)))
+        seconds = math.log((self.initial_rate + ramp * self.increase) / self.initial_rate) / self.increase
+        return seconds + (requests - ramp) / self.max_rate
+
+    def success(self, url):
+        state = self.get_family(url)
+        state.rate = min(self.max_rate, state.rate + self.increase)
+
+    def throttled(self, url, retry_after=None):
+        state = self.get_family(url)
+        state.throttled += 1
         now = time.time()
-        to_add = MAX_REQ_PER_SEC * (now - tokenfilltime)
-        tokencounter = min(MAX_REQ_PER_SEC, tokencounter + to_add)
-        tokenfilltime = now
-    if tokencounter < 1:
-        # print('Ratelimit reached')
-        await asyncio.sleep(0.1)
-        await ratelimit()
-    else:
-        tokencounter -= 1
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # No (numeric) hint from the server, back off for roughly one refill period
+            delay = 1.0
+        state.blocked_until = max(state.blocked_until, now + delay)
+        state.tokens = 0
+        # Requests that were in flight when the limit was hit are throttled as well,
+        # only decrease once per throttling event
+        if now - state.last_decrease > delay:
+            state.rate = max(self.min_rate, state.rate * self.decrease)
+            state.last_decrease = now
+            print('Rate limit hit on {0}, sleeping {1:0.1f} seconds and continuing at {2:0.1f} req/s'.format(endpoint_family(url), delay, state.rate))
+
+    def rates(self):
+        '''
+        Current rate per endpoint family, as dict with the rate and request stats
+        '''
+        return {family: {'rate': state.rate, 'requests': state.requests, 'throttled': state.throttled}
+                for family, state in self.families.items()}
+
+    def print_rates(self):
+        print('Request rates per endpoint:')
+        for family, stats in sorted(self.rates().items()):
+            print('  {0:<45} {1:8.1f} req/s {2:8d} requests {3:6d} throttled'.format(family, stats['rate'], stats['requests'], stats['throttled']))
+
+class ConnectionStats(object):
+    '''
+    Counts how often requests opened a new connection or reused one from the
+    pool, and how long they waited for a free connection when the pool was full
+    '''
+    def __init__(self):
+        self.created = 0
+        self.reused = 0
+        self.queued = 0
+        self.queuetime = 0.0
+        self.dnshits = 0
+        self.dnsmisses = 0
+        self.received = 0
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self.on_connection_reuseconn)
+        trace_config.on_connection_queued_start.append(self.on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(self.on_connection_queued_end)
+        trace_config.on_dns_cache_hit.append(self.on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self.on_dns_cache_miss)
+        trace_config.on_response_chunk_received.append(self.on_response_chunk_received)
+        return trace_config
+
+    async def on_connection_create_end(self, session, context, params):
+        self.created += 1
+
+    async def on_connection_reuseconn(self, session, context, params):
+        self.reused += 1
+
+    async def on_connection_queued_start(self, session, context, params):
+        context.queuestart = time.perf_counter()
+
+    async def on_connection_queued_end(self, session, context, params):
+        self.queued += 1
+        self.queuetime += time.perf_counter() - context.queuestart
+
+    async def on_dns_cache_hit(self, session, context, params):
+        self.dnshits += 1
+
+    async def on_dns_cache_miss(self, session, context, params):
+        self.dnsmisses += 1
+
+    async def on_response_chunk_received(self, session, context, params):
+        self.received += len(params.chunk)
 
+    def print_stats(self):
+        total = self.created + self.reused
+        if total == 0:
+            return
+        print('Opened {0} connections, {1} of {2} requests ({3:0.1f}%) reused a pooled connection'.format(self.created, self.reused, total, self.reused * 100.0 / total))
+        print('Received {0:0.1f} MB of response data'.format(self.received / 1048576.0))
+        if self.dnsmisses > 0:
+            print('Resolved hostnames {0} times, {1} lookups were answered from the DNS cache'.format(self.dnsmisses, self.dnshits))
+        if self.queued > 0:
+            print('Requests waited {0} times for a free connection, {1:0.2f} seconds in total. Consider raising --connection-limit'.format(self.queued, self.queuetime))
+
+def create_connector(args):
+    '''
+    Connection pool shared by all requests of a gather run
+    '''
+    return aiohttp.TCPConnector(limit=args.connection_limit,
+                                limit_per_host=args.connections_per_host,
+                                keepalive_timeout=args.keepalive_timeout,
+                                ttl_dns_cache=args.dns_cache_ttl)
+
+class TokenProvider(object):
+    '''
+    Keeps the access token of a tenant valid. The token is refreshed in the
+    background before it expires, so requests keep using the current token
+    in the meantime. Concurrent callers share a single refresh, and only wait
+    for it if the current token has expired already.
+    '''
+    def __init__(self, token):
+        self.headers = {}
+        self.set_token(token)
+        self.expiretime = time.mktime(time.strptime(token['expiresOn'].split('.')[0], '%Y-%m-%d %H:%M:%S'))
+        self.refreshing = None
+        # Earliest moment to try again after a failed refresh
+        self.retrytime = 0
+        self.refreshes = 0
+
+    def set_token(self, token):
+        self.token = token
+        # Headers are updated in place, so new requests pick up the new token
+        self.headers['Authorization'] = '%s %s' % (token['tokenType'], token['accessToken'])
 
-def checktoken():
-    global token, expiretime
-    if time.time() > expiretime - 300:
+    async def refresh(self):
         auth = Authentication()
         try:
-            auth.client_id = token['_clientId']
+            auth.client_id = self.token['_clientId']
         except KeyError:
             auth.client_id = '1b730954-1685-4b74-9bfd-dac224a7b894'
-        auth.tenant = token['tenantId']
-        auth.tokendata = token
-        if 'refreshToken' in token:
-            token = auth.authenticate_with_refresh(token)
-            headers['Authorization'] = '%s %s' % (token['tokenType'], token['accessToken'])
-            expiretime = time.time() + token['expiresIn']
-            print('Refreshed token')
+        auth.tenant = self.token['tenantId']
+        # The refresh updates the token data it is given, so give it a copy
+        auth.tokendata = dict(self.token)
+        loop = asyncio.get_event_loop()
+        try:
+            # The refresh does a blocking HTTP request, keep it off the event loop
+            token = await loop.run_in_executor(None, auth.authenticate_with_refresh, self.token)
+        except Exception as exc:
+            print('Failed to refresh token: %s' % exc)
+            self.retrytime = time.time() + TOKEN_RETRY_INTERVAL
+            return
+        finally:
+            self.refreshing = None
+        self.set_token(token)
+        self.expiretime = time.time() + int(token['expiresIn'])
+        self.refreshes += 1
+        print('Refreshed token')
+
+    def expire(self, token):
+        '''
+        Mark the token as expired after the API rejected it, so the next
+        check refreshes it. Ignored if the token was refreshed in the meantime.
+        '''
+        if token is self.token:
+            self.expiretime = min(self.expiretime, time.time())
+
+    async def check(self):
+        '''
+        Make sure the token is valid, refreshing it if it expires soon.
+        Returns False if the token has expired and could not be refreshed.
+        '''
+        now = time.time()
+        if now < self.expiretime - TOKEN_REFRESH_MARGIN:
             return True
-        elif time.time() > expiretime:
-            print('Access token is expired, but no access to refresh token! Dumping will fail')
-            return False
-    return True
+        if 'refreshToken' not in self.token:
+            if now > self.expiretime:
+                print('Access token is expired, but no access to refresh token! Dumping will fail')
+                return False
+            return True
+        if self.refreshing is None and now >= self.retrytime:
+            self.refreshing = asyncio.ensure_future(self.refresh())
+        if now > self.expiretime and self.refreshing is not None:
+            # Shielded, so a cancelled request does not cancel the refresh for the others
+            await asyncio.shield(self.refreshing)
+        return time.time() < self.expiretime
 
-async def dumpsingle(url, method):
-    global urlcounter, tokencounter
-    checktoken()
-    await ratelimit()
+class GatherContext(object):
+    '''
+    State of the gather of a single tenant: the token, database, rate limits
+    and request counters. Each tenant that is gathered has its own context.
+    '''
+    def __init__(self, token, dburl, tenantid=None, ratelimiter=None, archive=None, replay=None, retries=RETRY_ATTEMPTS,
+                 proxy=None, connstats=None, baseurl=None):
+        self.dburl = dburl
+        # Base URL of the API, URLs of archived responses start with it
+        if baseurl is None:
+            baseurl = GRAPH_URL
+        self.baseurl = baseurl
+        if token is not None and 'tenantId' in token:
+            self.tenantid = token['tenantId']
+        elif tenantid:
+            self.tenantid = tenantid
+        else:
+            self.tenantid = 'myorganization'
+        # Replayed gathers have no token
+        if token is not None:
+            self.tokens = TokenProvider(token)
+            self.headers = self.tokens.headers
+        else:
+            self.tokens = None
+            self.headers = {}
+        if ratelimiter is None:
+            ratelimiter = AdaptiveRateLimiter()
+        self.ratelimiter = ratelimiter
+        # Archive to record responses to, or archive to replay responses from
+        self.archive = archive
+        self.replay = replay
+        self.urlcounter = 0
+        self.batchcounter = 0
+        self.batcheditems = 0
+        self.groupcounter = 0
+        self.totalgroups = 0
+        self.retries = retries
+        # Requests that succeeded after retrying and requests that never did
+        self.recovered = 0
+        self.failed = 0
+        self.proxy = proxy
+        if connstats is None:
+            connstats = ConnectionStats()
+        self.connstats = connstats
+
+async def ratelimit(ctx, url):
+    await ctx.ratelimiter.acquire(url)
+
+async def dumpsingle(ctx, url, method, batcher=None):
+    if ctx.replay is not None:
+        return replay_response(ctx, url)
+    obj = await fetchsingle(ctx, url, method, batcher)
+    if ctx.archive is not None:
+        await ctx.archive.write(current_task.get(), url, obj)
+    return obj
+
+def replay_response(ctx, url):
+    '''
+    The archived response for url. A URL that is not in the archive fails
+    like a request, so the objects it belongs to are not marked as completed.
+    '''
     try:
-        urlcounter += 1
-        async with method(url, headers=headers) as res:
-            if res.status == 429:
-                if tokencounter > 0:
-                    tokencounter -= 10*MAX_REQ_PER_SEC
-                    print('Sleeping because of rate-limit hit')
-                obj = await dumpsingle(url, method)
-                return obj
-            if res.status != 200:
-                # This can happen
-                if res.status == 404 and 'applicationRefs' in url:
+        return ctx.replay.get(url)
+    except KeyError:
+        raise RequestFailed(url, 'not in archive')
+
+async def fetchsingle(ctx, url, method, batcher=None):
+    if batcher is not None:
+        return await batcher.get(url)
+    status, obj = await request_json(ctx, url, method)
+    if status != 200:
+        # This can happen
+        if status == 404 and 'applicationRefs' in url:
+            return
+        # Ignore default users role not being found
+        if status == 404 and 'a0b1b346-4d3e-4e8b-98f8-753987be4970' in url:
+            return
+        print('Error %d for URL %s' % (status, url))
+        return
+    return obj
+
+def parse_batch_response(content_type, body):
+    '''
+    Split a multipart/mixed $batch response into a list of
+    (status, headers, body) tuples, in the order the requests were sent
+    '''
+    boundary = content_type.split('boundary=')[1].split(';')[0].strip('"')
+    results = []
+    for part in body.split('--' + boundary)[1:]:
+        if part.startswith('--'):
+            # Closing boundary
+            break
+        # Each part has its own MIME headers, followed by the raw HTTP response
+        _, _, response = part.replace('\r\n', '\n').strip().partition('\n\n')
+        statusline, _, response = response.partition('\n')
+        headerlines, _, content = response.partition('\n\n')
+        partheaders = {}
+        for line in headerlines.split('\n'):
+            name, _, value = line.partition(':')
+            partheaders[name.strip()] = value.strip()
+        results.append((int(statusline.split(' ')[1]), partheaders, content.strip()))
+    return results
+
+class RequestBatcher(object):
+    '''
+    Combines independent GET requests into OData $batch requests.
+    Callers await get() as they would dumpsingle(), the batcher
+    fans the responses of each batch back out to the individual callers.
+    '''
+    def __init__(self, ctx, api_version, ahsession, batchsize=MAX_BATCH_SIZE, maxwait=0.05):
+        self.ctx = ctx
+        self.url = ctx.baseurl + '/%s/$batch?api-version=%s' % (ctx.tenantid, api_version)
+        self.ahsession = ahsession
+        self.batchsize = batchsize
+        self.maxwait = maxwait
+        self.pending = []
+        self.flusher = None
+        self.running = set()
+        # Number of failed attempts of requests that are retried
+        self.attempts = {}
+
+    async def get(self, url):
+        future = asyncio.get_event_loop().create_future()
+        self.queue(url, future)
+        return await future
+
+    def queue(self, url, future):
+        self.pending.append((url, future))
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+        elif self.flusher is None:
+            # Give other coroutines the chance to add their requests before sending a partial batch
+            self.flusher = asyncio.ensure_future(self.delayed_flush())
+
+    def retry(self, url, future, error):
+        '''
+        Send a request again with a later batch after a back-off,
+        or fail it if all attempts are used up
+        '''
+        attempt = self.attempts.get(future, 0) + 1
+        if attempt > self.ctx.retries:
+            self.fail(future, RequestFailed(url, error))
+            print('Giving up after %d attempts (%s): %s' % (attempt, error, url))
+            return
+        self.attempts[future] = attempt
+        asyncio.get_event_loop().call_later(retry_delay(attempt), self.queue, url, future)
+
+    def resolve(self, future, result):
+        if self.attempts.pop(future, None) is not None:
+            self.ctx.recovered += 1
+        if not future.done():
+            future.set_result(result)
+
+    def fail(self, future, exc):
+        self.attempts.pop(future, None)
+        if not future.done():
+            future.set_exception(exc)
+
+    async def delayed_flush(self):
+        await asyncio.sleep(self.maxwait)
+        self.flusher = None
+        while self.pending:
+            self.flush()
+
+    def flush(self):
+        items = self.pending[:self.batchsize]
+        del self.pending[:self.batchsize]
+        task = asyncio.ensure_future(self.send(items))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def send(self, items):
+        '''
+        Send a batch. Requests that are not answered or sent again
+        fail with the error, so their callers never wait forever.
+        '''
+        try:
+            await self.sendbatch(items)
+        except Exception as exc:
+            for _, future in items:
+                self.fail(future, exc)
+
+    async def sendbatch(self, items):
+        ctx = self.ctx
+        boundary = 'batch_%s' % uuid.uuid4()
+        parts = []
+        for url, _ in items:
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n'
+                         'GET %s HTTP/1.1\r\nAccept: application/json\r\n\r\n' % (boundary, url))
+        parts.append('--%s--\r\n' % boundary)
+        if not await ctx.tokens.check():
+            raise RequestFailed(self.url, 'access token expired')
+        token = ctx.tokens.token
+        await ratelimit(ctx, self.url)
+        batchheaders = dict(ctx.headers)
+        batchheaders['Content-Type'] = 'multipart/mixed; boundary=%s' % boundary
+        try:
+            ctx.urlcounter += 1
+            async with self.ahsession.post(self.url, headers=batchheaders, data=''.join(parts), proxy=ctx.proxy) as res:
+                if res.status == 429:
+                    ctx.ratelimiter.throttled(self.url, res.headers.get('Retry-After'))
+                    for url, future in items:
+                        self.queue(url, future)
                     return
-                # Ignore default users role not being found
-                if res.status == 404 and 'a0b1b346-4d3e-4e8b-98f8-753987be4970' in url:
+                ctx.ratelimiter.success(self.url)
+                if res.status == 401:
+                    ctx.tokens.expire(token)
+                if res.status >= 500 or res.status == 401:
+                    for url, future in items:
+                        self.retry(url, future, 'HTTP status %d' % res.status)
+                    return
+                if res.status not in (200, 202):
+                    print('Error %d for batch URL %s' % (res.status, self.url))
+                    for _, future in items:
+                        self.resolve(future, None)
                     return
-                print('Error %d for URL %s' % (res.status, url))
+                results = parse_batch_response(res.headers['Content-Type'], await res.text())
+        except TRANSIENT_ERRORS as exc:
+            for url, future in items:
+                self.retry(url, future, str(exc) or exc.__class__.__name__)
+            return
+        ctx.batchcounter += 1
+        ctx.batcheditems += len(items)
+        if len(results) != len(items):
+            # Responses are matched to the requests by their order, which is lost when parts are missing
+            print('Got %d responses for a batch of %d requests' % (len(results), len(items)))
+            for url, future in items:
+                self.retry(url, future, 'missing from batch response')
+            return
+        for (url, future), result in zip(items, results):
+            try:
+                self.handle(url, future, result, token)
+            except Exception as exc:
+                # Keep going, the other requests of the batch are answered independently
+                self.fail(future, exc)
+
+    def handle(self, url, future, result, token):
+        '''
+        Answer a single request with its part of the batch response
+        '''
+        status, partheaders, content = result
+        if status == 429:
+            # Only this request was throttled, send it again with a later batch
+            self.ctx.ratelimiter.throttled(self.url, partheaders.get('Retry-After'))
+            self.queue(url, future)
+            return
+        if status == 401:
+            self.ctx.tokens.expire(token)
+        if status >= 500 or status == 401:
+            self.retry(url, future, 'HTTP status %d' % status)
+            return
+        if status != 200:
+            # Same exceptions as in dumpsingle
+            if status == 404 and ('applicationRefs' in url or 'a0b1b346-4d3e-4e8b-98f8-753987be4970' in url):
+                self.resolve(future, None)
                 return
-            objects = await res.json()
-            return objects
-    except Exception as exc:
-        print(exc)
-        return
+            print('Error %d for URL %s' % (status, url))
+            self.resolve(future, None)
+            return
+        try:
+            obj = serializer.loads(content)
+        except json.decoder.JSONDecodeError:
+            print('Invalid JSON for URL %s' % url)
+            obj = None
+        self.resolve(future, obj)
 
-def commit(engine, dbtype, cache, ignore=False):
-    global dburl
-    if 'postgresql' in dburl and ignore:
+def commit(engine, dbtype, cache, ignore=False, upsert=False):
+    dialect = engine.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite') and upsert:
+        table = dbtype.__table__
+        insertst = pginsert(table) if dialect == 'postgresql' else sqliteinsert(table)
+        keys = [column.name for column in table.primary_key]
+        # Only update the properties that were fetched, columns that are gathered
+        # separately such as strongAuthenticationDetail keep their value
+        fetched = set(prop for row in cache for prop in row)
+        # A statement can not update the same row twice, keep the last version of duplicates
+        cache = list({tuple(row[key] for key in keys): row for row in cache}.values())
+        update = {column.name: insertst.excluded[column.name] for column in table.c if column.name in fetched and column.name not in keys}
+        if update:
+            statement = insertst.on_conflict_do_update(index_elements=keys, set_=update)
+        else:
+            statement = insertst.on_conflict_do_nothing(index_elements=keys)
+    elif dialect == 'postgresql' and ignore:
         insertst = pginsert(dbtype.__table__)
         statement = insertst.on_conflict_do_nothing(
             index_elements=['objectId']
         )
-    elif 'sqlite' in dburl and ignore:
+    elif dialect == 'sqlite' and ignore:
         statement = dbtype.__table__.insert(prefixes=['OR IGNORE'])
     else:
         statement = dbtype.__table__.insert()
@@ -177,15 +828,17 @@ def commit(engine, dbtype, cache, ignore=False):
         cache
     )
 
-def commitlink(engine, cachedict, ignore=False):
-    global dburl
+def commitlink(engine, cachedict, ignore=True):
+    '''
+    Store links. Links that are stored already, for example because the API
+    returned them twice, are ignored unless ignore is False.
+    '''
+    dialect = engine.get_bind().dialect.name
     for linktable, cache in cachedict.items():
-        if 'postgresql' in dburl and ignore:
-            insertst = pginsert(linktable)
-            statement = insertst.on_conflict_do_nothing(
-                index_elements=['objectId']
-            )
-        elif 'sqlite' in dburl and ignore:
+        if dialect == 'postgresql' and ignore:
+            # Without conflict target, since link tables of older databases have no primary key
+            statement = pginsert(linktable).on_conflict_do_nothing()
+        elif dialect == 'sqlite' and ignore:
             statement = linktable.insert(prefixes=['OR IGNORE'])
         else:
             statement = linktable.insert()
@@ -195,6 +848,129 @@ def commitlink(engine, cachedict, ignore=False):
             cache
         )
 
+def commitcursor(engine, task, nextlink=None, done=False):
+    '''
+    Store the progress of a task. The cursor row of a task has an empty objectId,
+    parent objects that were completed are stored as separate rows
+    '''
+    table = GatherCheckpoint.__table__
+    engine.execute(table.delete().where(table.c.task == task).where(table.c.objectId == ''))
+    engine.execute(table.insert(), {'task': task, 'objectId': '', 'nextLink': nextlink, 'done': done})
+
+def commitstate(engine, task, state):
+    '''
+    Store a decision of a task that a resumed run has to follow
+    '''
+    table = GatherCheckpoint.__table__
+    engine.execute(table.delete().where(table.c.task == task).where(table.c.objectId == ''))
+    engine.execute(table.insert(), {'task': task, 'objectId': '', 'state': state, 'done': False})
+
+def commitpage(engine, dbtype, cache, task, nextlink, done, upsert=False):
+    '''
+    Store a page of objects together with the progress of the task
+    '''
+    if len(cache) > 0:
+        commit(engine, dbtype, cache, upsert=upsert)
+    commitcursor(engine, task, nextlink=nextlink, done=done)
+
+def commitparents(engine, task, parentids):
+    engine.execute(
+        GatherCheckpoint.__table__.insert(),
+        [{'task': task, 'objectId': parentid, 'done': True} for parentid in parentids]
+    )
+
+def delete_in(engine, table, column, values):
+    '''
+    Delete rows of which column is one of values, in chunks to stay
+    below the maximum number of parameters of the database
+    '''
+    values = list(values)
+    for i in range(0, len(values), 500):
+        engine.execute(table.delete().where(table.c[column].in_(values[i:i+500])))
+
+def clear_tables(engine, dbtypes):
+    '''
+    Remove all rows from the tables of dbtypes, and from the
+    tables referring to them
+    '''
+    tables = [dbtype.__table__ for dbtype in dbtypes]
+    for table in database.Base.metadata.tables.values():
+        if table in tables:
+            continue
+        for column in table.c:
+            if any(fkey.column.table in tables for fkey in column.foreign_keys):
+                engine.execute(table.delete())
+                break
+    for table in tables:
+        engine.execute(table.delete())
+
+def remove_objects(engine, dbtype, objectids):
+    '''
+    Remove objects that were deleted from the directory, including
+    the links from and to these objects
+    '''
+    table = dbtype.__table__
+    key = list(table.primary_key)[0].name
+    for linktable in database.Base.metadata.tables.values():
+        if not linktable.name.startswith('lnk_'):
+            continue
+        for column in linktable.c:
+            if any(fkey.column.table is table for fkey in column.foreign_keys):
+                delete_in(engine, linktable, column.name, objectids)
+    delete_in(engine, AppRoleAssignment.__table__, 'principalId', objectids)
+    delete_in(engine, AppRoleAssignment.__table__, 'resourceId', objectids)
+    if dbtype is ServicePrincipal:
+        appids = [appid for appid, in engine.execute(select(table.c.appId).where(table.c.objectId.in_(list(objectids))))]
+        delete_in(engine, ApplicationRef.__table__, 'appId', appids)
+    delete_in(engine, table, key, objectids)
+
+def relationship_link(parenttbl, linkname):
+    '''
+    Returns the link table behind an ORM relationship, together with the
+    names of the columns that refer to the parent and to the child
+    '''
+    prop = getattr(parenttbl, linkname).property
+    return prop.secondary, prop.synchronize_pairs[0][1].name, prop.secondary_synchronize_pairs[0][1].name
+
+def relationship_mapping(parenttbl, mapping, linkname=None, childtbl=None):
+    '''
+    Converts an ORM mapping (object type to child table and relationship name)
+    to object type -> (child table, link table, parent column, child column).
+    Without a mapping, the result has the single child table under key None.
+    Object types mapped to None are skipped.
+    '''
+    if mapping is None:
+        return {None: (childtbl,) + relationship_link(parenttbl, linkname)}
+    return {objclass: (value[0],) + relationship_link(parenttbl, value[1]) if value else None for objclass, value in mapping.items()}
+
+def mapping_linktables(parenttbl, mapping, linkname=None):
+    '''
+    Returns the link tables that a link mapping writes to, together with the
+    name of the column that refers to the parent
+    '''
+    if mapping is None:
+        return [relationship_link(parenttbl, linkname)[:2]]
+    tables = []
+    for value in mapping.values():
+        if value is None:
+            continue
+        if len(value) == 3:
+            # Direct link mapping (linktable, parent column, child column)
+            tables.append((value[0], value[1]))
+        else:
+            # ORM mapping (child table, relationship name)
+            tables.append(relationship_link(parenttbl, value[1])[:2])
+    return tables
+
+def create_indexes(engine):
+    '''
+    Create the secondary indexes once the data is loaded, which is faster than
+    maintaining them during the inserts
+    '''
+    start = time.time()
+    database.create_indexes(engine)
+    print('Created indexes in {0:0.1f} seconds'.format(time.time() - start))
+
 def commitmfa(engine, dbtype, cache):
     statement = dbtype.__table__.update().where(dbtype.objectId == bindparam('userid'))
     engine.execute(
@@ -202,446 +978,1377 @@ def commitmfa(engine, dbtype, cache):
         cache
     )
 
-async def queue_processor(queue):
-    while True:
-        task = await queue.get()
-        # task is already a coroutine, so we wait for it to finish
-        await task
-        queue.task_done()
+class DatabaseWriter(object):
+    '''
+    Thread that owns the database session. All database access of the gather
+    goes through its queue, so the HTTP requests never wait on the database.
+    Queued writes are executed in order and committed in batches, each write
+    is executed within one transaction.
+    '''
+    def __init__(self, engine, maxsize=WRITE_QUEUE_SIZE, commitinterval=1.0):
+        self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self.queue = Queue(maxsize)
+        self.maxsize = maxsize
+        self.commitinterval = commitinterval
+        self.thread = threading.Thread(target=self.process, daemon=True)
+        self.error = None
+        # Statistics
+        self.writes = 0
+        self.commits = 0
+        self.maxdepth = 0
+        self.totallag = 0.0
+        self.maxlag = 0.0
+        self.writetime = 0.0
+        self.waittime = 0.0
+        # Keeps writes in order while waiting for room in the queue
+        self.lock = asyncio.Lock()
+
+    def start(self):
+        self.thread.start()
+
+    def process(self):
+        lastcommit = time.time()
+        pending = 0
+        while True:
+            job, args, callback, queued = self.queue.get()
+            if job is None:
+                if pending > 0 and self.error is None:
+                    self.session.commit()
+                    self.commits += 1
+                self.session.close()
+                break
+            if self.error is not None:
+                # Drain the queue so nothing waits on us forever
+                if callback:
+                    callback(None, self.error)
+                continue
+            start = time.time()
+            lag = start - queued
+            self.totallag += lag
+            self.maxlag = max(self.maxlag, lag)
+            try:
+                result = job(self.session, *args)
+                pending += 1
+                if self.queue.empty() or start - lastcommit > self.commitinterval:
+                    self.session.commit()
+                    self.commits += 1
+                    lastcommit = time.time()
+                    pending = 0
+            except Exception as exc:
+                traceback.print_exc()
+                self.session.rollback()
+                self.error = exc
+                if callback:
+                    callback(None, exc)
+                continue
+            self.writes += 1
+            self.writetime += time.time() - start
+            if callback:
+                callback(result, None)
+
+    async def put(self, job, *args, callback=None):
+        '''
+        Queue job to be executed as job(session, *args) in the writer thread.
+        When the queue is full, this waits until there is room again.
+        '''
+        if self.error is not None:
+            raise self.error
+        item = (job, args, callback, time.time())
+        async with self.lock:
+            try:
+                self.queue.put_nowait(item)
+            except Full:
+                start = time.time()
+                await asyncio.get_running_loop().run_in_executor(None, self.queue.put, item)
+                self.waittime += time.time() - start
+        self.maxdepth = max(self.maxdepth, self.queue.qsize())
+
+    async def call(self, job, *args):
+        '''
+        Execute job in the writer thread after all queued writes, and return its result
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def callback(result, exc):
+            loop.call_soon_threadsafe(set_future, future, result, exc)
+        await self.put(job, *args, callback=callback)
+        return await future
+
+    async def execute(self, statement):
+        await self.put(lambda session: session.execute(statement))
+
+    async def fetchall(self, statement):
+        return await self.call(lambda session: session.execute(statement).fetchall())
+
+    async def query(self, *entities):
+        return await self.call(lambda session: session.query(*entities).all())
+
+    async def close(self):
+        await self.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self.thread.join)
+        if self.error is not None:
+            raise self.error
+
+    def print_stats(self):
+        if self.writes == 0:
+            return
+        print('Database writer executed {0} operations in {1} transactions, spending {2:.2f} seconds on the database'.format(self.writes, self.commits, self.writetime))
+        print('Maximum write queue depth {0}/{1}, writer lag {2:.2f} seconds on average and {3:.2f} seconds maximum'.format(self.maxdepth, self.maxsize, self.totallag / self.writes, self.maxlag))
+        if self.waittime > 0:
+            print('Gathering waited {0:.2f} seconds on a full write queue, the database is the bottleneck'.format(self.waittime))
+
+def set_future(future, result, exc):
+    if future.done():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+
+async def run_workers(jobs, workers=MAX_WORKERS):
+    '''
+    Run the coroutines from the async iterable jobs with a fixed number of workers.
+    New jobs are only taken from jobs when a worker is available, so the number
+    of pending coroutines does not grow with the number of jobs.
+    '''
+    queue = asyncio.Queue(maxsize=workers)
+    errors = []
+    async def worker():
+        while True:
+            job = await queue.get()
+            try:
+                await job
+            except Exception as exc:
+                errors.append(exc)
+            queue.task_done()
+    tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+    try:
+        async for job in jobs:
+            if errors:
+                job.close()
+                break
+            await queue.put(job)
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+    if errors:
+        raise errors[0]
+
+async def iterate(items):
+    '''
+    Async iterable over the items of a list
+    '''
+    for item in items:
+        yield item
+
+class GatherTask(object):
+    '''
+    A step of the gather. The task starts once all tables in depends are
+    complete, tables are complete once all tasks that provide them are done.
+    The tables in clears are filled by the task alone, these are emptied
+    when the task runs against a database that already holds them.
+    '''
+    def __init__(self, name, func, *args, provides=(), depends=(), clears=(), **kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.provides = provides
+        self.depends = depends
+        self.clears = clears
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+async def run_tasks(tasks, dumper):
+    '''
+    Run the gather tasks, starting each task as soon as its dependencies are complete.
+    Writes of a finished task are queued before anything that later tasks read,
+    so they always see the complete tables.
+    '''
+    remaining = {}
+    for task in tasks:
+        for table in task.provides:
+            remaining[table] = remaining.get(table, 0) + 1
+    # Tables that no task writes to are complete from the start
+    for table in sorted(set(table for task in tasks for table in task.depends)):
+        if table not in remaining:
+            await dumper.table_completed(table)
+    pending = list(tasks)
+    running = {}
+    try:
+        while pending or running:
+            for task in pending[:]:
+                if not any(remaining.get(table) for table in task.depends):
+                    pending.remove(task)
+                    # The task runs in a copy of the current context, which identifies its requests
+                    reset = current_task.set(task.name)
+                    running[asyncio.ensure_future(task.run())] = task
+                    current_task.reset(reset)
+            if not running:
+                raise ValueError('Gather tasks depend on each other: %s' % ', '.join(task.name for task in pending))
+            done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                future.result()
+                for table in task.provides:
+                    remaining[table] -= 1
+                    if remaining[table] == 0:
+                        await dumper.table_completed(table)
+    finally:
+        for future in running:
+            future.cancel()
+
+def select_tasks(tasks, only=None, exclude=None):
+    '''
+    The tasks of which the name matches one of the comma separated patterns
+    in only, and none of those in exclude. Patterns can contain wildcards.
+    Raises a ValueError for patterns that do not match any task.
+    '''
+    names = [task.name for task in tasks]
+    def matching(patterns):
+        matched = set()
+        for pattern in patterns.split(','):
+            found = fnmatch.filter(names, pattern.strip())
+            if not found:
+                raise ValueError('No gather task matches {0}, the tasks are: {1}'.format(pattern.strip(), ', '.join(names)))
+            matched.update(found)
+        return matched
+    selected = matching(only) if only else set(names)
+    if exclude:
+        selected -= matching(exclude)
+    return [task for task in tasks if task.name in selected]
+
+def gather_tasks(dumper, args):
+    '''
+    Returns the list of gather tasks, with the tables each of them writes to and reads from
+    '''
+    # Mapping object, mapping type returned to Table and link name
+    group_mapping = {
+        'Microsoft.DirectoryServices.User': (User, 'memberUsers'),
+        'Microsoft.DirectoryServices.Group': (Group, 'memberGroups'),
+        'Microsoft.DirectoryServices.Contact': (Contact, 'memberContacts'),
+        'Microsoft.DirectoryServices.Device': (Device, 'memberDevices'),
+        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'memberServicePrincipals'),
+    }
+    group_owner_mapping = {
+        'Microsoft.DirectoryServices.User': (User, 'ownerUsers'),
+        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'ownerServicePrincipals'),
+    }
+    owner_mapping = {
+        'Microsoft.DirectoryServices.User': (User, 'ownerUsers'),
+        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'ownerServicePrincipals'),
+    }
+    au_mapping = {
+        'Microsoft.DirectoryServices.User': (User, 'memberUsers'),
+        'Microsoft.DirectoryServices.Group': (Group, 'memberGroups'),
+        'Microsoft.DirectoryServices.Device': (Device, 'memberDevices'),
+    }
+    role_mapping = {
+        'Microsoft.DirectoryServices.User': (User, 'memberUsers'),
+        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'memberServicePrincipals'),
+        'Microsoft.DirectoryServices.Group': (Group, 'memberGroups'),
+    }
+    def links(parenttbl, mapping=None, linkname=None):
+        return [linktable for linktable, _ in mapping_linktables(parenttbl, mapping, linkname)]
+    if args.incremental:
+        dump_changes = dumper.dump_delta
+    else:
+        dump_changes = dumper.dump_object
+    tasks = [
+        GatherTask('users', dump_changes, 'users', User, provides=['Users']),
+        GatherTask('tenantDetails', dumper.dump_object, 'tenantDetails', TenantDetail, provides=['TenantDetails']),
+        GatherTask('policies', dumper.dump_object, 'policies', Policy, provides=['Policys']),
+        GatherTask('servicePrincipals', dump_changes, 'servicePrincipals', ServicePrincipal, provides=['ServicePrincipals']),
+        GatherTask('groups', dump_changes, 'groups', Group, provides=['Groups']),
+        GatherTask('administrativeUnits', dumper.dump_object, 'administrativeUnits', AdministrativeUnit, provides=['AdministrativeUnits']),
+        GatherTask('applications', dumper.dump_object, 'applications', Application, provides=['Applications']),
+        GatherTask('devices', dump_changes, 'devices', Device, provides=['Devices']),
+        # GatherTask('domains', dumper.dump_object, 'domains', Domain, provides=['Domains']),
+        GatherTask('directoryRoles', dumper.dump_object, 'directoryRoles', DirectoryRole, provides=['DirectoryRoles']),
+        GatherTask('roleDefinitions', dumper.dump_object, 'roleDefinitions', RoleDefinition, provides=['RoleDefinitions']),
+        GatherTask('contacts', dump_changes, 'contacts', Contact, provides=['Contacts']),
+        GatherTask('oauth2PermissionGrants', dumper.dump_object, 'oauth2PermissionGrants', OAuth2PermissionGrant, provides=['OAuth2PermissionGrants']),
+        GatherTask('authorizationPolicy', dumper.dump_object, 'authorizationPolicy', AuthorizationPolicy, provides=['AuthorizationPolicys']),
+        GatherTask('settings', dumper.dump_object, 'settings', DirectorySetting, provides=['DirectorySettings']),
+    ]
+    if args.skip_first_phase:
+        # Objects are already in the database
+        tasks = []
+    tasks += [
+        GatherTask('groups/members', dumper.dump_group_members, group_mapping,
+                   depends=['Groups', 'Users', 'Contacts', 'Devices', 'ServicePrincipals'], clears=links(Group, group_mapping)),
+        GatherTask('groups/owners', dumper.dump_links, 'groups', 'owners', Group, mapping=group_owner_mapping,
+                   depends=['Groups', 'Users', 'ServicePrincipals'], clears=links(Group, group_owner_mapping)),
+        GatherTask('administrativeUnits/members', dumper.dump_links, 'administrativeUnits', 'members', AdministrativeUnit, mapping=au_mapping, expand=True,
+                   depends=['AdministrativeUnits', 'Users', 'Groups', 'Devices'], clears=links(AdministrativeUnit, au_mapping)),
+        GatherTask('devices/registeredOwners', dumper.dump_device_owners,
+                   depends=['Devices', 'Users', 'Groups'], clears=links(Device, linkname='owner')),
+        GatherTask('directoryRoles/members', dumper.dump_links, 'directoryRoles', 'members', DirectoryRole, mapping=role_mapping,
+                   depends=['DirectoryRoles', 'Users', 'ServicePrincipals', 'Groups'], clears=links(DirectoryRole, role_mapping)),
+        GatherTask('servicePrincipals/appRoleAssignedTo', dumper.dump_app_role_assignments,
+                   provides=['AppRoleAssignments'], depends=['ServicePrincipals'], clears=[AppRoleAssignment.__table__]),
+        GatherTask('servicePrincipals/owners', dumper.dump_object_expansion, 'servicePrincipals', ServicePrincipal, 'owners', 'owner', User, mapping=owner_mapping,
+                   depends=['ServicePrincipals', 'Users'], clears=links(ServicePrincipal, owner_mapping)),
+        GatherTask('applications/owners', dumper.dump_object_expansion, 'applications', Application, 'owners', 'owner', User, mapping=owner_mapping,
+                   depends=['Applications', 'Users', 'ServicePrincipals'], clears=links(Application, owner_mapping)),
+        GatherTask('roleAssignments', dumper.dump_custom_role_members, RoleAssignment,
+                   provides=['RoleAssignments'], depends=['RoleDefinitions'], clears=[RoleAssignment.__table__]),
+        GatherTask('eligibleRoleAssignments', dumper.dump_eligible_role_members, EligibleRoleAssignment,
+                   provides=['EligibleRoleAssignments'], depends=['RoleDefinitions'], clears=[EligibleRoleAssignment.__table__]),
+        GatherTask('applicationRefs', dumper.dump_each, 'servicePrincipals', ServicePrincipal, 'applicationRefs', ApplicationRef,
+                   provides=['ApplicationRefs'], depends=['ServicePrincipals'], clears=[ApplicationRef.__table__]),
+        GatherTask('servicePrincipals/keyCredentials', dumper.dump_keycredentials, 'servicePrincipals', ServicePrincipal,
+                   depends=['ServicePrincipals']),
+        GatherTask('applications/keyCredentials', dumper.dump_keycredentials, 'applications', Application,
+                   depends=['Applications']),
+    ]
+    if args.mfa:
+        tasks.append(GatherTask('users/strongAuthenticationDetail', dumper.dump_mfa, 'users', User,
+                                depends=['Users']))
+    return tasks
 
 class DataDumper(object):
-    def __init__(self, tenantid, api_version, ahsession=None, engine=None, session=None):
+    def __init__(self, ctx, api_version, ahsession=None, writer=None, batcher=None, resume=False, incremental=False,
+                 selectprofile=None, pagesize=None, partitioned=False, membership='auto', refresh=False):
+        self.ctx = ctx
         self.api_version = api_version
-        self.tenantid = tenantid
-        self.session = session
-        self.engine = engine
+        self.tenantid = ctx.tenantid
+        self.baseurl = ctx.baseurl
+        self.writer = writer
         self.ahsession = ahsession
+        self.batcher = batcher
+        self.resume = resume
+        # Profile of the properties to request for large collections, None for all properties
+        self.selectprofile = selectprofile
+        # Objects per page requested with $top, None for the default of the directory
+        self.pagesize = pagesize
+        # Enumerate the collections in PARTITIONS over concurrent cursors
+        self.partitioned = partitioned
+        # Direction to collect group memberships from: groups, members or auto
+        self.membership = membership
+        # Update the objects in a database that already holds them, instead of filling empty tables
+        self.refresh = refresh
+        # objectId -> table of all objects, to validate links before writing them
+        self.objectindex = {}
+        # Jobs per task of which the requests kept failing, to try again at the end of the task
+        self.deadletters = {}
+        # For incremental runs, the objectIds that changed per collection
+        if incremental:
+            self.changed = {}
+        else:
+            self.changed = None
+
+    async def build_index(self, dbtype):
+        '''
+        Add the objects of dbtype to the index of objectIds to their table,
+        which is used instead of looking up each linked object in the database
+        '''
+        objectids = await self.writer.query(dbtype.objectId)
+        self.objectindex.update((objectid, dbtype) for objectid, in objectids)
+
+    async def table_completed(self, table):
+        '''
+        Called by the scheduler once no task will write objects to table anymore
+        '''
+        if table in INDEXED_TABLES:
+            await self.build_index(INDEXED_TABLES[table])
+        if table == 'Groups':
+            self.ctx.totalgroups = await self.writer.call(lambda session: session.query(func.count(Group.objectId)).scalar())
+
+    async def stream_parents(self, parenttbl, *columns):
+        '''
+        Async generator that yields the objectId and columns of all parent objects,
+        reading them from the database in chunks ordered by objectId
+        '''
+        lastid = None
+        while True:
+            query = select(parenttbl.objectId, *columns).order_by(parenttbl.objectId).limit(PARENT_CHUNK_SIZE)
+            if lastid is not None:
+                query = query.where(parenttbl.objectId > lastid)
+            rows = await self.writer.fetchall(query)
+            for row in rows:
+                yield row
+            if len(rows) < PARENT_CHUNK_SIZE:
+                return
+            lastid = rows[-1][0]
+
+    async def get_checkpoint(self, task):
+        table = GatherCheckpoint.__table__
+        res = await self.writer.fetchall(select(table).where(table.c.task == task).where(table.c.objectId == ''))
+        if res:
+            return res[0]
+        return None
+
+    async def get_finished_parents(self, task):
+        table = GatherCheckpoint.__table__
+        res = await self.writer.fetchall(select(table.c.objectId).where(table.c.task == task).where(table.c.objectId != ''))
+        return set(parentid for parentid, in res)
+
+    async def task_completed(self, task, cleanup=()):
+        '''
+        When resuming, check if a task was completed during a previous run.
+        Partial results of tasks that were not completed are removed from the
+        tables in cleanup, since these tasks start over.
+        Incremental runs always start over, after removing the previous results.
+        '''
+        if self.changed is not None:
+            for table in cleanup:
+                await self.writer.execute(table.delete())
+            return False
+        if not self.resume:
+            return False
+        checkpoint = await self.get_checkpoint('task:' + task)
+        if checkpoint is not None and checkpoint.done:
+            return True
+        for table in cleanup:
+            await self.writer.execute(table.delete())
+        return False
+
+    async def mark_completed(self, task):
+        await self.writer.put(commitcursor, 'task:' + task, None, True)
+
+    async def select_parents(self, task, objecttype, linktables=()):
+        '''
+        Decide which parent objects a task processes, returns a function that
+        is True for the objectIds of these parents. Previous results for those
+        parents are removed from linktables, since they will be fetched again.
+
+        When resuming, this skips the parents completed during a previous run.
+        For incremental runs, only parents that changed are processed. Parents
+        of which changes are not tracked are all processed again.
+        '''
+        table = GatherCheckpoint.__table__
+        if self.changed is not None:
+            await self.writer.execute(table.delete().where(table.c.task == task).where(table.c.objectId != ''))
+            if objecttype not in self.changed:
+                for linktable, _ in linktables:
+                    await self.writer.execute(linktable.delete())
+                return lambda parentid: True
+            changed = self.changed[objecttype]
+            for linktable, parentcol in linktables:
+                await self.writer.put(delete_in, linktable, parentcol, changed)
+            print('Refreshing {0} for {1} changed objects'.format(task.split(':', 1)[1], len(changed)))
+            return changed.__contains__
+        if not self.resume:
+            return lambda parentid: True
+        for linktable, parentcol in linktables:
+            finished = select(table.c.objectId).where(table.c.task == task)
+            await self.writer.execute(linktable.delete().where(~linktable.c[parentcol].in_(finished)))
+        finished = await self.get_finished_parents(task)
+        if finished:
+            print('Resuming {0}, skipping {1} completed objects'.format(task.split(':', 1)[1], len(finished)))
+        return lambda parentid: parentid not in finished
+
+    async def finish_parents(self, task, parentids):
+        '''
+        Record parents of which all linked objects are written to the database.
+        '''
+        if len(parentids) == 0:
+            return
+        await self.writer.put(commitparents, task, list(parentids))
+
+    async def guard(self, taskname, job, *args, **kwargs):
+        '''
+        Run the job that processes a single parent object. If its requests keep
+        failing, it is put on the dead letter list to try again at the end of the task.
+        '''
+        try:
+            await job(*args, **kwargs)
+        except RequestFailed as exc:
+            self.deadletters.setdefault(taskname, []).append((exc.url, job, args, kwargs))
+
+    async def retry_deadletters(self, task):
+        '''
+        Try the failed jobs of a task once more. Returns the number of jobs that
+        failed again, their parents are not recorded as completed so that
+        a resumed gather collects them.
+        '''
+        deadletters = self.deadletters.pop(task, [])
+        if not deadletters:
+            return 0
+        print('Retrying {0} failed requests of {1}'.format(len(deadletters), task))
+        failed = []
+        async def retry(url, job, args, kwargs):
+            try:
+                await job(*args, **kwargs)
+            except RequestFailed as exc:
+                failed.append(exc.url)
+                return
+            self.ctx.recovered += 1
+        async def jobs():
+            for deadletter in deadletters:
+                yield retry(*deadletter)
+        await run_workers(jobs())
+        for url in failed:
+            print('Permanently failed: %s' % url)
+        self.ctx.failed += len(failed)
+        return len(failed)
 
     async def dump_object(self, objecttype, dbtype, method=None):
         if method is None:
             method = self.ahsession.get
-        url = 'https://graph.windows.net/%s/%s?api-version=1.61-internal' % (self.tenantid, objecttype)
+        url = self.baseurl + '/%s/%s?api-version=1.61-internal' % (self.tenantid, objecttype)
+        if objecttype in LARGE_COLLECTIONS:
+            columns = select_columns(dbtype, self.selectprofile)
+            if columns:
+                url += '&$select=' + ','.join(columns)
+            if self.pagesize:
+                url += '&$top=%d' % self.pagesize
+        task = 'object:' + objecttype
+        partitioned = self.partitioned and objecttype in PARTITIONS
+        if self.resume:
+            checkpoint = await self.get_checkpoint(task)
+            if checkpoint is not None:
+                if checkpoint.done:
+                    return
+                # Continue the way the previous run started, partitioned runs store no next link
+                partitioned = checkpoint.nextLink is None
+        # Keys of the objects that still exist, when updating a database in place
+        seen = set() if self.refresh else None
+        if not partitioned:
+            await self.dump_cursor(url, dbtype, task, method, seen)
+        else:
+            await self.writer.put(commitcursor, task, None, False)
+            prop, prefixes = PARTITIONS[objecttype]
+            async def jobs():
+                for prefix in prefixes:
+                    yield self.dump_cursor(url + '&$filter=' + partition_filter(prop, prefix), dbtype, '%s:%s' % (task, prefix), method, seen)
+            await run_workers(jobs())
+            await self.writer.put(commitcursor, task, None, True)
+        # Objects committed by an interrupted run are not seen again when resuming
+        if seen is not None and not self.resume:
+            await self.remove_stale(objecttype, dbtype, seen)
+
+    async def remove_stale(self, objecttype, dbtype, seen):
+        '''
+        Remove the objects that were stored by a previous gather, but
+        were not returned anymore since they were deleted from the directory
+        '''
+        key = list(dbtype.__table__.primary_key)[0]
+        stale = set(objectid for objectid, in await self.writer.fetchall(select(key))) - seen
+        if stale:
+            print('Removing {0} {1} that no longer exist'.format(len(stale), objecttype))
+            await self.writer.put(remove_objects, dbtype, stale)
+
+    async def dump_cursor(self, url, dbtype, task, method, seen=None):
+        '''
+        Page through a collection, committing the objects together with
+        the next link, so a resumed run continues after the last commit
+        '''
+        if self.resume:
+            checkpoint = await self.get_checkpoint(task)
+            if checkpoint is not None:
+                if checkpoint.done:
+                    return
+                # Continue after the last committed page
+                url = checkpoint.nextLink
+                print('Resuming {0} from last committed page'.format(task))
+        key = list(dbtype.__table__.primary_key)[0].name
+        cache = []
+        async for page, nexturl in dumppages(self.ctx, url, method=method):
+            cache.extend(page)
+            if seen is not None:
+                seen.update(obj[key] for obj in page)
+            # Only commit on page boundaries, so the next link is the exact point to resume from
+            if len(cache) > 1000 and nexturl:
+                await self.writer.put(commitpage, dbtype, cache, task, nexturl, False, self.refresh)
+                cache = []
+        await self.writer.put(commitpage, dbtype, cache, task, None, True, self.refresh)
+
+    async def dump_delta(self, objecttype, dbtype, method=None):
+        '''
+        Dump the changes to a collection since the previous run using differential query.
+        Changed objects are updated in the database, deleted objects are removed.
+        Without a stored delta link, all objects are returned as changed.
+        '''
+        if method is None:
+            method = self.ahsession.get
+        task = 'delta:' + objecttype
+        checkpoint = await self.get_checkpoint(task)
+        if checkpoint is not None and checkpoint.nextLink:
+            url = mknext(checkpoint.nextLink, '')
+        else:
+            print('No delta link stored for {0}, collecting all objects'.format(objecttype))
+            url = self.baseurl + '/%s/%s?api-version=%s&deltaLink=' % (self.tenantid, objecttype, self.api_version)
+        changed = self.changed.setdefault(objecttype, set())
+        deleted = set()
+        delta = {}
         cache = []
-        async for obj in dumphelper(url, method=method):
-            cache.append(obj)
+        async for page, _ in dumppages(self.ctx, url, method=method, delta=delta):
+            for obj in page:
+                if obj.get('odata.type') == 'Microsoft.DirectoryServices.DirectoryLinkChange':
+                    # Membership changes, these are refreshed for the source object
+                    changed.add(obj['sourceObjectId'])
+                elif obj.get('aad.isDeleted'):
+                    deleted.add(obj['objectId'])
+                else:
+                    changed.add(obj['objectId'])
+                    cache.append(obj)
             if len(cache) > 1000:
-                commit(self.engine, dbtype, cache)
-                del cache[:]
+                await self.writer.put(commit, dbtype, cache, False, True)
+                cache = []
         if len(cache) > 0:
-            commit(self.engine, dbtype, cache)
+            await self.writer.put(commit, dbtype, cache, False, True)
+        if deleted:
+            await self.writer.put(remove_objects, dbtype, deleted)
+            changed.difference_update(deleted)
+        print('Collected {0} changed and {1} deleted {2}'.format(len(changed), len(deleted), objecttype))
+        if 'deltaLink' in delta:
+            await self.writer.put(commitcursor, task, delta['deltaLink'], True)
+        else:
+            print('No delta link received for {0}, the next incremental run will collect these changes again'.format(objecttype))
 
-    async def dump_l_to_db(self, url, method, mapping, linkname, childtbl, parent):
-        global groupcounter, totalgroups, devicecounter, totaldevices
-        i = 0
-        async for obj in dumphelper(url, method=method):
-            objectid, objclass = obj['url'].split('/')[-2:]
-            # If only one type exists, we don't need to use the mapping
-            if mapping is not None:
-                try:
-                    childtbl, linkname = mapping[objclass]
-                except KeyError:
-                    print('Unsupported member type: %s for parent %s' % (objclass, parent.__table__))
-                    continue
-            child = self.session.query(childtbl).get(objectid)
-            if not child:
-                try:
-                    parentname = parent.displayName
-                except AttributeError:
-                    parentname = parent.objectId
-                print('Non-existing child found on %s %s: %s' % (parent.__table__, parentname, objectid))
-                continue
-            getattr(parent, linkname).append(child)
-            i += 1
-            if i > 1000:
-                self.session.commit()
-                i = 0
-        if str(parent.__table__) == 'Groups':
-            groupcounter += 1
-            print('Done processing {0}/{1} groups'.format(int(groupcounter/2), totalgroups), end='\r')
+    async def dump_l_to_db(self, url, method, mapping, parenttbl, parentid, parentname, task=None):
+        try:
+            await self.dump_l_to_linktables(url, method, mapping, parenttbl, parentid, parentname)
+        except RequestFailed:
+            # Remove what was written already, so the parent can be processed again
+            for linktable, leftcol in set((linktable, leftcol) for _, linktable, leftcol, _ in filter(None, mapping.values())):
+                await self.writer.put(delete_in, linktable, leftcol, [parentid])
+            raise
+        if task:
+            await self.finish_parents(task, [parentid])
+        if str(parenttbl.__table__) == 'Groups':
+            self.ctx.groupcounter += 1
+            print('Done processing {0}/{1} groups'.format(int(self.ctx.groupcounter/2), self.ctx.totalgroups), end='\r')
 
-    async def dump_l_to_linktable(self, url, method, mapping, parentid, objecttype):
-        global groupcounter, totalgroups, devicecounter, totaldevices
+    async def dump_l_to_linktables(self, url, method, mapping, parenttbl, parentid, parentname):
         i = 0
         cache = {}
-        async for obj in dumphelper(url, method=method):
+        async for obj in dumphelper(self.ctx, url, method=method):
             objectid, objclass = obj['url'].split('/')[-2:]
-            # If only one type exists, we don't need to use the mapping
-            if mapping is not None:
-                try:
-                    linktable, leftcol, rightcol = mapping[objclass]
-                except KeyError:
-                    print('Unsupported member type: %s for parent %s' % (objclass, objecttype))
-                    continue
+            try:
+                # If only one type exists, we don't need to use the mapping
+                link = mapping.get(None) or mapping[objclass]
+            except KeyError:
+                print('Unsupported member type: %s for parent %s' % (objclass, parenttbl.__table__))
+                continue
+            if link is None:
+                # Stored by another task
+                continue
+            childtbl, linktable, leftcol, rightcol = link
+            if self.objectindex.get(objectid) is not childtbl:
+                print('Non-existing child found on %s %s: %s' % (parenttbl.__table__, parentname or parentid, objectid))
+                continue
             try:
                 cache[linktable].append({leftcol: parentid, rightcol: objectid})
             except KeyError:
                 cache[linktable] = [{leftcol: parentid, rightcol: objectid}]
             i += 1
             if i > 1000:
-                commitlink(self.session, cache)
+                await self.writer.put(commitlink, cache)
                 cache = {}
                 i = 0
-        commitlink(self.session, cache)
-        if str(objecttype) == 'groups':
-            groupcounter += 1
-            print('Done processing {0}/{1} groups {2}/{3} devices'.format(int(groupcounter/2), totalgroups, devicecounter, totaldevices), end='\r')
-        if str(objecttype) == 'devices':
-            devicecounter += 1
-            print('Done processing {0}/{1} groups {2}/{3} devices'.format(int(groupcounter/2), totalgroups, devicecounter, totaldevices), end='\r')
-
-    async def dump_links(self, objecttype, linktype, parenttbl, mapping=None, linkname=None, childtbl=None, method=None):
+        if cache:
+            await self.writer.put(commitlink, cache)
+
+    async def dump_links(self, objecttype, linktype, parenttbl, mapping=None, linkname=None, childtbl=None, method=None, exclude=(), expand=False):
         if method is None:
             method = self.ahsession.get
-        parents = self.session.query(parenttbl).all()
-        jobs = []
-        i = 0
-        for parent in parents:
-            url = 'https://graph.windows.net/%s/%s/%s/$links/%s?api-version=%s' % (self.tenantid, objecttype, parent.objectId, linktype, self.api_version)
-            jobs.append(self.dump_l_to_db(url, method, mapping, linkname, childtbl, parent))
-            i += 1
-            # Chunk it to avoid huge memory usage
-            if i > 1000:
-                await asyncio.gather(*jobs)
-                del jobs[:]
-                i = 0
-        await asyncio.gather(*jobs)
-        self.session.commit()
+        task = 'links:%s/%s' % (objecttype, linktype)
+        selected = await self.select_parents(task, objecttype, mapping_linktables(parenttbl, mapping, linkname))
+        linkmapping = relationship_mapping(parenttbl, mapping, linkname, childtbl)
+        if expand:
+            capped = await self.expand_links(objecttype, linktype, parenttbl, linkmapping, task, selected, method)
+            await self.follow_links(objecttype, linktype, parenttbl, linkmapping, task, iterate(capped), method)
+            return
+        async def parents():
+            async for parentid, parentname in self.stream_parents(parenttbl, parenttbl.displayName):
+                if selected(parentid) and parentid not in exclude:
+                    yield parentid, parentname
+        await self.follow_links(objecttype, linktype, parenttbl, linkmapping, task, parents(), method)
+
+    async def follow_links(self, objecttype, linktype, parenttbl, linkmapping, task, parents, method):
+        '''
+        Dump the links of each parent from the async iterable parents, with a request chain per parent
+        '''
+        async def jobs():
+            async for parentid, parentname in parents:
+                url = self.baseurl + '/%s/%s/%s/$links/%s?api-version=%s' % (self.tenantid, objecttype, parentid, linktype, self.api_version)
+                if self.pagesize:
+                    url += '&$top=%d' % self.pagesize
+                yield self.guard(task, self.dump_l_to_db, url, method, linkmapping, parenttbl, parentid, parentname, task=task)
+        await run_workers(jobs())
+        await self.retry_deadletters(task)
+
+    async def expand_links(self, objecttype, linktype, parenttbl, linkmapping, task, selected, method):
+        '''
+        Dump links by expanding them on the listing of the parents, which takes a request
+        per page of parents instead of one per parent. Returns the parents of which the
+        expanded links were cut off at the expansion limit, these need separate requests.
+
+        Incremental runs request the links of the changed parents separately instead,
+        unless listing all parents takes fewer requests.
+        '''
+        if self.changed is not None and objecttype in self.changed:
+            changed = self.changed[objecttype]
+            parents = sum(1 for dbtype in self.objectindex.values() if dbtype is parenttbl)
+            if len(changed) <= math.ceil(parents / DEFAULT_PAGE_SIZE):
+                return [(parentid, parentname) async for parentid, parentname in self.stream_parents(parenttbl, parenttbl.displayName)
+                        if parentid in changed]
+        url = self.baseurl + '/%s/%s?api-version=%s&$expand=%s' % (self.tenantid, objecttype, self.api_version, linktype)
+        capped = []
+        expanded = 0
+        requests = 0
+        async for page, _ in dumppages(self.ctx, url, method=method):
+            requests += 1
+            cache = {}
+            finished = []
+            for obj in page:
+                parentid = obj['objectId']
+                if not selected(parentid):
+                    continue
+                if self.objectindex.get(parentid) is not parenttbl:
+                    print('Non-existing parent found during expansion %s %s: %s' % (parenttbl.__table__, linktype, parentid))
+                    continue
+                if len(obj[linktype]) >= EXPAND_LIMIT:
+                    capped.append((parentid, obj.get('displayName')))
+                    continue
+                for child in obj[linktype]:
+                    try:
+                        link = linkmapping.get(None) or linkmapping[child['odata.type']]
+                    except KeyError:
+                        print('Unsupported member type: %s for parent %s' % (child['odata.type'], parenttbl.__table__))
+                        continue
+                    if link is None:
+                        continue
+                    childtbl, linktable, leftcol, rightcol = link
+                    if self.objectindex.get(child['objectId']) is not childtbl:
+                        print('Non-existing child found on %s %s: %s' % (parenttbl.__table__, obj.get('displayName') or parentid, child['objectId']))
+                        continue
+                    cache.setdefault(linktable, []).append({leftcol: parentid, rightcol: child['objectId']})
+                finished.append(parentid)
+            if cache:
+                await self.writer.put(commitlink, cache)
+            await self.finish_parents(task, finished)
+            expanded += len(finished)
+            if parenttbl is Group:
+                self.ctx.groupcounter += len(finished)
+                print('Done processing {0}/{1} groups'.format(int(self.ctx.groupcounter/2), self.ctx.totalgroups), end='\r')
+        print('Expanded {0} of {1} objects with {2} requests, {3} objects reached the expansion limit and are requested separately'.format(
+            linktype, expanded, requests, len(capped)))
+        return capped
 
-    async def dump_links_with_queue(self, queue, objecttype, linktype, parenttbl, mapping=None, method=None):
+    async def dump_group_members(self, mapping, method=None):
+        '''
+        Fill the group membership tables from the cheapest direction: the members
+        of each group, or the groups that each object is a member of.
+        Members of groups are expanded on the listing of the groups, only the groups
+        with more members than the expansion limit need a request of their own.
+        '''
         if method is None:
             method = self.ahsession.get
-        parents = self.session.query(parenttbl.objectId).all()
-        jobs = []
-        for parentid, in parents:
-            url = 'https://graph.windows.net/%s/%s/%s/$links/%s?api-version=%s' % (self.tenantid, objecttype, parentid, linktype, self.api_version)
-            # Chunk it to avoid huge memory usage
-            await queue.put(self.dump_l_to_linktable(url, method, mapping, parentid, objecttype))
-        await queue.join()
-        self.session.commit()
+        task = 'links:groups/members'
+        direction = await self.membership_direction()
+        if direction != 'auto':
+            # Resumed runs continue in the same direction
+            await self.writer.put(commitstate, 'membership:groups', direction)
+        unified = set()
+        if direction != 'members':
+            linktables = mapping_linktables(Group, mapping)
+            selected = await self.select_parents(task, 'groups', linktables)
+            linkmapping = relationship_mapping(Group, mapping)
+            capped = await self.expand_links('groups', 'members', Group, linkmapping, task, selected, method)
+            if direction == 'auto':
+                unified = await self.unified_groups()
+                tables = collections.Counter(self.objectindex.values())
+                permember = sum(tables[dbtype] for dbtype in MEMBER_COLLECTIONS.values()) - len(unified)
+                if len(capped) <= permember:
+                    direction = 'groups'
+                    print('Collecting members of {0} large groups per group: {1} requests fewer than per member object'.format(len(capped), permember - len(capped)))
+                else:
+                    direction = 'members'
+                    print('Collecting group memberships per member object: {0} requests fewer than for {1} large groups'.format(len(capped) - permember, len(capped)))
+                    # Start over from the other direction
+                    for linktable, _ in linktables:
+                        await self.writer.execute(linktable.delete())
+                    checkpoints = GatherCheckpoint.__table__
+                    await self.writer.execute(checkpoints.delete().where(checkpoints.c.task == task))
+                await self.writer.put(commitstate, 'membership:groups', direction)
+            if direction == 'groups':
+                await self.follow_links('groups', 'members', Group, linkmapping, task, iterate(capped), method)
+                return
+        else:
+            unified = await self.unified_groups()
+        for objecttype, membertbl in MEMBER_COLLECTIONS.items():
+            # Microsoft 365 groups can not be a member of other groups
+            exclude = unified if membertbl is Group else ()
+            await self.dump_links(objecttype, 'memberOf', membertbl, mapping=MEMBEROF_MAPPING, method=method, exclude=exclude)
 
-    async def dump_mfa_to_db(self, url, method, parentid, cache):
-        obj = await dumpsingle(url, method=method)
+    async def membership_direction(self):
+        '''
+        Direction to collect group memberships from, which is auto if it depends on
+        the number of large groups. Resumed runs use the direction decided before.
+        '''
+        if self.changed is not None:
+            # Membership changes are tracked per group
+            return 'groups'
+        if self.resume:
+            checkpoint = await self.get_checkpoint('membership:groups')
+            if checkpoint is not None:
+                return checkpoint.state
+        return self.membership
+
+    async def unified_groups(self):
+        '''
+        The objectIds of all Microsoft 365 groups
+        '''
+        unified = set()
+        async for groupid, grouptypes in self.stream_parents(Group, Group.groupTypes):
+            if grouptypes and 'Unified' in grouptypes:
+                unified.add(groupid)
+        return unified
+
+    async def dump_mfa_to_db(self, url, method, parenttbl, parentid, cache):
+        obj = await dumpsingle(self.ctx, url, method=method, batcher=self.batcher)
         if not obj:
             return
         cache.append({'userid':parentid,'strongAuthenticationDetail':obj['strongAuthenticationDetail']})
+        if len(cache) > 1000:
+            objects = cache[:]
+            del cache[:]
+            await self.writer.put(commitmfa, parenttbl, objects)
 
     async def dump_mfa(self, objecttype, parenttbl, method=None):
         if method is None:
             method = self.ahsession.get
-        parents = self.session.query(parenttbl.objectId).all()
-        jobs = []
+        task = '%s/strongAuthenticationDetail' % objecttype
+        if await self.task_completed(task):
+            return
+        selected = await self.select_parents('task:' + task, objecttype)
         cache = []
-        i = 0
-        for parentid, in parents:
-            url = 'https://graph.windows.net/%s/%s/%s?api-version=%s&$select=strongAuthenticationDetail,objectId' % (self.tenantid, objecttype, parentid, self.api_version)
-            jobs.append(self.dump_mfa_to_db(url, method, parentid, cache))
-            i += 1
-            # Chunk it to avoid huge memory usage
-            if i > 1000:
-                await asyncio.gather(*jobs)
-                del jobs[:]
-                commitmfa(self.session, parenttbl, cache)
-                del cache[:]
-                i = 0
-        await asyncio.gather(*jobs)
-        commitmfa(self.session, parenttbl, cache)
-        del cache[:]
+        async def jobs():
+            async for parentid, in self.stream_parents(parenttbl):
+                if not selected(parentid):
+                    continue
+                url = self.baseurl + '/%s/%s/%s?api-version=%s&$select=strongAuthenticationDetail,objectId' % (self.tenantid, objecttype, parentid, self.api_version)
+                yield self.guard(task, self.dump_mfa_to_db, url, method, parenttbl, parentid, cache)
+        await run_workers(jobs())
+        # Failed jobs add to the same cache when they are retried
+        failed = await self.retry_deadletters(task)
+        if len(cache) > 0:
+            await self.writer.put(commitmfa, parenttbl, cache)
+        if not failed:
+            await self.mark_completed(task)
 
-    async def dump_lo_to_db(self, url, method, linkobjecttype, cache, ignore_duplicates=False):
+    async def dump_lo_to_db(self, url, method, linkobjecttype, cache, ignore_duplicates=False, task=None, parentid=None, finished=None):
         """
         Async db dumphelper for multiple linked objects (returned as a list)
         """
-        async for obj in dumphelper(url, method=method):
-            # objectid, objclass = obj['url'].split('/')[-2:]
-            # If only one type exists, we don't need to use the mapping
-            # print(parent.objectId, obj)
-            cache.append(obj)
-            if len(cache) > 1000:
-                commit(self.session, linkobjecttype, cache, ignore=ignore_duplicates)
-                del cache[:]
+        # Only add the objects once all of them are collected, so a failed
+        # request does not leave part of them in the cache
+        parentobjects = []
+        async for obj in dumphelper(self.ctx, url, method=method):
+            parentobjects.append(obj)
+        cache.extend(parentobjects)
+        if task:
+            finished.append(parentid)
+        if len(cache) > 1000:
+            # The cache is shared between jobs, so take over its contents before
+            # waiting on the writer. All objects of the finished parents are
+            # in there, so these are recorded after writing them.
+            objects = cache[:]
+            del cache[:]
+            if task:
+                parentids = finished[:]
+                del finished[:]
+            await self.writer.put(commit, linkobjecttype, objects, ignore_duplicates)
+            if task:
+                await self.finish_parents(task, parentids)
 
-    async def dump_so_to_db(self, url, method, linkobjecttype, cache, ignore_duplicates=False):
+    async def dump_so_to_db(self, url, method, linkobjecttype, cache, ignore_duplicates=False, upsert=False):
         """
         Async db dumphelper for objects that are returned as single objects (direct values)
         """
-        obj = await dumpsingle(url, method=method)
+        obj = await dumpsingle(self.ctx, url, method=method, batcher=self.batcher)
         if not obj:
             return
         cache.append(obj)
         if len(cache) > 1000:
-            commit(self.session, linkobjecttype, cache, ignore=ignore_duplicates)
+            objects = cache[:]
             del cache[:]
+            await self.writer.put(commit, linkobjecttype, objects, ignore_duplicates, upsert)
 
     async def dump_linked_objects(self, objecttype, linktype, parenttbl, linkobjecttype, method=None, ignore_duplicates=False):
         if method is None:
             method = self.ahsession.get
-        parents = self.session.query(parenttbl).all()
+        # Objects linked to parents that were not completed are fetched again,
+        # which relies on duplicates being ignored
+        task = 'linkedobjects:%s/%s' % (objecttype, linktype)
+        # Linked objects can change without a change to their parent, so incremental
+        # runs fetch them for all parents
+        selected = await self.select_parents(task, None)
         cache = []
-        jobs = []
-        for parent in parents:
-            url = 'https://graph.windows.net/%s/%s/%s/%s?api-version=%s' % (self.tenantid, objecttype, parent.objectId, linktype, self.api_version)
-            jobs.append(self.dump_lo_to_db(url, method, linkobjecttype, cache, ignore_duplicates=ignore_duplicates))
-        await asyncio.gather(*jobs)
+        finishedparents = []
+        async def jobs():
+            async for parentid, in self.stream_parents(parenttbl):
+                if not selected(parentid):
+                    continue
+                url = self.baseurl + '/%s/%s/%s/%s?api-version=%s' % (self.tenantid, objecttype, parentid, linktype, self.api_version)
+                yield self.guard(task, self.dump_lo_to_db, url, method, linkobjecttype, cache, ignore_duplicates=ignore_duplicates, task=task, parentid=parentid, finished=finishedparents)
+        await run_workers(jobs())
+        await self.retry_deadletters(task)
         if len(cache) > 0:
-            commit(self.session, linkobjecttype, cache, ignore=ignore_duplicates)
-        self.session.commit()
+            await self.writer.put(commit, linkobjecttype, cache, ignore_duplicates)
+        await self.finish_parents(task, finishedparents)
 
 
+    async def dump_app_role_assignments(self):
+        '''
+        Dump the app role assignments from the resource side. Each assignment
+        is listed on the service principal of its resource, including those of
+        which the principal is a service principal, so asking each service
+        principal for its own assignments as well only returns duplicates.
+        '''
+        await self.dump_linked_objects('servicePrincipals', 'appRoleAssignedTo', ServicePrincipal, AppRoleAssignment, ignore_duplicates=True)
+        skipped = sum(1 for dbtype in self.objectindex.values() if dbtype is ServicePrincipal)
+        print('Collected app role assignments from the resource side only, skipped the assignments of {0} service principals'.format(skipped))
+
     async def dump_object_expansion(self, objecttype, dbtype, expandprop, linkname, childtbl, mapping=None, method=None):
         if method is None:
             method = self.ahsession.get
-        url = 'https://graph.windows.net/%s/%s?api-version=%s&$expand=%s' % (self.tenantid, objecttype, self.api_version, expandprop)
+        url = self.baseurl + '/%s/%s?api-version=%s&$expand=%s' % (self.tenantid, objecttype, self.api_version, expandprop)
+        task = '%s/%s' % (objecttype, expandprop)
+        linktables = [linktable for linktable, _ in mapping_linktables(dbtype, mapping, linkname)]
+        if await self.task_completed(task, cleanup=linktables):
+            return
+        linkmapping = relationship_mapping(dbtype, mapping, linkname, childtbl)
         i = 0
-        async for obj in dumphelper(url, method=method):
+        cache = {}
+        async for obj in dumphelper(self.ctx, url, method=method):
             if len(obj[expandprop]) > 0:
-                parent = self.session.query(dbtype).get(obj['objectId'])
-                if not parent:
-                    print('Non-existing parent found during expansion %s %s: %s' % (dbtype.__table__, expandprop, obj['objectId']))
+                parentid = obj['objectId']
+                if self.objectindex.get(parentid) is not dbtype:
+                    print('Non-existing parent found during expansion %s %s: %s' % (dbtype.__table__, expandprop, parentid))
                     continue
                 for epdata in obj[expandprop]:
                     objclass = epdata['odata.type']
-                    if mapping is not None:
-                        try:
-                            childtbl, linkname = mapping[objclass]
-                        except KeyError:
-                            print('Unsupported member type: %s' % objclass)
-                            continue
-                    child = self.session.query(childtbl).get(epdata['objectId'])
-                    if not child:
+                    try:
+                        childtbl, linktable, leftcol, rightcol = linkmapping.get(None) or linkmapping[objclass]
+                    except KeyError:
+                        print('Unsupported member type: %s' % objclass)
+                        continue
+                    if self.objectindex.get(epdata['objectId']) is not childtbl:
                         print('Non-existing child during expansion %s %s: %s' % (dbtype.__table__, expandprop, epdata['objectId']))
                         continue
-                    getattr(parent, linkname).append(child)
+                    try:
+                        cache[linktable].append({leftcol: parentid, rightcol: epdata['objectId']})
+                    except KeyError:
+                        cache[linktable] = [{leftcol: parentid, rightcol: epdata['objectId']}]
                     i += 1
                     if i > 1000:
-                        self.session.commit()
+                        await self.writer.put(commitlink, cache)
+                        cache = {}
                         i = 0
-        self.session.commit()
+        if cache:
+            await self.writer.put(commitlink, cache)
+        await self.mark_completed(task)
+
+    async def dump_device_owners(self):
+        # Expanding the owners takes the least requests, but does not scale to large tenants
+        if self.ctx.totalgroups > MAX_GROUPS:
+            await self.dump_links('devices', 'registeredOwners', Device, linkname='owner', childtbl=User)
+        else:
+            await self.dump_object_expansion('devices', Device, 'registeredOwners', 'owner', User)
 
     async def dump_keycredentials(self, objecttype, dbtype, method=None):
         if method is None:
             method = self.ahsession.get
+        if await self.task_completed('%s/keyCredentials' % objecttype):
+            return
         cache = []
-        url = 'https://graph.windows.net/%s/%s?api-version=1.61-internal&$select=keyCredentials,objectId' % (self.tenantid, objecttype)
-        async for obj in dumphelper(url, method=method):
+        url = self.baseurl + '/%s/%s?api-version=1.61-internal&$select=keyCredentials,objectId' % (self.tenantid, objecttype)
+        async for obj in dumphelper(self.ctx, url, method=method):
             cache.append({'userid':obj['objectId'], 'keyCredentials':obj['keyCredentials']})
             if len(cache) > 1000:
-                commitmfa(self.session, dbtype, cache)
-                del cache[:]
+                await self.writer.put(commitmfa, dbtype, cache)
+                cache = []
         if len(cache) > 0:
-            commitmfa(self.session, dbtype, cache)
-        del cache[:]
+            await self.writer.put(commitmfa, dbtype, cache)
+        await self.mark_completed('%s/keyCredentials' % objecttype)
 
     async def dump_apps_from_list(self, parents, endpoint, dbtype, ignore_duplicates=True):
         cache = []
-        jobs = []
-        for parentid in parents:
-            url = 'https://graph.windows.net/%s/%s/%s?api-version=%s' % (self.tenantid, endpoint, parentid, self.api_version)
-            jobs.append(self.dump_so_to_db(url, self.ahsession.get, dbtype, cache, ignore_duplicates=ignore_duplicates))
-        await asyncio.gather(*jobs)
+        async def jobs():
+            for parentid in parents:
+                url = self.baseurl + '/%s/%s/%s?api-version=%s' % (self.tenantid, endpoint, parentid, self.api_version)
+                yield self.dump_so_to_db(url, self.ahsession.get, dbtype, cache, ignore_duplicates=ignore_duplicates)
+        await run_workers(jobs())
         if len(cache) > 0:
-            commit(self.session, dbtype, cache, ignore=ignore_duplicates)
-        self.session.commit()
+            await self.writer.put(commit, dbtype, cache, ignore_duplicates)
 
-    async def dump_each(self, parenttbl, endpoint, dbtype, ignore_duplicates=True):
-        parents = self.session.query(parenttbl).all()
+    async def dump_each(self, parentobjecttype, parenttbl, endpoint, dbtype, ignore_duplicates=True):
+        if await self.task_completed(endpoint):
+            return
+        selected = await self.select_parents('task:' + endpoint, parentobjecttype)
+        # Objects of changed parents replace those of the previous run
+        upsert = self.changed is not None
         cache = []
-        jobs = []
-        for parent in parents:
-            url = 'https://graph.windows.net/%s/%s/%s?api-version=%s' % (self.tenantid, endpoint, parent.appId, self.api_version)
-            jobs.append(self.dump_so_to_db(url, self.ahsession.get, dbtype, cache, ignore_duplicates=ignore_duplicates))
-        await asyncio.gather(*jobs)
+        async def jobs():
+            async for parentid, appid in self.stream_parents(parenttbl, parenttbl.appId):
+                if not selected(parentid):
+                    continue
+                url = self.baseurl + '/%s/%s/%s?api-version=%s' % (self.tenantid, endpoint, appid, self.api_version)
+                yield self.guard(endpoint, self.dump_so_to_db, url, self.ahsession.get, dbtype, cache,
+                                 ignore_duplicates=ignore_duplicates, upsert=upsert)
+        await run_workers(jobs())
+        failed = await self.retry_deadletters(endpoint)
         if len(cache) > 0:
-            commit(self.session, dbtype, cache, ignore=ignore_duplicates)
-        self.session.commit()
+            await self.writer.put(commit, dbtype, cache, ignore_duplicates, upsert)
+        if not failed:
+            await self.mark_completed(endpoint)
 
     async def dump_custom_role_members(self, dbtype):
-        parents = self.session.query(RoleDefinition).all()
+        if await self.task_completed('roleAssignments', cleanup=[dbtype.__table__]):
+            return
         cache = []
-        jobs = []
-        for parent in parents:
-            url = 'https://graph.windows.net/%s/roleAssignments?api-version=%s&$filter=roleDefinitionId eq \'%s\'' % (self.tenantid, self.api_version, parent.objectId)
-            jobs.append(self.dump_lo_to_db(url, self.ahsession.get, dbtype, cache))
-        await asyncio.gather(*jobs)
+        async def jobs():
+            async for parentid, in self.stream_parents(RoleDefinition):
+                url = self.baseurl + '/%s/roleAssignments?api-version=%s&$filter=roleDefinitionId eq \'%s\'' % (self.tenantid, self.api_version, parentid)
+                yield self.guard('roleAssignments', self.dump_lo_to_db, url, self.ahsession.get, dbtype, cache)
+        await run_workers(jobs())
+        failed = await self.retry_deadletters('roleAssignments')
         if len(cache) > 0:
-            commit(self.session, dbtype, cache)
-        self.session.commit()
+            await self.writer.put(commit, dbtype, cache)
+        if not failed:
+            await self.mark_completed('roleAssignments')
 
     async def dump_eligible_role_members(self, dbtype):
-        parents = self.session.query(RoleDefinition).all()
+        if await self.task_completed('eligibleRoleAssignments', cleanup=[dbtype.__table__]):
+            return
         cache = []
-        jobs = []
-        for parent in parents:
-            url = 'https://graph.windows.net/%s/eligibleRoleAssignments?api-version=%s&$filter=roleDefinitionId eq \'%s\'' % (self.tenantid, self.api_version, parent.objectId)
-            jobs.append(self.dump_lo_to_db(url, self.ahsession.get, dbtype, cache))
-        await asyncio.gather(*jobs)
+        async def jobs():
+            async for parentid, in self.stream_parents(RoleDefinition):
+                url = self.baseurl + '/%s/eligibleRoleAssignments?api-version=%s&$filter=roleDefinitionId eq \'%s\'' % (self.tenantid, self.api_version, parentid)
+                yield self.guard('eligibleRoleAssignments', self.dump_lo_to_db, url, self.ahsession.get, dbtype, cache)
+        await run_workers(jobs())
+        failed = await self.retry_deadletters('eligibleRoleAssignments')
         if len(cache) > 0:
-            commit(self.session, dbtype, cache)
-        self.session.commit()
-
-async def run(args):
-    global token, expiretime, headers, totalgroups, totaldevices, dburl
-    if 'tenantId' in token:
-        tenantid = token['tenantId']
-    elif args.tenant:
-        tenantid = args.tenant
+            await self.writer.put(commit, dbtype, cache)
+        if not failed:
+            await self.mark_completed('eligibleRoleAssignments')
+
+class GatherPlan(object):
+    '''
+    Takes the place of the DataDumper in the gather tasks to estimate the number
+    of requests of each task, from the number of objects in each collection
+    '''
+    def __init__(self, counts, args, members=None):
+        self.counts = counts
+        self.args = args
+        self.pagesize = args.page_size or DEFAULT_PAGE_SIZE
+        # Number of members of each group from a previous gather, None if unknown
+        self.members = members
+        # Requests of all tasks that share the $batch endpoint
+        self.batchrequests = 0
+
+    def pages(self, objects, pagesize=None):
+        # Empty collections still take a request
+        return max(1, math.ceil(objects / (pagesize or DEFAULT_PAGE_SIZE)))
+
+    def batched(self, requests):
+        if self.args.batch:
+            requests = math.ceil(requests / self.args.batch_size)
+            self.batchrequests += requests
+        return requests
+
+    def large_groups(self):
+        '''
+        Requests for the groups with more members than fit in an expansion
+        '''
+        if self.members is None:
+            return 0
+        return sum(self.pages(members, self.pagesize) for members in self.members.values() if members >= EXPAND_LIMIT)
+
+    def dump_object(self, objecttype, dbtype, method=None):
+        if objecttype not in LARGE_COLLECTIONS:
+            return self.pages(self.counts.get(objecttype, 0))
+        requests = self.pages(self.counts[objecttype], self.pagesize)
+        if self.args.partitioned and objecttype in PARTITIONS:
+            # Each partition ends with a page that is not full
+            requests += len(PARTITIONS[objecttype][1])
+        return requests
+
+    def dump_delta(self, objecttype, dbtype, method=None):
+        return self.pages(self.counts[objecttype])
+
+    def dump_links(self, objecttype, linktype, parenttbl, mapping=None, linkname=None, childtbl=None, method=None, exclude=(), expand=False):
+        if expand:
+            return self.pages(self.counts[objecttype])
+        return self.counts[objecttype]
+
+    def dump_group_members(self, mapping, method=None):
+        if self.args.membership == 'members':
+            return sum(self.counts[objecttype] for objecttype in MEMBER_COLLECTIONS)
+        return self.pages(self.counts['groups']) + self.large_groups()
+
+    def dump_device_owners(self):
+        if self.counts['groups'] > MAX_GROUPS:
+            return self.counts['devices']
+        return self.pages(self.counts['devices'])
+
+    def dump_linked_objects(self, objecttype, linktype, parenttbl, linkobjecttype, method=None, ignore_duplicates=False):
+        return self.counts[objecttype]
+
+    def dump_app_role_assignments(self):
+        return self.counts['servicePrincipals']
+
+    def dump_object_expansion(self, objecttype, dbtype, expandprop, linkname, childtbl, mapping=None, method=None):
+        return self.pages(self.counts[objecttype])
+
+    def dump_custom_role_members(self, dbtype):
+        return self.counts['roleDefinitions']
+
+    def dump_eligible_role_members(self, dbtype):
+        return self.counts['roleDefinitions']
+
+    def dump_each(self, parentobjecttype, parenttbl, endpoint, dbtype, ignore_duplicates=True):
+        return self.batched(self.counts[parentobjecttype])
+
+    def dump_keycredentials(self, objecttype, dbtype, method=None):
+        return self.pages(self.counts[objecttype])
+
+    def dump_mfa(self, objecttype, parenttbl, method=None):
+        return self.batched(self.counts[objecttype])
+
+    def database_size(self, links=None):
+        '''
+        Expected size of the database in bytes. Without the number of links from
+        a previous gather, each group is assumed to have PLAN_MEMBERS_PER_GROUP members.
+        '''
+        size = sum(self.counts[objecttype] * PLAN_ROW_SIZE.get(dbtype.__tablename__, PLAN_ROW_SIZE[None])
+                   for objecttype, dbtype in PLAN_COLLECTIONS.items())
+        if links is None:
+            links = self.counts['groups'] * PLAN_MEMBERS_PER_GROUP
+        return size + links * PLAN_ROW_SIZE['lnk']
+
+def plan_counts_from_db(dburl):
+    '''
+    Number of objects in each collection, the number of members of each group
+    and the total number of links from an existing database. Returns None if
+    the database does not contain a previous gather.
+    '''
+    if dburl.startswith('sqlite:///') and not os.path.exists(dburl[len('sqlite:///'):]):
+        return None
+    engine = database.init(dburl=dburl)
+    if not inspect(engine).has_table(User.__tablename__):
+        return None
+    session = database.get_session(engine)
+    counts = {objecttype: session.query(func.count(dbtype.objectId)).scalar() for objecttype, dbtype in PLAN_COLLECTIONS.items()}
+    if counts['users'] == 0:
+        return None
+    members = collections.Counter()
+    for linkname in ('memberUsers', 'memberGroups', 'memberContacts', 'memberDevices', 'memberServicePrincipals'):
+        linktable, groupcol, _ = relationship_link(Group, linkname)
+        for groupid, count in session.execute(select(linktable.c[groupcol], func.count()).group_by(linktable.c[groupcol])):
+            members[groupid] += count
+    links = 0
+    for table in database.Base.metadata.tables.values():
+        if table.name.startswith('lnk_'):
+            links += session.execute(select(func.count()).select_from(table)).scalar()
+    session.close()
+    return counts, members, links
+
+async def plan_counts_from_api(ctx, args):
+    '''
+    Number of objects in each collection, from $count where the directory
+    supports it and by listing the objectIds of the collection otherwise
+    '''
+    counts = {}
+    async with aiohttp.ClientSession(connector=create_connector(args)) as ahsession:
+        for objecttype in PLAN_COLLECTIONS:
+            url = ctx.baseurl + '/%s/%s/$count?api-version=1.61-internal' % (ctx.tenantid, objecttype)
+            await ctx.tokens.check()
+            ctx.urlcounter += 1
+            async with ahsession.get(url, headers=ctx.headers, proxy=ctx.proxy) as res:
+                if res.status == 200:
+                    counts[objecttype] = int(await res.text())
+                    continue
+            url = ctx.baseurl + '/%s/%s?api-version=1.61-internal' % (ctx.tenantid, objecttype)
+            if objecttype in LARGE_COLLECTIONS:
+                url += '&$select=objectId&$top=%d' % MAX_PAGE_SIZE
+            counts[objecttype] = 0
+            async for page, _ in dumppages(ctx, url, method=ahsession.get):
+                counts[objecttype] += len(page)
+    return counts
+
+def run_plan(args, token, baseurl=None):
+    '''
+    Print the expected number of requests of each gather task, the time
+    these take at the maximum request rate and the size of the database
+    '''
+    ctx = GatherContext(token, get_dburl(args.database), tenantid=args.tenant, retries=args.retries, proxy=args.proxy,
+                        baseurl=baseurl)
+    result = plan_counts_from_db(ctx.dburl)
+    if result is not None:
+        counts, members, links = result
+        print('Planning gather of tenant {0} with the object counts of {1}'.format(ctx.tenantid, args.database))
     else:
-        tenantid = 'myorganization'
-    expiretime = time.mktime(time.strptime(token['expiresOn'].split('.')[0], '%Y-%m-%d %H:%M:%S'))
-    headers = {
-        'Authorization': '%s %s' % (token['tokenType'], token['accessToken'])
-    }
-    if not checktoken():
+        counts = asyncio.get_event_loop().run_until_complete(plan_counts_from_api(ctx, args))
+        members = links = None
+        print('Planning gather of tenant {0} with the object counts from the API ({1} requests)'.format(ctx.tenantid, ctx.urlcounter))
+    for objecttype, count in counts.items():
+        print('{0:<40} {1:>10} objects'.format(objecttype, count))
+    plan = GatherPlan(counts, args, members)
+    print('')
+    total = 0
+    # Requests per endpoint, each task requests its own endpoint apart from the batched requests
+    endpoints = {}
+    for task in select_tasks(gather_tasks(plan, args), args.only, args.exclude):
+        batchrequests = plan.batchrequests
+        requests = task.run()
+        total += requests
+        endpoints[task.name] = requests - (plan.batchrequests - batchrequests)
+        print('{0:<40} {1:>10} requests'.format(task.name, requests))
+    endpoints['$batch'] = plan.batchrequests
+    print('{0:<40} {1:>10} requests'.format('Total', total))
+    if members is None:
+        print('Groups with more than {0} members take additional requests, which are not known before the first gather'.format(EXPAND_LIMIT - 1))
+    # The rate limit is per endpoint, so the endpoint with the most requests bounds the wall time
+    ratelimiter = AdaptiveRateLimiter(initial_rate=args.initial_rate, max_rate=args.max_rate)
+    endpoint = max(endpoints, key=endpoints.get)
+    print('Expected wall time: at least {0:0.1f} seconds for the {1} requests of {2}, starting at {3:0.0f} and increasing up to {4:0.0f} requests per second'.format(
+          ratelimiter.duration(endpoints[endpoint]), endpoints[endpoint], endpoint, ratelimiter.initial_rate, ratelimiter.max_rate))
+    print('Expected database size: {0:0.1f} MB'.format(plan.database_size(links) / 1048576.0))
+
+async def run(ctx, args, connector=None):
+    '''
+    Gather a tenant. The connection pool is created for this run,
+    unless a connector is passed to share between runs.
+    '''
+    if not await ctx.tokens.check():
         return
     # Recreate DB
 
-    if args.skip_first_phase:
+    # Tasks that are not selected keep their tables as they are
+    selective = bool(args.only or args.exclude)
+    if args.skip_first_phase or args.resume or args.incremental or selective:
         destroy_db = False
     else:
         destroy_db = True
 
-    engine = database.init(destroy_db, dburl=dburl)
-    dumper = DataDumper(tenantid, '1.61-internal', engine=engine)
-    if not args.skip_first_phase:
-        async with aiohttp.ClientSession() as ahsession:
-            print('Starting data gathering phase 1 of 2 (collecting objects)')
-            dumper.ahsession = ahsession
-            tasks = []
-            tasks.append(dumper.dump_object('users', User))
-            tasks.append(dumper.dump_object('tenantDetails', TenantDetail))
-            tasks.append(dumper.dump_object('policies', Policy))
-            tasks.append(dumper.dump_object('servicePrincipals', ServicePrincipal))
-            tasks.append(dumper.dump_object('groups', Group))
-            tasks.append(dumper.dump_object('administrativeUnits', AdministrativeUnit))
-
-            tasks.append(dumper.dump_object('applications', Application))
-            tasks.append(dumper.dump_object('devices', Device))
-            # tasks.append(dumper.dump_object('domains', Domain))
-            tasks.append(dumper.dump_object('directoryRoles', DirectoryRole))
-            tasks.append(dumper.dump_object('roleDefinitions', RoleDefinition))
-            # tasks.append(dumper.dump_object('roleAssignments', RoleAssignment))
-            tasks.append(dumper.dump_object('contacts', Contact))
-            # tasks.append(dumper.dump_object('getAvailableExtensionProperties', ExtensionProperty, method=ahsession.post))
-            tasks.append(dumper.dump_object('oauth2PermissionGrants', OAuth2PermissionGrant))
-            tasks.append(dumper.dump_object('authorizationPolicy', AuthorizationPolicy))
-            tasks.append(dumper.dump_object('settings', DirectorySetting))
-            await asyncio.gather(*tasks)
-
-    Session = sessionmaker(bind=engine)
-    dbsession = Session()
+    engine = database.init(destroy_db, dburl=ctx.dburl)
+    if not destroy_db:
+        # Create missing tables, such as the checkpoint table for databases
+        # created by older versions, or all tables for a first incremental run
+        database.Base.metadata.create_all(engine)
+    writer = DatabaseWriter(engine, maxsize=args.write_queue_size)
+    writer.start()
+    dumper = DataDumper(ctx, '1.61-internal', writer=writer, resume=args.resume, incremental=args.incremental,
+                        selectprofile=args.select_profile, pagesize=args.page_size, partitioned=args.partitioned,
+                        membership=args.membership, refresh=selective)
+    alltasks = gather_tasks(dumper, args)
+    tasks = select_tasks(alltasks, args.only, args.exclude)
+    if selective:
+        missing = await missing_dependencies(dumper, tasks, alltasks)
+        if missing:
+            for table, provider in missing:
+                print('The selected tasks require {0}, which is not in the database. Select the {1} task to gather it'.format(table, provider))
+            await writer.close()
+            return
+    if args.archive:
+        ctx.archive = ResponseArchive(args.archive, ctx.tenantid, selectprofile=args.select_profile,
+                                      pagesize=args.page_size, partitioned=args.partitioned, membership=args.membership,
+                                      baseurl=ctx.baseurl)
+    if args.incremental:
+        # Collections without differential query are collected again completely
+        await writer.put(clear_tables, [TenantDetail, Policy, AdministrativeUnit, Application, DirectoryRole, RoleDefinition,
+                              OAuth2PermissionGrant, AuthorizationPolicy, DirectorySetting])
+        await writer.execute(AppRoleAssignment.__table__.delete())
 
-    if args.skip_first_phase:
-        # Delete existing links to make sure we start with clean data
-        for table in database.Base.metadata.tables.keys():
-            if table.startswith('lnk_'):
-                dbsession.execute("DELETE FROM {0}".format(table))
-        dbsession.query(ApplicationRef).delete()
-        dbsession.query(RoleAssignment).delete()
-        dbsession.query(EligibleRoleAssignment).delete()
-        dbsession.commit()
+    if (args.skip_first_phase or selective) and not args.resume:
+        # Delete existing links of the tasks that run to make sure we start with clean data
+        for task in tasks:
+            for table in task.clears:
+                await writer.execute(table.delete())
+        # Also forget about progress of previous runs, except for the first phase
+        # and the delta links of incremental runs
+        checkpoints = GatherCheckpoint.__table__
+        await writer.execute(checkpoints.delete().where(~checkpoints.c.task.startswith('object:'))
+                                                 .where(~checkpoints.c.task.startswith('delta:')))
+        for task in tasks:
+            if task.provides and not task.depends:
+                # Objects of the first phase that are collected again
+                cursor = 'object:' + task.name
+                await writer.execute(checkpoints.delete().where((checkpoints.c.task == cursor) | checkpoints.c.task.startswith(cursor + ':')))
 
-    # Mapping object, mapping type returned to Table and link name
-    group_mapping = {
-        'Microsoft.DirectoryServices.User': (User, 'memberUsers'),
-        'Microsoft.DirectoryServices.Group': (Group, 'memberGroups'),
-        'Microsoft.DirectoryServices.Contact': (Contact, 'memberContacts'),
-        'Microsoft.DirectoryServices.Device': (Device, 'memberDevices'),
-        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'memberServicePrincipals'),
-    }
-    group_owner_mapping = {
-        'Microsoft.DirectoryServices.User': (User, 'ownerUsers'),
-        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'ownerServicePrincipals'),
-    }
-    owner_mapping = {
-        'Microsoft.DirectoryServices.User': (User, 'ownerUsers'),
-        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'ownerServicePrincipals'),
-    }
-    au_mapping = {
-        'Microsoft.DirectoryServices.User': (User, 'memberUsers'),
-        'Microsoft.DirectoryServices.Group': (Group, 'memberGroups'),
-        'Microsoft.DirectoryServices.Device': (Device, 'memberDevices'),
-    }
-    role_mapping = {
-        'Microsoft.DirectoryServices.User': (User, 'memberUsers'),
-        'Microsoft.DirectoryServices.ServicePrincipal': (ServicePrincipal, 'memberServicePrincipals'),
-        'Microsoft.DirectoryServices.Group': (Group, 'memberGroups'),
-    }
-    # Direct link mapping
-    group_link_mapping = {
-        'Microsoft.DirectoryServices.User': (lnk_group_member_user, 'Group', 'User'),
-        'Microsoft.DirectoryServices.Group': (lnk_group_member_group, 'Group', 'childGroup'),
-        'Microsoft.DirectoryServices.Contact': (lnk_group_member_contact, 'Group', 'Contact'),
-        'Microsoft.DirectoryServices.Device': (lnk_group_member_device, 'Group', 'Device'),
-        'Microsoft.DirectoryServices.ServicePrincipal': (lnk_group_member_serviceprincipal, 'Group', 'ServicePrincipal'),
-    }
-    au_link_mapping = {
-        'Microsoft.DirectoryServices.User': (lnk_au_member_user, 'AdministrativeUnit', 'User'),
-        'Microsoft.DirectoryServices.Group': (lnk_au_member_group, 'AdministrativeUnit', 'Group'),
-        'Microsoft.DirectoryServices.Device': (lnk_au_member_device, 'AdministrativeUnit', 'Device'),
-    }
-    group_owner_link_mapping = {
-        'Microsoft.DirectoryServices.User': (lnk_group_owner_user, 'Group', 'User'),
-        'Microsoft.DirectoryServices.ServicePrincipal': (lnk_group_owner_serviceprincipal, 'Group', 'ServicePrincipal'),
-    }
-    device_link_mapping = {
-        'Microsoft.DirectoryServices.User': (lnk_device_owner, 'Device', 'User'),
-    }
+    if connector is None:
+        connector = create_connector(args)
+        connector_owner = True
+    else:
+        connector_owner = False
+    async with aiohttp.ClientSession(connector=connector, connector_owner=connector_owner,
+                                     trace_configs=[ctx.connstats.trace_config()]) as ahsession:
+        print('Starting data gathering')
+        dumper.ahsession = ahsession
+        if args.batch:
+            dumper.batcher = RequestBatcher(ctx, '1.61-internal', ahsession, batchsize=args.batch_size)
+        try:
+            await run_tasks(tasks, dumper)
+        except RequestFailed as exc:
+            # Everything written so far is kept, a resumed gather continues from there
+            ctx.failed += 1
+            print('Stopped gathering: {0}'.format(exc))
+        dumper.batcher = None
+
+    await writer.close()
+    create_indexes(engine)
+    writer.print_stats()
+    if ctx.archive is not None:
+        ctx.archive.close()
+        print('Archived {0} responses to {1}'.format(ctx.archive.records, args.archive))
+        ctx.archive = None
+
+async def missing_dependencies(dumper, tasks, alltasks):
+    '''
+    Tables that the selected tasks read but do not gather themselves have to be
+    in the database already. Returns the missing tables, with the task gathering them.
+    '''
+    provided = set(table for task in tasks for table in task.provides)
+    missing = []
+    for table in sorted(set(table for task in tasks for table in task.depends) - provided):
+        providers = [task.name for task in alltasks if table in task.provides]
+        if not providers:
+            # Not gathered in this run at all, such as with --skip-first-phase
+            continue
+        checkpoints = GatherCheckpoint.__table__
+        cursors = ['object:' + name for name in providers] + ['delta:' + name for name in providers]
+        if await dumper.writer.fetchall(select(checkpoints.c.task).where(checkpoints.c.task.in_(cursors)).where(checkpoints.c.done == True)):
+            continue
+        # Databases of older versions have no checkpoints, but an empty collection
+        # can only be told apart from a missing one by its checkpoint
+        dbtable = database.Base.metadata.tables[table]
+        if (await dumper.writer.fetchall(select(func.count()).select_from(dbtable)))[0][0] > 0:
+            continue
+        missing.append((table, ' or '.join(providers)))
+    return missing
 
-    tasks = []
-    dumper.session = dbsession
-    totalgroups = dbsession.query(func.count(Group.objectId)).scalar()
-    totaldevices = dbsession.query(func.count(Device.objectId)).scalar()
-    if totalgroups > MAX_GROUPS:
-        print('Gathered {0} groups, switching to 3-phase approach for efficiency'.format(totalgroups))
+async def ingest(ctx, args):
+    '''
+    Rebuild a database by replaying the gather tasks from an archive
+    '''
+    engine = database.init(True, dburl=ctx.dburl)
+    writer = DatabaseWriter(engine, maxsize=args.write_queue_size)
+    writer.start()
+    # Request the same URLs as the gather that created the archive
+    dumper = DataDumper(ctx, '1.61-internal', writer=writer, selectprofile=ctx.replay.selectprofile,
+                        pagesize=ctx.replay.pagesize, partitioned=ctx.replay.partitioned, membership=ctx.replay.membership)
+    # Run the tasks that were archived, including the optional ones
+    gatherargs = argparse.Namespace(mfa=True, incremental=False, skip_first_phase=False)
+    tasks = [task for task in gather_tasks(dumper, gatherargs) if task.name in ctx.replay.tasks]
+    # No requests are made, but the tasks expect a session
     async with aiohttp.ClientSession() as ahsession:
-        if totalgroups > MAX_GROUPS:
-            print('Starting data gathering phase 2 of 3 (collecting properties and relationships)')
-        else:
-            print('Starting data gathering phase 2 of 2 (collecting properties and relationships)')
         dumper.ahsession = ahsession
-        # If we have a lot of groups, dump them separately
-        if totalgroups <= MAX_GROUPS:
-            tasks.append(dumper.dump_links('groups', 'members', Group, mapping=group_mapping))
-            tasks.append(dumper.dump_links('groups', 'owners', Group, mapping=group_owner_mapping))
-            tasks.append(dumper.dump_links('administrativeUnits', 'members', AdministrativeUnit, mapping=au_mapping))
-            tasks.append(dumper.dump_object_expansion('devices', Device, 'registeredOwners', 'owner', User))
-        tasks.append(dumper.dump_links('directoryRoles', 'members', DirectoryRole, mapping=role_mapping))
-        tasks.append(dumper.dump_linked_objects('servicePrincipals', 'appRoleAssignedTo', ServicePrincipal, AppRoleAssignment, ignore_duplicates=True))
-        tasks.append(dumper.dump_linked_objects('servicePrincipals', 'appRoleAssignments', ServicePrincipal, AppRoleAssignment, ignore_duplicates=True))
-        tasks.append(dumper.dump_object_expansion('servicePrincipals', ServicePrincipal, 'owners', 'owner', User, mapping=owner_mapping))
-        tasks.append(dumper.dump_object_expansion('applications', Application, 'owners', 'owner', User, mapping=owner_mapping))
-        tasks.append(dumper.dump_custom_role_members(RoleAssignment))
-        tasks.append(dumper.dump_eligible_role_members(EligibleRoleAssignment))
-        if args.mfa:
-            tasks.append(dumper.dump_mfa('users', User, method=ahsession.get))
-        tasks.append(dumper.dump_each(ServicePrincipal, 'applicationRefs', ApplicationRef))
-        tasks.append(dumper.dump_keycredentials('servicePrincipals', ServicePrincipal))
-        tasks.append(dumper.dump_keycredentials('applications', Application))
-        await asyncio.gather(*tasks)
-    dbsession.commit()
-
-    tasks = []
-    if totalgroups > MAX_GROUPS:
-        print('Starting data gathering phase 3 of 3 (collecting group memberships and device owners)')
-        async with aiohttp.ClientSession() as ahsession:
-            dumper.ahsession = ahsession
-            queue = asyncio.Queue(maxsize=100)
-            # Start the workers
-            workers = []
-            for i in range(100):
-                workers.append(asyncio.ensure_future(queue_processor(queue)))
-
-            tasks.append(dumper.dump_links_with_queue(queue, 'devices', 'registeredOwners', Device, mapping=device_link_mapping))
-            tasks.append(dumper.dump_links_with_queue(queue, 'groups', 'members', Group, mapping=group_link_mapping))
-            tasks.append(dumper.dump_links_with_queue(queue, 'groups', 'owners', Group, mapping=group_owner_link_mapping))
-            tasks.append(dumper.dump_links_with_queue(queue, 'administrativeUnits', 'members', AdministrativeUnit, mapping=au_link_mapping))
-
-            await asyncio.gather(*tasks)
-            await queue.join()
-            for worker_task in workers:
-                worker_task.cancel()
-
-    dbsession.commit()
-    dbsession.close()
+        try:
+            await run_tasks(tasks, dumper)
+        except RequestFailed as exc:
+            ctx.failed += 1
+            print('Stopped ingesting: {0}'.format(exc))
+    await writer.close()
+    create_indexes(engine)
+    writer.print_stats()
 
 def getargs(gather_parser):
     gather_parser.add_argument('-d',
@@ -657,19 +2364,196 @@ def getargs(gather_parser):
     gather_parser.add_argument('--tokens-stdin',
                                action='store_true',
                                help='Read tokens from stdin instead of from disk')
+    gather_parser.add_argument('-t',
+                               '--tenant',
+                               action='store',
+                               help='Tenant ID to gather, if this info is not stored in the token')
+    gather_parser.add_argument('--plan',
+                               action='store_true',
+                               help='Only print the expected number of requests per task, the expected time and the expected database size. '
+                                    'Uses the object counts of the database if it contains a previous gather, otherwise these are requested from the API')
+    getoptionargs(gather_parser)
+
+def getoptionargs(gather_parser):
+    '''
+    Options that apply to each tenant that is gathered
+    '''
     gather_parser.add_argument('--mfa',
                                action='store_true',
                                help='Dump MFA details (requires use of a privileged account)')
     gather_parser.add_argument('--skip-first-phase',
                                action='store_true',
                                help='Skip the first phase (assumes this has been previously completed)')
-    gather_parser.add_argument('-t',
-                               '--tenant',
+    gather_parser.add_argument('--batch',
+                               action='store_true',
+                               help='Combine per-object requests (MFA details, applicationRefs) into $batch requests')
+    gather_parser.add_argument('--batch-size',
                                action='store',
-                               help='Tenant ID to gather, if this info is not stored in the token')
+                               type=int,
+                               help='Number of requests per $batch request (default: {0})'.format(MAX_BATCH_SIZE),
+                               default=MAX_BATCH_SIZE)
+    gather_parser.add_argument('--max-rate',
+                               action='store',
+                               type=float,
+                               help='Maximum number of requests per second per endpoint (default: {0:0.0f})'.format(MAX_REQ_PER_SEC),
+                               default=MAX_REQ_PER_SEC)
+    gather_parser.add_argument('--initial-rate',
+                               action='store',
+                               type=float,
+                               help='Number of requests per second per endpoint to start with, after which the rate is adapted to what the endpoint allows (default: {0:0.0f})'.format(INITIAL_REQ_PER_SEC),
+                               default=INITIAL_REQ_PER_SEC)
+    gather_parser.add_argument('--retries',
+                               action='store',
+                               type=int,
+                               help='Number of times a request is retried after a connection error or server error (default: {0})'.format(RETRY_ATTEMPTS),
+                               default=RETRY_ATTEMPTS)
+    gather_parser.add_argument('--connection-limit',
+                               action='store',
+                               type=int,
+                               help='Maximum number of open connections, 0 for no limit (default: {0})'.format(CONNECTION_LIMIT),
+                               default=CONNECTION_LIMIT)
+    gather_parser.add_argument('--connections-per-host',
+                               action='store',
+                               type=int,
+                               help='Maximum number of open connections to the same host, 0 for no limit (default: {0})'.format(CONNECTION_LIMIT_PER_HOST),
+                               default=CONNECTION_LIMIT_PER_HOST)
+    gather_parser.add_argument('--keepalive-timeout',
+                               action='store',
+                               type=float,
+                               help='Seconds to keep idle connections open for reuse (default: {0:0.0f})'.format(KEEPALIVE_TIMEOUT),
+                               default=KEEPALIVE_TIMEOUT)
+    gather_parser.add_argument('--dns-cache-ttl',
+                               action='store',
+                               type=int,
+                               help='Seconds to cache DNS lookups (default: {0})'.format(DNS_CACHE_TTL),
+                               default=DNS_CACHE_TTL)
+    gather_parser.add_argument('--proxy',
+                               action='store',
+                               metavar='URL',
+                               help='HTTP proxy to send the requests through, for example http://127.0.0.1:8080')
+    gather_parser.add_argument('--select-profile',
+                               action='store',
+                               choices=SELECT_PROFILES,
+                               help='Properties to request for users, groups, devices, contacts, service principals and applications. '
+                                    'minimal: only properties used by the GUI and plugins, standard: all stored properties except large ones '
+                                    'that are not analysed (such as assigned and provisioned plans), full: all properties, without $select (default: {0})'.format(SELECT_PROFILE),
+                               default=SELECT_PROFILE)
+    gather_parser.add_argument('--page-size',
+                               action='store',
+                               type=int,
+                               help='Number of objects per page for large collections and links, 0 for the default of the directory (default: {0})'.format(MAX_PAGE_SIZE),
+                               default=MAX_PAGE_SIZE)
+    gather_parser.add_argument('--partitioned',
+                               action='store_true',
+                               help='Enumerate users over concurrent cursors, split by the first character of the user principal name. '
+                                    'Faster for large tenants, but takes more requests for small ones')
+    gather_parser.add_argument('--membership',
+                               action='store',
+                               choices=('auto', 'groups', 'members'),
+                               help='Collect group memberships per group, or per member object by asking each object which groups it is a member of. '
+                                    'auto picks the direction that takes the least requests (default: auto)',
+                               default='auto')
+    gather_parser.add_argument('--only',
+                               action='store',
+                               metavar='TASKS',
+                               help='Only run these gather tasks, as comma separated names which can contain wildcards, such as users,groups,groups/*. '
+                                    'Tables of other tasks in an existing database are kept. --plan lists the names of the tasks')
+    gather_parser.add_argument('--exclude',
+                               action='store',
+                               metavar='TASKS',
+                               help='Do not run these gather tasks, as comma separated names which can contain wildcards. '
+                                    'Tables of these tasks in an existing database are kept')
+    gather_parser.add_argument('--rate-stats',
+                               action='store_true',
+                               help='Print the request rate reached for each endpoint after gathering')
+    gather_parser.add_argument('--resume',
+                               action='store_true',
+                               help='Resume a gather that was interrupted, continuing where the previous run stopped')
+    gather_parser.add_argument('--archive',
+                               action='store',
+                               metavar='FILE',
+                               help='Append all raw responses to an archive, which can be loaded into a database again with roadrecon ingest. '
+                                    'Compressed based on the extension: .zst (requires the zstandard module) or .gz. '
+                                    'For gather-many, {tenant} is replaced by the tenant ID')
+    gather_parser.add_argument('--write-queue-size',
+                               type=int,
+                               action='store',
+                               help='Number of pending database writes before gathering waits for the database (default: %d)' % WRITE_QUEUE_SIZE,
+                               default=WRITE_QUEUE_SIZE)
+    gather_parser.add_argument('--incremental',
+                               action='store_true',
+                               help='Update an existing database with the changes since the previous incremental run, '
+                                    'using differential query. The first incremental run collects all objects')
+
+def getmanyargs(many_parser):
+    many_parser.add_argument('tokenfiles',
+                             action='store',
+                             nargs='+',
+                             metavar='TOKENFILE',
+                             help='Files with credentials obtained by roadrecon auth, one for each tenant')
+    many_parser.add_argument('-d',
+                             '--database',
+                             action='store',
+                             help='Database for each tenant, in which {tenant} is replaced by the tenant ID. '
+                                  'Can be a local file for SQLite or an SQLAlchemy compatible URL. Default: roadrecon-{tenant}.db',
+                             default='roadrecon-{tenant}.db')
+    many_parser.add_argument('--concurrency',
+                             type=int,
+                             action='store',
+                             help='Number of tenants to gather at the same time (default: 4)',
+                             default=4)
+    many_parser.add_argument('--processes',
+                             type=int,
+                             action='store',
+                             help='Spread the tenants over this many processes, instead of gathering them '
+                                  'concurrently in one event loop (default: 0, gather in one process)',
+                             default=0)
+    getoptionargs(many_parser)
+
+def get_dburl(dbname):
+    if not ':/' in dbname:
+        if dbname[0] != '/':
+            return 'sqlite:///' + os.path.join(os.getcwd(), dbname)
+        return 'sqlite:///' + dbname
+    return dbname
+
+def getingestargs(ingest_parser):
+    ingest_parser.add_argument('archive',
+                               action='store',
+                               help='Archive created with roadrecon gather --archive')
+    ingest_parser.add_argument('-d',
+                               '--database',
+                               action='store',
+                               help='Database file. Can be the local database name for SQLite, or an SQLAlchemy compatible URL such as postgresql+psycopg2://dirkjan@/roadtools. Default: roadrecon.db',
+                               default='roadrecon.db')
+    ingest_parser.add_argument('--write-queue-size',
+                               type=int,
+                               action='store',
+                               help='Number of pending database writes before replaying waits for the database (default: %d)' % WRITE_QUEUE_SIZE,
+                               default=WRITE_QUEUE_SIZE)
+
+def check_args(args):
+    if not 0 <= args.page_size <= MAX_PAGE_SIZE:
+        print('--page-size should be between 0 and {0}'.format(MAX_PAGE_SIZE))
+        return False
+    if args.incremental and (args.resume or args.skip_first_phase):
+        print('--incremental can not be combined with --resume or --skip-first-phase')
+        return False
+    if args.incremental and args.membership == 'members':
+        print('--incremental collects changed memberships per group and can not be combined with --membership members')
+        return False
+    if args.incremental and (args.only or args.exclude):
+        print('--incremental tracks the changes to all collections and can not be combined with --only or --exclude')
+        return False
+    try:
+        # Only the names of the tasks are needed here
+        select_tasks(gather_tasks(GatherPlan({}, args), args), args.only, args.exclude)
+    except ValueError as exc:
+        print(exc)
+        return False
+    return True
 
 def main(args=None):
-    global token, headers, dburl, urlcounter
     if args is None:
         parser = argparse.ArgumentParser(add_help=True, description='ROADrecon - Gather Azure AD information', formatter_class=argparse.RawDescriptionHelpFormatter)
         getargs(parser)
@@ -677,26 +2561,143 @@ def main(args=None):
         if len(sys.argv) < 2:
             parser.print_help()
             sys.exit(1)
+    if not check_args(args):
+        return
     if args.tokens_stdin:
         token = json.loads(sys.stdin.read())
     else:
         with open(args.tokenfile, 'r') as infile:
             token = json.load(infile)
-    if not ':/' in args.database:
-        if args.database[0] != '/':
-            dburl = 'sqlite:///' + os.path.join(os.getcwd(), args.database)
-        else:
-            dburl = 'sqlite:///' + args.database
-    else:
-        dburl = args.database
+    if args.plan:
+        run_plan(args, token)
+        return
+    run_gather(args, token)
+
+def run_gather(args, token, baseurl=None):
+    '''
+    Gather the tenant of the token from the API at baseurl (graph.windows.net
+    by default), returns the time it took
+    '''
+    ratelimiter = AdaptiveRateLimiter(initial_rate=args.initial_rate, max_rate=args.max_rate)
+    ctx = GatherContext(token, get_dburl(args.database), tenantid=args.tenant, ratelimiter=ratelimiter, retries=args.retries,
+                        proxy=args.proxy, baseurl=baseurl)
+
+    seconds = time.perf_counter()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(ctx, args))
+    elapsed = time.perf_counter() - seconds
+    print("ROADrecon gather executed in {0:0.2f} seconds and issued {1} HTTP requests.".format(elapsed, ctx.urlcounter))
+    if ctx.batchcounter > 0:
+        print("Combined {0} requests into {1} $batch requests, saving {2} round trips.".format(ctx.batcheditems, ctx.batchcounter, ctx.batcheditems - ctx.batchcounter))
+    if ctx.recovered > 0 or ctx.failed > 0:
+        print("Recovered {0} requests by retrying, {1} requests failed permanently.".format(ctx.recovered, ctx.failed))
+    if ctx.failed > 0:
+        print("The gathered data is incomplete, run gather again with --resume to collect the missing data.")
+    ctx.connstats.print_stats()
+    if args.rate_stats:
+        ctx.ratelimiter.print_rates()
+    return elapsed
+
+async def gather_tenant(tokenfile, args, connector=None, connstats=None):
+    '''
+    Gather a single tenant of gather-many, returns the tenant, database,
+    elapsed time, number of requests and number of failed requests to report
+    '''
+    with open(tokenfile, 'r') as infile:
+        token = json.load(infile)
+    if 'tenantId' not in token:
+        raise Exception('No tenant ID found in token file {0}'.format(tokenfile))
+    # Options are shared by all tenants, but each tenant gets its own files
+    tenantargs = argparse.Namespace(**vars(args))
+    tenantargs.database = args.database.format(tenant=token['tenantId'])
+    if args.archive:
+        tenantargs.archive = args.archive.format(tenant=token['tenantId'])
+    ratelimiter = AdaptiveRateLimiter(initial_rate=args.initial_rate, max_rate=args.max_rate)
+    ctx = GatherContext(token, get_dburl(tenantargs.database), ratelimiter=ratelimiter, retries=args.retries,
+                        proxy=args.proxy, connstats=connstats)
+    seconds = time.perf_counter()
+    await run(ctx, tenantargs, connector=connector)
+    return ctx.tenantid, tenantargs.database, time.perf_counter() - seconds, ctx.urlcounter, ctx.failed
+
+def gather_tenant_process(tokenfile, args):
+    '''
+    Gather a tenant in a worker process
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather_tenant(tokenfile, args))
+    finally:
+        loop.close()
+
+async def run_many(args):
+    '''
+    Gather the tenants of all token files concurrently in this event loop,
+    sharing one connection pool
+    '''
+    semaphore = asyncio.Semaphore(args.concurrency)
+    connector = create_connector(args)
+    connstats = ConnectionStats()
+    async def gather_one(tokenfile):
+        async with semaphore:
+            return await gather_tenant(tokenfile, args, connector=connector, connstats=connstats)
+    try:
+        results = await asyncio.gather(*[gather_one(tokenfile) for tokenfile in args.tokenfiles], return_exceptions=True)
+    finally:
+        await connector.close()
+    connstats.print_stats()
+    return results
+
+def check_many_args(args):
+    if not check_args(args):
+        return False
+    # Tenants gathered at the same time can not share a file
+    if len(args.tokenfiles) > 1 and '{tenant}' not in args.database:
+        print('--database should contain {tenant}, which is replaced by the tenant ID for each tenant')
+        return False
+    if args.archive and '{tenant}' not in args.archive:
+        print('--archive should contain {tenant}, which is replaced by the tenant ID for each tenant')
+        return False
+    return True
 
-    headers['Authorization'] = '%s %s' % (token['tokenType'], token['accessToken'])
+def gather_many_main(args):
+    if not check_many_args(args):
+        return
+    seconds = time.perf_counter()
+    if args.processes > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = [executor.submit(gather_tenant_process, tokenfile, args) for tokenfile in args.tokenfiles]
+            concurrent.futures.wait(futures)
+        results = [future.exception() or future.result() for future in futures]
+    else:
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(run_many(args))
+    elapsed = time.perf_counter() - seconds
+    print("ROADrecon gather-many executed in {0:0.2f} seconds for {1} tenants.".format(elapsed, len(args.tokenfiles)))
+    for tokenfile, result in zip(args.tokenfiles, results):
+        if isinstance(result, Exception):
+            print('  {0}: failed: {1}'.format(tokenfile, result))
+            continue
+        tenantid, database, tenantelapsed, requests, failed = result
+        print('  {0}: gathered into {1} in {2:0.2f} seconds with {3} HTTP requests'.format(tenantid, database, tenantelapsed, requests))
+        if failed > 0:
+            print('    {0} requests failed permanently, run gather again with --resume for this tenant'.format(failed))
 
+def ingest_main(args):
+    dburl = get_dburl(args.database)
     seconds = time.perf_counter()
+    replay = ArchiveReplay(args.archive)
+    if replay.tenantid is None:
+        print('No gather found in archive {0}'.format(args.archive))
+        return
+    # Archived responses are looked up by URL, so request them from the API the archive was gathered from
+    ctx = GatherContext(None, dburl, tenantid=replay.tenantid, replay=replay, baseurl=replay.baseurl)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(run(args))
+    loop.run_until_complete(ingest(ctx, args))
+    replay.close()
     elapsed = time.perf_counter() - seconds
-    print("ROADrecon gather executed in {0:0.2f} seconds and issued {1} HTTP requests.".format(elapsed, urlcounter))
+    print("ROADrecon ingest executed in {0:0.2f} seconds and replayed {1} of {2} archived responses.".format(elapsed, replay.replayed, len(replay.offsets)))
+    if ctx.failed > 0:
+        print('{0} responses were missing from the archive, the database is incomplete'.format(ctx.failed))
 
 
 if __name__ == "__main__":
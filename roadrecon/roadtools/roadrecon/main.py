@@ -4,6 +4,8 @@ import os
 import importlib
 from roadtools.roadlib.auth import Authentication
 from roadtools.roadrecon.gather import getargs as getgatherargs
+from roadtools.roadrecon.gather import getingestargs, getmanyargs
+from roadtools.roadrecon.benchmark import getargs as getbenchmarkargs
 RR_HELP = '''ROADrecon - The Azure AD exploration tool.
 By @_dirkjan - dirkjanm.io
 
@@ -14,10 +16,17 @@ roadrecon auth <options>
 
 2. Gather all information
 roadrecon gather <options>
+   Or gather multiple tenants at once
+roadrecon gather-many <options>
+   Or load information from an archive made with gather --archive
+roadrecon ingest <options>
 
 3. Explore the data or export it to a specific format using a plugin
 roadrecon gui
 roadrecon plugin -h
+
+To measure gather performance against a local mock of the API, use
+roadrecon benchmark <options>
 '''
 
 def check_database_exists(path):
@@ -52,6 +61,18 @@ def main():
     gather_parser = subparsers.add_parser('gather', aliases=['dump'], help='Gather Azure AD information')
     getgatherargs(gather_parser)
 
+    # Construct options to gather multiple tenants
+    many_parser = subparsers.add_parser('gather-many', help='Gather Azure AD information of multiple tenants concurrently')
+    getmanyargs(many_parser)
+
+    # Construct ingest module options
+    ingest_parser = subparsers.add_parser('ingest', help='Load Azure AD information from a gather archive')
+    getingestargs(ingest_parser)
+
+    # Construct benchmark module options
+    benchmark_parser = subparsers.add_parser('benchmark', help='Benchmark gather against a local mock API with a synthetic tenant')
+    getbenchmarkargs(benchmark_parser)
+
     # Construct GUI options
     gui_parser = subparsers.add_parser('gui', help='Launch the web-based GUI')
     gui_parser.add_argument('-d',
@@ -118,6 +139,15 @@ def main():
     elif args.command == 'gather' or args.command == 'dump':
         from roadtools.roadrecon.gather import main as gathermain
         gathermain(args)
+    elif args.command == 'gather-many':
+        from roadtools.roadrecon.gather import gather_many_main
+        gather_many_main(args)
+    elif args.command == 'ingest':
+        from roadtools.roadrecon.gather import ingest_main
+        ingest_main(args)
+    elif args.command == 'benchmark':
+        from roadtools.roadrecon.benchmark import main as benchmarkmain
+        benchmarkmain(args)
     elif args.command == 'plugin':
         # Dynamic import
         plugin_module = importlib.import_module('roadtools.roadrecon.plugins.{}'.format(args.plugin))
@@ -146,7 +146,8 @@ class BloodHoundPlugin():
             except ClientError as e:
                 pass  # on neo4j 4, an error is raised when the constraint exists already
 
-            for user in self.session.query(User):
+            for user in self.session.query(User.objectId, User.userPrincipalName, User.displayName, User.accountEnabled,
+                                           User.onPremisesDistinguishedName, User.mail, User.onPremisesSecurityIdentifier):
                 property_query = 'UNWIND $props AS prop MERGE (n:AzureUser {objectid: prop.sourceid}) SET n += prop.map'
                 uprops = {
                     'name': user.userPrincipalName,
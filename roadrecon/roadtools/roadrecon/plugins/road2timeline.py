@@ -26,6 +26,7 @@ import argparse
 import sqlalchemy
 
 import roadtools.roadlib.metadef.database as database
+from roadtools.roadlib.timestamps import parse_timestamps
 
 from pathlib import Path
 from typing import Dict, Optional
@@ -156,7 +157,9 @@ if HAS_RTT_MODULES:
             # into a python Datetime object.
             if type(column.type) == sqlalchemy.sql.sqltypes.DATETIME:
                 if column.name in df.columns:
-                    df[column.name] = df[column.name].apply(pd.to_datetime, errors="coerce")
+                    df[column.name] = pd.to_datetime(
+                        parse_timestamps(df[column.name], errors="coerce"), errors="coerce"
+                    )
 
         return df
 
@@ -46,6 +46,7 @@ from roadtools.roadrecon.server import (
     groups_schema, applications_schema, serviceprincipals_schema
 )
 import roadtools.roadlib.metadef.database as database
+from sqlalchemy.orm import undefer
 
 # Required property - plugin description
 DESCRIPTION = "Export data to an Excel file"
@@ -121,6 +122,10 @@ class ExportToFilePlugin():
         sheet = book[name]
         return sheet
 
+    def _query_fields(self, model, fields):
+        # Only load the columns that are exported
+        return self.session.query(*[getattr(model, field) for field in fields])
+
     def get_users(self, book, column_width=40):
         sheet_name = "Users"
         self._print_msg('Export %s info' % sheet_name)
@@ -128,7 +133,7 @@ class ExportToFilePlugin():
         sheet = self._create_sheet(book, sheet_name)
         self._create_excel_headers(sheet, users_schema.Meta().fields)
         self._apply_style_sheet(sheet, column_width)
-        all_users = self.session.query(User).all()
+        all_users = self._query_fields(User, users_schema.Meta().fields).all()
         self._fill_sheet(sheet, all_users, users_schema.Meta().fields)
 
     def get_devices(self, book, column_width=40):
@@ -138,7 +143,7 @@ class ExportToFilePlugin():
         sheet = self._create_sheet(book, sheet_name)
         self._create_excel_headers(sheet, devices_schema.Meta().fields)
         self._apply_style_sheet(sheet, column_width)
-        all_devices = self.session.query(Device).all()
+        all_devices = self._query_fields(Device, devices_schema.Meta().fields).all()
         self._fill_sheet(sheet, all_devices, devices_schema.Meta().fields)
 
     def get_groups(self, book, column_width=40):
@@ -148,7 +153,7 @@ class ExportToFilePlugin():
         sheet = self._create_sheet(book, sheet_name)
         self._create_excel_headers(sheet, groups_schema.Meta().fields)
         self._apply_style_sheet(sheet, column_width)
-        all_groups = self.session.query(Group).all()
+        all_groups = self._query_fields(Group, groups_schema.Meta().fields).all()
         self._fill_sheet(sheet, all_groups, groups_schema.Meta().fields)
 
     def get_member_of(self, book, column_width=40):
@@ -209,7 +214,10 @@ class ExportToFilePlugin():
         sheet = self._create_sheet(book, sheet_name)
         self._create_excel_headers(sheet, fields)
         self._apply_style_sheet(sheet, column_width)
-        all_applications = self.session.query(Application).all()
+        all_applications = self.session.query(Application).options(
+            undefer(Application.appRoles), undefer(Application.oauth2Permissions),
+            undefer(Application.passwordCredentials), undefer(Application.keyCredentials)
+        ).all()
         self._fill_sheet(sheet, all_applications, fields)
 
     def get_service_principals(self, book, column_width=40):
@@ -226,7 +234,10 @@ class ExportToFilePlugin():
         sheet = self._create_sheet(book, sheet_name)
         self._create_excel_headers(sheet, fields)
         self._apply_style_sheet(sheet, column_width)
-        all_service_principal = self.session.query(ServicePrincipal).all()
+        all_service_principal = self.session.query(ServicePrincipal).options(
+            undefer(ServicePrincipal.appRoles), undefer(ServicePrincipal.oauth2Permissions),
+            undefer(ServicePrincipal.passwordCredentials), undefer(ServicePrincipal.keyCredentials)
+        ).all()
         self._fill_sheet(sheet, all_service_principal, fields)
 
     def get_app_roles(self, book, column_width=40):
@@ -239,7 +250,7 @@ class ExportToFilePlugin():
         self._apply_style_sheet(sheet, column_width)
         approles = []
         for ar in self.session.query(AppRoleAssignment).all():
-            rsp = self.session.query(ServicePrincipal).get(ar.resourceId)
+            rsp = self.session.query(ServicePrincipal).options(undefer(ServicePrincipal.appRoles)).get(ar.resourceId)
             if ar.principalType == 'ServicePrincipal':
                 sp = self.session.query(ServicePrincipal).get(ar.principalId)
             if ar.principalType == 'User':
@@ -322,7 +333,9 @@ class ExportToFilePlugin():
         )
         self._create_excel_headers(sheet, fields)
         self._apply_style_sheet(sheet, column_width)
-        all_mfa = self.session.query(User).all()
+        all_mfa = self.session.query(
+            User.objectId, User.displayName, User.accountEnabled, User.strongAuthenticationDetail, User.searchableDeviceKey
+        ).all()
         mfa = []
         for user in all_mfa:
             mfa_methods = len(user.strongAuthenticationDetail['methods'])
@@ -4,15 +4,36 @@ from flask_marshmallow import Marshmallow
 from flask_cors import CORS
 from marshmallow_sqlalchemy import ModelConverter
 from marshmallow import fields
+from roadtools.roadlib import serializer
 from roadtools.roadlib.metadef.database import User, JSON, Group, DirectoryRole, ServicePrincipal, AppRoleAssignment, TenantDetail, Application, Device, OAuth2PermissionGrant, AuthorizationPolicy, DirectorySetting, AdministrativeUnit, RoleDefinition
 import os
 import argparse
 from sqlalchemy import func
+from sqlalchemy.orm import defaultload, undefer, undefer_group
 import mimetypes
+try:
+    from flask.json.provider import DefaultJSONProvider
+    HAS_JSON_PROVIDER = True
+except ModuleNotFoundError:
+    # Flask < 2.2
+    HAS_JSON_PROVIDER = False
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+if HAS_JSON_PROVIDER:
+    class SerializerJSONProvider(DefaultJSONProvider):
+        '''
+        Encode responses with the fastest available JSON backend
+        '''
+        def dumps(self, obj, **kwargs):
+            return serializer.dumps(obj, default=self.default, sort_keys=self.sort_keys)
+
+        def loads(self, s, **kwargs):
+            return serializer.loads(s)
+
+    app.json = SerializerJSONProvider(app)
+
 # This will get initialized later on
 db = None
 ma = Marshmallow(app)
@@ -178,6 +199,40 @@ serviceprincipals_schema = ServicePrincipalsSchema(many=True)
 directoryroles_schema = DirectoryRolesSchema(many=True)
 administrativeunits_schema = AdministrativeUnitsSchema(many=True)
 
+def deferred_fields(model, schema):
+    '''
+    The deferred columns of model that a list schema shows
+    '''
+    attrs = model.__mapper__.column_attrs
+    return [getattr(model, name) for name in schema.Meta.fields if name in attrs and attrs[name].deferred]
+
+def load_fields(model, schema):
+    '''
+    Loader options for the deferred columns that a schema shows, for the queried
+    objects and for the objects of the relationships that the schema nests
+    '''
+    shown = getattr(schema.Meta, 'fields', None)
+    if shown is None:
+        # Schemas without a list of fields show all columns
+        options = [undefer_group('heavy'), undefer_group('details')]
+    else:
+        options = [undefer(column) for column in deferred_fields(model, schema)]
+    for name, field in schema._declared_fields.items():
+        if not isinstance(field, fields.Nested) or (shown is not None and name not in shown):
+            continue
+        relationship = getattr(model, name)
+        nested = load_fields(relationship.property.mapper.class_, field.nested)
+        if nested:
+            options.append(defaultload(relationship).options(*nested))
+    return options
+
+def query_fields(model, schema):
+    '''
+    Query only the columns that a list schema shows, instead of complete objects.
+    Fields that the model does not have are left out, as for complete objects.
+    '''
+    return db.session.query(*[getattr(model, name) for name in schema.Meta.fields if hasattr(model, name)])
+
 @app.route("/")
 def get_index():
     return send_file('dist_gui/index.html')
@@ -195,28 +250,28 @@ def get_gui(path):
 
 @app.route("/api/users", methods=["GET"])
 def get_users():
-    all_users = db.session.query(User).all()
+    all_users = query_fields(User, UsersSchema).all()
     result = users_schema.dump(all_users)
     return jsonify(result)
 
 
 @app.route("/api/users/<id>", methods=["GET"])
 def user_detail(id):
-    user = db.session.query(User).get(id)
+    user = db.session.query(User).options(*load_fields(User, UserSchema)).get(id)
     if not user:
         abort(404)
     return user_schema.jsonify(user)
 
 @app.route("/api/devices", methods=["GET"])
 def get_devices():
-    all_devices = db.session.query(Device).all()
+    all_devices = query_fields(Device, DevicesSchema).all()
     result = devices_schema.dump(all_devices)
     return jsonify(result)
 
 
 @app.route("/api/devices/<id>", methods=["GET"])
 def device_detail(id):
-    device = db.session.query(Device).get(id)
+    device = db.session.query(Device).options(*load_fields(Device, DeviceSchema)).get(id)
     if not device:
         abort(404)
     return device_schema.jsonify(device)
@@ -231,52 +286,58 @@ def user_groups(id):
 
 @app.route("/api/groups", methods=["GET"])
 def get_groups():
-    all_groups = db.session.query(Group).all()
+    all_groups = query_fields(Group, GroupsSchema).all()
     result = groups_schema.dump(all_groups)
     return jsonify(result)
 
 @app.route("/api/groups/<id>", methods=["GET"])
 def group_detail(id):
-    group = db.session.query(Group).get(id)
+    group = db.session.query(Group).options(*load_fields(Group, GroupSchema)).get(id)
     if not group:
         abort(404)
     return group_schema.jsonify(group)
 
 @app.route("/api/administrativeunits", methods=["GET"])
 def get_administrativeunits():
-    all_administrativeunits = db.session.query(AdministrativeUnit).all()
+    all_administrativeunits = query_fields(AdministrativeUnit, AdministrativeUnitsSchema).all()
     result = administrativeunits_schema.dump(all_administrativeunits)
     return jsonify(result)
 
 @app.route("/api/administrativeunits/<id>", methods=["GET"])
 def administrativeunit_detail(id):
-    administrativeunit = db.session.query(AdministrativeUnit).get(id)
+    administrativeunit = db.session.query(AdministrativeUnit).options(*load_fields(AdministrativeUnit, AdministrativeUnitSchema)).get(id)
     if not administrativeunit:
         abort(404)
     return administrativeunit_schema.jsonify(administrativeunit)
 
 @app.route("/api/serviceprincipals", methods=["GET"])
 def get_sps():
-    all_sps = db.session.query(ServicePrincipal).all()
+    all_sps = db.session.query(ServicePrincipal).options(*load_fields(ServicePrincipal, ServicePrincipalsSchema)).all()
     return serviceprincipals_schema.jsonify(all_sps)
 
+def sp_detail_query():
+    '''
+    Query for a single service principal with the columns that its schema shows
+    '''
+    return db.session.query(ServicePrincipal).options(*load_fields(ServicePrincipal, ServicePrincipalSchema))
+
 @app.route("/api/serviceprincipals/<id>", methods=["GET"])
 def sp_detail(id):
-    sp = db.session.query(ServicePrincipal).get(id)
+    sp = sp_detail_query().get(id)
     if not sp:
         abort(404)
     return serviceprincipal_schema.jsonify(sp)
 
 @app.route("/api/serviceprincipals-by-appid/<id>", methods=["GET"])
 def sp_detail_by_appid(id):
-    sp = db.session.query(ServicePrincipal).filter(ServicePrincipal.appId == id).first()
+    sp = sp_detail_query().filter(ServicePrincipal.appId == id).first()
     if not sp:
         abort(404)
     return serviceprincipal_schema.jsonify(sp)
 
 @app.route("/api/applications", methods=["GET"])
 def get_applications():
-    all_applications = db.session.query(Application).all()
+    all_applications = db.session.query(Application).options(*load_fields(Application, ApplicationsSchema)).all()
     result = applications_schema.dump(all_applications)
     return jsonify(result)
 
@@ -288,7 +349,7 @@ def get_mfa():
     # for approle in per_user:
     #     enabledusers.append(approle.principalId)
 
-    all_mfa = db.session.query(User).all()
+    all_mfa = db.session.query(User.objectId, User.displayName, User.accountEnabled, User.strongAuthenticationDetail, User.searchableDeviceKey).all()
     out = []
     for user in all_mfa:
         mfa_methods = len(user.strongAuthenticationDetail['methods'])
@@ -314,16 +375,16 @@ def get_mfa():
 
 @app.route("/api/applications/<id>", methods=["GET"])
 def application_detail(id):
-    application = db.session.query(Application).get(id)
+    application = db.session.query(Application).options(*load_fields(Application, ApplicationSchema)).get(id)
     if not application:
         abort(404)
     return application_schema.jsonify(application)
 
 def resolve_objectid(oid):
-    res = db.session.query(User).get(oid)
+    res = db.session.query(User).options(*load_fields(User, UsersSchema)).get(oid)
     if res:
         return 'User', users_schema.dump([res])[0]
-    res = db.session.query(ServicePrincipal).get(oid)
+    res = db.session.query(ServicePrincipal).options(*load_fields(ServicePrincipal, ServicePrincipalsSchema)).get(oid)
     if res:
         return 'ServicePrincipal', serviceprincipals_schema.dump([res])[0]
     res = db.session.query(Group).get(oid)
@@ -332,7 +393,7 @@ def resolve_objectid(oid):
     res = db.session.query(Device).get(oid)
     if res:
         return 'Device', devices_schema.dump([res])[0]
-    res = db.session.query(Application).get(oid)
+    res = db.session.query(Application).options(*load_fields(Application, ApplicationsSchema)).get(oid)
     if res:
         return 'Application', applications_schema.dump([res])[0]
     return 'Unknown', None
@@ -396,7 +457,7 @@ def translate_rolescopes(scopes):
 
 
 def process_approle(approles, ar):
-    rsp = db.session.query(ServicePrincipal).get(ar.resourceId)
+    rsp = db.session.query(ServicePrincipal).options(undefer(ServicePrincipal.appRoles)).get(ar.resourceId)
     if ar.principalType == 'ServicePrincipal':
         sp = db.session.query(ServicePrincipal).get(ar.principalId)
     if ar.principalType == 'User':
@@ -511,7 +572,7 @@ def get_allroles():
 
 @app.route("/api/directoryroles", methods=["GET"])
 def get_dirroles():
-    drs = db.session.query(DirectoryRole).all()
+    drs = db.session.query(DirectoryRole).options(*load_fields(DirectoryRole, DirectoryRolesSchema)).all()
     return directoryroles_schema.jsonify(drs)
 
 @app.route("/api/tenantdetails", methods=["GET"])
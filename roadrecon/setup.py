@@ -21,7 +21,7 @@ setup(name='roadrecon',
       install_requires=[
           'roadlib>=0.17',
           'flask',
-          'sqlalchemy<2',
+          'sqlalchemy>=1.4,<2',
           'marshmallow',
           'flask-sqlalchemy>=2.5',
           'flask-marshmallow',
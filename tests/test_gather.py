@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import threading
+import time
+import aiohttp
+import roadtools.roadlib.metadef.database as database
+from roadtools.roadlib.metadef.database import AppRoleAssignment, Device, Group, ServicePrincipal, User
+from roadtools.roadrecon import benchmark, gather
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import pytest
+
+TOKEN = {'tokenType': 'Bearer', 'accessToken': 'test', 'expiresOn': '2099-01-01 00:00:00.000000'}
+
+@pytest.fixture(scope='module')
+def session(tmp_path_factory):
+    dbpath = str(tmp_path_factory.mktemp('gather') / 'gather.db')
+    parser = argparse.ArgumentParser()
+    benchmark.getargs(parser)
+    args = parser.parse_args(['-d', dbpath, '--users', '200', '--groups', '20', '--service-principals', '10',
+                              '--devices', '20', '--throttle-rate', '0.01'])
+    benchmark.main(args)
+    engine = database.init(dburl='sqlite:///' + dbpath)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+def test_gather_objects(session):
+    """Test if gather stores all objects of the mock tenant"""
+
+    assert session.query(User).count() == 200
+    assert session.query(Group).count() == 20
+    assert session.query(ServicePrincipal).count() == 10
+    assert session.query(Device).count() == 20
+
+def test_gather_links(session):
+    """Test if gather stores group memberships and device owners"""
+
+    groups = session.query(Group).all()
+    assert sum(len(group.memberUsers) for group in groups) > 0
+    assert sum(len(group.memberGroups) for group in groups) > 0
+    for device in session.query(Device).all():
+        assert len(device.owner) == 1
+
+def test_select_tasks():
+    """Test if gather tasks are selected by name and wildcard"""
+
+    args = argparse.Namespace(incremental=False, skip_first_phase=False, mfa=False, page_size=999)
+    tasks = gather.gather_tasks(gather.GatherPlan({}, args), args)
+    names = [task.name for task in gather.select_tasks(tasks, 'users,groups/*', 'groups/owners')]
+    assert names == ['users', 'groups/members']
+    with pytest.raises(ValueError):
+        gather.select_tasks(tasks, 'nonexisting')
+
+def test_refresh_keeps_mfa(tmp_path):
+    """Test if refreshing the users keeps the MFA details of an earlier gather"""
+
+    dbpath = str(tmp_path / 'refresh.db')
+    parser = argparse.ArgumentParser()
+    benchmark.getargs(parser)
+    options = ['-d', dbpath, '--users', '50', '--groups', '5', '--throttle-rate', '0']
+    benchmark.main(parser.parse_args(options + ['--mfa']))
+    engine = database.init(dburl='sqlite:///' + dbpath)
+    session = sessionmaker(bind=engine)()
+    assert session.query(User).filter(User.strongAuthenticationDetail != None).count() == 50
+    session.close()
+    benchmark.main(parser.parse_args(options + ['--only', 'users']))
+    session = sessionmaker(bind=engine)()
+    assert session.query(User).filter(User.strongAuthenticationDetail != None).count() == 50
+    session.close()
+
+def test_batch_fails_without_retries():
+    """Test if batched requests fail instead of waiting forever when server errors are not retried"""
+
+    tenant = benchmark.SyntheticTenant(users=10, groups=2, serviceprincipals=1, devices=1)
+    server = benchmark.MockDirectoryServer(tenant, error_rate=1.0)
+    urls = ['/%s/users/%s?api-version=1.61-internal' % (tenant.tenantid, user['objectId']) for user in tenant.collections['users']]
+    async def run():
+        runner = await server.start()
+        ctx = gather.GatherContext(dict(TOKEN, tenantId=tenant.tenantid), 'sqlite://', retries=0, baseurl=server.baseurl)
+        try:
+            async with aiohttp.ClientSession() as ahsession:
+                batcher = gather.RequestBatcher(ctx, '1.61-internal', ahsession)
+                requests = [batcher.get(server.baseurl + url) for url in urls]
+                return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 10)
+        finally:
+            await runner.cleanup()
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert len(results) == 10
+    assert all(isinstance(result, gather.RequestFailed) for result in results)
+
+def table_rows(dbpath):
+    """All rows of each table except the gather checkpoints, in a comparable order"""
+
+    engine = create_engine('sqlite:///' + dbpath)
+    tables = {}
+    for table in database.Base.metadata.sorted_tables:
+        if table.name != 'GatherCheckpoints':
+            tables[table.name] = sorted(map(repr, engine.execute(table.select()).fetchall()))
+    engine.dispose()
+    return tables
+
+def test_ingest_archive(tmp_path):
+    """Test if ingesting a compressed archive gives the same database as the gather that created it"""
+
+    parser = argparse.ArgumentParser()
+    benchmark.getargs(parser)
+    archive = str(tmp_path / 'gather.ndjson.gz')
+    benchmark.main(parser.parse_args(['-d', str(tmp_path / 'gather.db'), '--users', '50', '--groups', '5',
+                                      '--throttle-rate', '0', '--mfa', '--archive', archive]))
+    parser = argparse.ArgumentParser()
+    gather.getingestargs(parser)
+    gather.ingest_main(parser.parse_args([archive, '-d', str(tmp_path / 'ingest.db')]))
+    assert table_rows(str(tmp_path / 'ingest.db')) == table_rows(str(tmp_path / 'gather.db'))
+
+def test_app_role_assignments_resource_side(tmp_path, monkeypatch):
+    """Test if app role assignments from the resource side are the same as from both sides"""
+
+    async def both_sides(self):
+        await self.dump_linked_objects('servicePrincipals', 'appRoleAssignedTo', ServicePrincipal, AppRoleAssignment, ignore_duplicates=True)
+        await self.dump_linked_objects('servicePrincipals', 'appRoleAssignments', ServicePrincipal, AppRoleAssignment, ignore_duplicates=True)
+    parser = argparse.ArgumentParser()
+    benchmark.getargs(parser)
+    options = ['--users', '20', '--groups', '2', '--service-principals', '30', '--throttle-rate', '0']
+    benchmark.main(parser.parse_args(['-d', str(tmp_path / 'resource.db')] + options))
+    monkeypatch.setattr(gather.DataDumper, 'dump_app_role_assignments', both_sides)
+    benchmark.main(parser.parse_args(['-d', str(tmp_path / 'both.db')] + options))
+    resource = table_rows(str(tmp_path / 'resource.db'))['AppRoleAssignments']
+    assert any("'ServicePrincipal'" in row for row in resource)
+    assert resource == table_rows(str(tmp_path / 'both.db'))['AppRoleAssignments']
+
+def test_parse_batch_response():
+    """Test if the parts of a batch response are split in the order of the requests"""
+
+    body = ('--batchresponse_1\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n'
+            'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{"objectId": "a"}\r\n'
+            '--batchresponse_1\r\nContent-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n'
+            'HTTP/1.1 429 Too Many Requests\r\nRetry-After: 3\r\n\r\n\r\n'
+            '--batchresponse_1--\r\n')
+    results = gather.parse_batch_response('multipart/mixed; boundary="batchresponse_1"', body)
+    assert results == [(200, {'Content-Type': 'application/json'}, '{"objectId": "a"}'), (429, {'Retry-After': '3'}, '')]
+
+def test_batch_part_errors(monkeypatch):
+    """Test if throttled, failed and missing parts of a batch are sent again until they succeed or fail"""
+
+    monkeypatch.setattr(gather, 'RETRY_BASE_DELAY', 0.01)
+    tenant = benchmark.SyntheticTenant(users=10, groups=2, serviceprincipals=1, devices=1)
+    server = benchmark.MockDirectoryServer(tenant)
+    userids = [user['objectId'] for user in tenant.collections['users']]
+    server.part_faults = {'users/' + userids[0]: [429], 'users/' + userids[1]: [503], 'users/' + userids[7]: [None],
+                          'users/' + userids[4]: [503, 503, 503]}
+    async def run():
+        runner = await server.start()
+        ctx = gather.GatherContext(dict(TOKEN, tenantId=tenant.tenantid), 'sqlite://', retries=2, baseurl=server.baseurl)
+        try:
+            async with aiohttp.ClientSession() as ahsession:
+                batcher = gather.RequestBatcher(ctx, '1.61-internal', ahsession)
+                requests = [batcher.get('%s/%s/users/%s?api-version=1.61-internal' % (server.baseurl, tenant.tenantid, userid))
+                            for userid in userids]
+                return await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 30)
+        finally:
+            await runner.cleanup()
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert isinstance(results.pop(4), gather.RequestFailed)
+    assert [result['objectId'] for result in results] == userids[:4] + userids[5:]
+    assert not any(server.part_faults.values())
+
+@pytest.mark.parametrize('membership', ['auto', 'members'])
+def test_resume(tmp_path, membership):
+    """Test if resuming a gather that failed halfway gives the same database as a gather that did not fail"""
+
+    parser = argparse.ArgumentParser()
+    benchmark.getargs(parser)
+    options = ['--users', '100', '--groups', '10', '--throttle-rate', '0', '--membership', membership]
+    benchmark.main(parser.parse_args(['-d', str(tmp_path / 'clean.db')] + options))
+    resumed = ['-d', str(tmp_path / 'resumed.db')] + options
+    benchmark.main(parser.parse_args(resumed + ['--error-rate', '0.05', '--retries', '0']))
+    assert table_rows(str(tmp_path / 'resumed.db')) != table_rows(str(tmp_path / 'clean.db'))
+    benchmark.main(parser.parse_args(resumed + ['--resume']))
+    assert table_rows(str(tmp_path / 'resumed.db')) == table_rows(str(tmp_path / 'clean.db'))
+
+def test_incremental(tmp_path):
+    """Test if an incremental gather after changes in the tenant gives the same database as a full gather"""
+
+    tenant = benchmark.SyntheticTenant(users=100, groups=10, serviceprincipals=10, devices=10)
+    server = benchmark.MockDirectoryServer(tenant)
+    # The gather runs in the event loop of this thread, the mock API in another
+    loop = asyncio.new_event_loop()
+    runner = loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    token = dict(TOKEN, tenantId=tenant.tenantid)
+    parser = argparse.ArgumentParser()
+    gather.getargs(parser)
+    try:
+        incremental = parser.parse_args(['-d', str(tmp_path / 'incremental.db'), '--incremental'])
+        gather.run_gather(incremental, token, baseurl=server.baseurl)
+        users = tenant.collections['users']
+        groups = tenant.collections['groups']
+        tenant.update(users[1]['objectId'], displayName='Renamed')
+        tenant.delete(users[2]['objectId'])
+        tenant.addmember(groups[3]['objectId'], users[4]['objectId'])
+        tenant.addmember(groups[0]['objectId'], tenant.links[(groups[0]['objectId'], 'members')][0], remove=True)
+        gather.run_gather(incremental, token, baseurl=server.baseurl)
+        gather.run_gather(parser.parse_args(['-d', str(tmp_path / 'full.db')]), token, baseurl=server.baseurl)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+    assert table_rows(str(tmp_path / 'incremental.db')) == table_rows(str(tmp_path / 'full.db'))
+
+def test_rate_limiter(monkeypatch):
+    """Test if the rate of an endpoint increases additively up to the maximum and halves when throttled"""
+
+    monkeypatch.setattr(gather.time, 'time', lambda: 1000.0)
+    limiter = gather.AdaptiveRateLimiter(initial_rate=10, max_rate=12)
+    url = 'https://graph.windows.net/tenant/users?api-version=1.61-internal'
+    limiter.success(url)
+    assert limiter.rates()['users']['rate'] == 11
+    limiter.success(url)
+    limiter.success(url)
+    assert limiter.rates()['users']['rate'] == 12
+    limiter.throttled(url, '5')
+    assert limiter.rates()['users']['rate'] == 6
+    assert limiter.get_family(url).blocked_until == 1005.0
+    # Requests that were in flight are throttled too, but only halve the rate once
+    limiter.throttled(url, '5')
+    assert limiter.rates()['users']['rate'] == 6
+    # Other endpoints keep their rate
+    assert limiter.get_family('https://graph.windows.net/tenant/groups?api-version=1.61-internal').rate == 10
+    # Requests wait until the time of the Retry-After hint has passed
+    monkeypatch.undo()
+    limiter = gather.AdaptiveRateLimiter()
+    limiter.throttled(url, '0.2')
+    start = time.time()
+    asyncio.get_event_loop().run_until_complete(limiter.acquire(url))
+    assert time.time() - start >= 0.15
@@ -0,0 +1,39 @@
+import datetime
+import json
+from roadtools.roadlib import serializer
+import pytest
+
+VALUES = [
+    {'created': datetime.datetime(2021, 3, 4, 5, 6, 7)},
+    {2: 'integer key', 1: 'other integer key'},
+    {'large': 2 ** 70},
+    ['text', 1.5, True, None],
+]
+
+def default(obj):
+    return obj.isoformat()
+
+@pytest.mark.skipif(not serializer.HAS_ORJSON_MODULE, reason='orjson is not installed')
+@pytest.mark.parametrize('value', VALUES)
+def test_orjson_like_json(value):
+    """Test if orjson encodes like the json module, falling back to it for values orjson does not support"""
+
+    assert json.loads(serializer.orjson_dumps(value, default=default)) == json.loads(json.dumps(value, default=default))
+    assert serializer.orjson_dumps(value, default=default, sort_keys=True).replace(' ', '') == \
+        json.dumps(value, default=default, sort_keys=True).replace(' ', '')
+
+def test_set_backend():
+    """Test if set_backend switches dumps and loads, and refuses unknown backends"""
+
+    backend = serializer.BACKEND
+    try:
+        for name in serializer.available_backends():
+            serializer.set_backend(name)
+            assert serializer.BACKEND == name
+            assert serializer.loads(serializer.dumps({'a': [1, 2]})) == {'a': [1, 2]}
+        serializer.set_backend('json')
+        assert serializer.dumps is serializer.json_dumps
+        with pytest.raises(ValueError):
+            serializer.set_backend('nonexisting')
+    finally:
+        serializer.set_backend(backend)
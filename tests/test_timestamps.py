@@ -0,0 +1,27 @@
+import datetime
+from roadtools.roadlib.timestamps import parse_timestamp, parse_timestamps
+import pytest
+
+def test_parse_formats():
+    """Test if the timestamp formats of the API are parsed to naive datetimes in UTC"""
+
+    expected = datetime.datetime(2021, 3, 4, 5, 6, 7)
+    assert parse_timestamp('2021-03-04T05:06:07') == expected
+    assert parse_timestamp('2021-03-04T05:06:07Z') == expected
+    assert parse_timestamp('2021-03-04 05:06:07Z') == expected
+    assert parse_timestamp('2021-03-04T07:36:07+02:30') == expected
+    assert parse_timestamp('2021-03-04T07:36:07+0230') == expected
+    assert parse_timestamp('2021-03-04T02:06:07-03:00') == expected
+    assert parse_timestamp('2021-03-04T05:06:07.1234567Z') == expected.replace(microsecond=123456)
+    assert parse_timestamp('2021-03-04T05:06:07.5Z') == expected.replace(microsecond=500000)
+
+def test_parse_errors():
+    """Test if invalid timestamps raise ValueError, or become None with errors='coerce'"""
+
+    values = [None, 'garbage', '2021-13-01T00:00:00Z', '0001-01-01T00:00:00+01:00', '2021-03-04T05:06:07Z']
+    for value in values[1:4]:
+        with pytest.raises(ValueError):
+            parse_timestamp(value)
+    with pytest.raises(ValueError):
+        parse_timestamps(values)
+    assert parse_timestamps(values, errors='coerce') == [None, None, None, None, datetime.datetime(2021, 3, 4, 5, 6, 7)]